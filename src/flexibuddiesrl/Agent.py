@@ -1,15 +1,45 @@
 from abc import ABC, abstractmethod
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from flexibuddiesrl.Util import T
+from flexibuddiesrl.Util import (
+    T,
+    select_agents,
+    flatten_agents,
+    batch_rows,
+    autocast,
+)
+from flexibuddiesrl.Compile import CompiledUpdate, is_traced
+
+
+def keeps_hidden(method):
+    """
+    For agent methods that evaluate networks outside of acting, like
+    expected_V. Recurrent encoders step from the cached acting state and
+    it is put back afterwards, so the next train_actions continues from it.
+    """
+
+    @functools.wraps(method)
+    def wrapped(self, *args, **kwargs):
+        encoders = self._recurrent_encoders()
+        saved = [enc.hidden for enc in encoders]
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            for enc, hidden in zip(encoders, saved):
+                enc.hidden = hidden
+
+    return wrapped
 
 
 class Agent(ABC):
 
     @abstractmethod
     def train_actions(self, observations, action_mask=None, step=False):
+        # observations may be [obs_dim] or [n_envs, obs_dim] for a vector env,
+        # actions then come back with the same leading dim and step counts n_envs
         return 0, 0, 0  # Action 0, log_prob 0, value
 
     @abstractmethod
@@ -21,9 +51,11 @@ class Agent(ABC):
         return 0  # loss
 
     @abstractmethod
-    def utility_function(self, observations, actions=None):
+    def utility_function(self, observations, actions=None, target=False):
         return 0  # Returns the single-agent critic for a single action.
-        # If actions are none then V(s)
+        # If actions are none then V(s). actions is the
+        # (discrete_actions, continuous_actions) pair as stored in a FlexiBatch.
+        # target reads the agent's target networks where it keeps them
 
     @abstractmethod
     def expected_V(self, obs, legal_action):
@@ -34,6 +66,198 @@ class Agent(ABC):
     def reinforcement_learn(self, batch, agent_num=0, critic_only=False, debug=False):
         return 0, 0  # actor loss, critic loss
 
+    def shared_reinforcement_learn(
+        self, batch, agent_nums=None, one_hot_ids=False, critic_only=False, debug=False
+    ):
+        """
+        Parameter sharing: every agent in agent_nums is trained on these
+        weights in one update by folding the agent axis into the batch axis.
+        With one_hot_ids the agent id is appended to obs, so obs_dim must
+        include n_agents. Returns per-agent (actor_losses, critic_losses).
+        """
+        if agent_nums is None:
+            agent_nums = list(range(len(batch.obs)))
+        flat = flatten_agents(
+            select_agents(batch, agent_nums, len(batch.obs) if one_hot_ids else None)
+        )
+        aloss, closs = self.reinforcement_learn(
+            flat, agent_num=0, critic_only=critic_only, debug=debug
+        )
+        return self._pop_agent_losses(len(agent_nums), aloss, closs)
+
+    def learn_many(
+        self,
+        batch,
+        n_updates,
+        minibatch_size,
+        agent_num=0,
+        critic_only=False,
+        debug=False,
+    ):
+        """
+        n_updates gradient steps from one large sample, for off-policy agents.
+        batch should hold at least n_updates * minibatch_size random rows,
+        minibatch i is rows [i * minibatch_size, (i + 1) * minibatch_size)
+        wrapping around. Delayed policy and target updates follow the
+        agent's own step counters. Returns mean (actor_loss, critic_loss) and
+        leaves td_errors [B] over the whole batch for prioritized replay.
+
+        The loop itself stays in Python and is not compiled as one unit.
+        Only each step is, through compile_updates, so every minibatch
+        still pays one compiled call. What the loop saves is the per-step
+        sampling and the host sync on the losses.
+        """
+        bsize = batch.global_rewards.shape[0]
+        device = batch.global_rewards.device
+        offsets = torch.arange(minibatch_size, device=device)
+        alosses, closses = [], []
+        td_errors = None
+        self._keep_loss_tensors = True
+        try:
+            for i in range(n_updates):
+                idx = (offsets + i * minibatch_size) % bsize
+                aloss, closs = self.reinforcement_learn(
+                    batch_rows(batch, idx),
+                    agent_num=agent_num,
+                    critic_only=critic_only,
+                    debug=debug,
+                )
+                alosses.append(aloss)
+                closses.append(closs)
+                td = getattr(self, "td_errors", None)
+                if td is not None:
+                    if td_errors is None:
+                        td_errors = torch.zeros(bsize, device=td.device)
+                    td_errors[idx] = td
+        finally:
+            self._keep_loss_tensors = False
+        self.td_errors = td_errors
+        # agents skip the actor loss on delayed steps and report a float 0
+        losses = torch.stack(
+            [torch.as_tensor(l, dtype=torch.float, device=device) for l in alosses]
+            + [torch.as_tensor(l, dtype=torch.float, device=device) for l in closses]
+        )
+        aloss, closs = losses.reshape(2, n_updates).mean(dim=1).tolist()
+        return aloss, closs
+
+    def compile_updates(self, compile=True, buckets=None, mode=None):
+        """
+        Runs the update steps of reinforcement_learn (targets, losses,
+        backward and optimizer step) through torch.compile. Batches are
+        padded up to buckets of rows so each bucket compiles once, see
+        Compile.bucket_rows. Recurrent agents and centralized critics keep
+        the eager update. compile=False goes back to eager.
+        """
+        self.compile_options = {
+            "compile": compile and self._compilable(),
+            "buckets": buckets,
+            "mode": mode,
+        }
+        self._updates = {}
+
+    def mixed_precision(self, dtype=torch.bfloat16):
+        """
+        Runs the network forwards of acting and of reinforcement_learn under
+        torch.autocast with dtype, None for full precision. Weights and
+        optimizer state stay fp32 and network outputs are cast back to fp32,
+        so log probs, softmax targets, losses and GAE are full precision.
+        """
+        self.amp_dtype = dtype
+        self._updates = {}
+
+    def _autocast(self):
+        return autocast(self.device, getattr(self, "amp_dtype", None))
+
+    def _compilable(self):
+        # padded rows would break sequences and team attention
+        return not getattr(self, "recurrent", None) and not getattr(
+            self, "centralized_critic", False
+        )
+
+    def _update(self, name, loss_fn, optimizer=None, parameters=None, clip_grad=None):
+        # The CompiledUpdate behind one optimizer step, made on first use
+        updates = getattr(self, "_updates", None)
+        if updates is None:
+            updates = {}
+            self._updates = updates
+        update = updates.get(name)
+        if update is None or update.optimizer is not optimizer:
+            update = CompiledUpdate(
+                loss_fn,
+                optimizer,
+                parameters,
+                clip_grad,
+                amp_dtype=getattr(self, "amp_dtype", None),
+                **getattr(self, "compile_options", {}),
+            )
+            updates[name] = update
+        return update
+
+    def _recurrent_encoders(self):
+        found = []
+        for v in list(self.__dict__.values()) + list(
+            self.__dict__.get("_modules", {}).values()
+        ):
+            if isinstance(v, nn.Module):
+                for m in v.modules():
+                    if isinstance(m, RecurrentEncoder) and m not in found:
+                        found.append(m)
+        return found
+
+    def reset_hidden(self, done=None):
+        # Clears cached recurrent acting state, per env where done if given
+        for enc in self._recurrent_encoders():
+            enc.reset_hidden(done)
+
+    def set_recurrent_context(self, batch, agent_num=0, rows=None, hidden=None):
+        """
+        Tells every RecurrentEncoder how batch rows form sequences. Sequence
+        batches carry episode_starts (and burn_in_obs / burn_in_lengths),
+        time-ordered rollouts are split after each terminated step.
+        """
+        starts = getattr(batch, "episode_starts", None)
+        if starts is None:
+            term = T(batch.terminated).float()
+            starts = torch.ones_like(term, dtype=torch.bool)
+            starts[1:] = term[:-1] > 0.5
+        agent_ids = getattr(batch, "agent_ids", None)
+        if agent_ids is not None:
+            # flattened agents never share a sequence
+            starts = T(starts).clone()
+            starts[1:] |= agent_ids[1:] != agent_ids[:-1]
+        if rows is not None:
+            starts = T(starts)[rows]
+            if hidden is not None and bool(starts[0]):
+                hidden = None
+        burn_in_obs = getattr(batch, "burn_in_obs", None)
+        if burn_in_obs is not None:
+            burn_in_obs = burn_in_obs[agent_num]
+        for enc in self._recurrent_encoders():
+            enc.set_sequences(
+                starts,
+                hidden=hidden,
+                burn_in_obs=burn_in_obs,
+                burn_in_lengths=getattr(batch, "burn_in_lengths", None),
+            )
+
+    def clear_recurrent_context(self):
+        for enc in self._recurrent_encoders():
+            enc.clear_sequences()
+
+    def _loss_item(self, loss):
+        # learn_many keeps the loss tensors and syncs once after its loop
+        if getattr(self, "_keep_loss_tensors", False):
+            return loss.detach()
+        return loss.item()
+
+    def _pop_agent_losses(self, n_agents, aloss, closs):
+        # Agents that do not break losses down by agent report the team loss
+        losses = getattr(self, "agent_losses", None)
+        self.agent_losses = None
+        if losses is None:
+            return np.full(n_agents, aloss), np.full(n_agents, closs)
+        return losses
+
     @abstractmethod
     def save(self, checkpoint_path):
         print("Save not implemeted")
@@ -79,6 +303,7 @@ class ffEncoder(nn.Module):
                 self.encoder.append(nn.Linear(hidden_dims[i - 1], hidden_dims[i]))
             if orthogonal_init:
                 _orthogonal_init(self.encoder[-1])
+        self.output_dim = hidden_dims[-1] if len(hidden_dims) > 0 else obs_dim
         self.float()
         self.to(device)
         self.device = device
@@ -101,7 +326,7 @@ class ffEncoder(nn.Module):
             if debug:
                 interlist.append(x)
         # if x contains nan, print the intermediate list and encoder weights
-        if torch.isnan(x).any():
+        if not is_traced(x) and torch.isnan(x).any():
             if debug:
                 print(f"Intermediate list: {interlist}")
             for layer in self.encoder:
@@ -109,6 +334,428 @@ class ffEncoder(nn.Module):
         return x
 
 
+class RecurrentEncoder(nn.Module):
+    def __init__(
+        self,
+        obs_dim,
+        hidden_dims=[64],
+        rnn_hidden=64,
+        cell="gru",
+        activation="relu",
+        device="cpu",
+        orthogonal_init=False,
+    ):
+        """
+        obs_dim: int
+            The dimension of the observation space
+        hidden_dims: list
+            ffEncoder stack applied to each observation before the rnn
+        rnn_hidden: int
+            Hidden size of the GRU / LSTM, also the output_dim
+        cell: str
+            "gru" or "lstm"
+
+        Acting: [B, obs_dim] or [obs_dim] inputs advance a cached hidden
+        state by one step, cleared per env with reset_hidden(done).
+        Training: set_sequences() describes how the rows of a flat
+        [N, obs_dim] batch split into ordered sequences. Each sequence is run
+        as one packed rnn call so gradients truncate at sequence starts.
+        """
+        super(RecurrentEncoder, self).__init__()
+        assert cell in ["gru", "lstm"], "cell should be gru or lstm"
+        self.cell = cell
+        self.device = device
+        self.pre = ffEncoder(
+            obs_dim,
+            hidden_dims,
+            activation=activation,
+            device=device,
+            orthogonal_init=orthogonal_init,
+            dropout=0,
+        )
+        rnn = nn.GRU if cell == "gru" else nn.LSTM
+        self.rnn = rnn(self.pre.output_dim, rnn_hidden, batch_first=True)
+        self.rnn_hidden = rnn_hidden
+        self.output_dim = rnn_hidden
+        self.hidden = None
+        self.context = None
+        self.last_hidden = None
+        self.to(device)
+
+    def _zeros(self, n):
+        h = torch.zeros((1, n, self.rnn_hidden), device=self.device)
+        return (h, h.clone()) if self.cell == "lstm" else h
+
+    def _map_hidden(self, fn, h):
+        # GRU state is one tensor, LSTM state is an (h, c) pair
+        return tuple(fn(x) for x in h) if isinstance(h, tuple) else fn(h)
+
+    def reset_hidden(self, done=None):
+        """Zeros the cached acting state, only for envs where done if given"""
+        if done is None or self.hidden is None:
+            self.hidden = None
+            return
+        keep = 1.0 - T(done, self.device).float().reshape(1, -1, 1)
+        self.hidden = self._map_hidden(lambda h: h * keep, self.hidden)
+
+    def _pre(self, x):
+        # rnn inputs match the fp32 hidden state under autocast
+        return self.pre(x).float()
+
+    def step(self, x, hidden=None):
+        # One cell update for x [B, obs_dim], returns (features, new hidden)
+        feats = self._pre(x).unsqueeze(1)
+        if hidden is None:
+            hidden = self._zeros(feats.shape[0])
+        out, hidden = self.rnn(feats, hidden)
+        return out[:, 0], hidden
+
+    def set_sequences(
+        self, episode_starts, hidden=None, burn_in_obs=None, burn_in_lengths=None
+    ):
+        """
+        episode_starts: [N] bool
+            True where a row starts a new sequence, row 0 always does
+        hidden: tensor
+            Initial state of the first sequence, e.g. carried from the
+            previous truncated BPTT chunk. Others start from zeros.
+        burn_in_obs: [S, burn_in, obs_dim]
+            Observations preceding each sequence, run without gradient to
+            warm its initial state
+        burn_in_lengths: [S]
+            Valid left-aligned steps in each burn_in_obs row
+        """
+        self.context = (episode_starts, hidden, burn_in_obs, burn_in_lengths)
+
+    def clear_sequences(self):
+        self.context = None
+
+    def _burn_in(self, h0, burn_in_obs, burn_in_lengths):
+        lengths = T(burn_in_lengths, self.device).long()
+        warm = (lengths > 0).nonzero().squeeze(-1)
+        if warm.numel() == 0:
+            return h0
+        with torch.no_grad():
+            x = T(burn_in_obs, self.device).float()[warm]
+            packed = nn.utils.rnn.pack_padded_sequence(
+                self._pre(x),
+                lengths[warm].cpu(),
+                batch_first=True,
+                enforce_sorted=False,
+            )
+            _, h = self.rnn(packed, self._map_hidden(lambda h: h[:, warm], h0))
+
+        def put(pair):
+            h0, h = pair
+            h0 = h0.clone()
+            h0[:, warm] = h
+            return h0
+
+        if isinstance(h0, tuple):
+            return tuple(put(p) for p in zip(h0, h))
+        return put((h0, h))
+
+    def _sequences(self, x):
+        episode_starts, hidden, burn_in_obs, burn_in_lengths = self.context
+        n = x.shape[0]
+        starts = T(episode_starts, self.device).bool().reshape(n).clone()
+        starts[0] = True
+        seq_id = torch.cumsum(starts.long(), dim=0) - 1
+        first = starts.nonzero().squeeze(-1)
+        lengths = torch.diff(torch.cat([first, torch.tensor([n], device=self.device)]))
+        pos = torch.arange(n, device=self.device) - first[seq_id]
+
+        feats = self._pre(x)
+        padded = torch.zeros(
+            (first.shape[0], int(lengths.max()), feats.shape[-1]), device=self.device
+        )
+        padded[seq_id, pos] = feats
+
+        h0 = self._zeros(first.shape[0])
+        if burn_in_obs is not None:
+            h0 = self._burn_in(h0, burn_in_obs, burn_in_lengths)
+        if hidden is not None:
+            h0 = self._map_hidden(lambda h: h.clone(), h0)
+            if isinstance(h0, tuple):
+                for h, c in zip(h0, hidden):
+                    h[:, 0] = c[:, 0]
+            else:
+                h0[:, 0] = hidden[:, 0]
+
+        packed = nn.utils.rnn.pack_padded_sequence(
+            padded, lengths.cpu(), batch_first=True, enforce_sorted=False
+        )
+        out, h_n = self.rnn(packed, h0)
+        out, _ = nn.utils.rnn.pad_packed_sequence(out, batch_first=True)
+        # state after the last row, to carry into the next chunk
+        self.last_hidden = self._map_hidden(lambda h: h[:, -1:].detach(), h_n)
+        return out[seq_id, pos]
+
+    def forward(self, x, debug=False):
+        x = T(x, self.device).float()
+        if x.dim() == 3:
+            # [S, L, obs_dim] sequences from zero state
+            feats = self._pre(x)
+            out, h_n = self.rnn(feats, self._zeros(x.shape[0]))
+            self.last_hidden = self._map_hidden(lambda h: h.detach(), h_n)
+            return out
+        if self.context is not None:
+            if debug:
+                print(f"RecurrentEncoder: training on {x.shape[0]} rows")
+            return self._sequences(x)
+        single = x.dim() == 1
+        x = x.reshape(-1, x.shape[-1])
+        if self.hidden is not None and self._map_hidden(
+            lambda h: h.shape[1], self.hidden
+        ) not in [x.shape[0], (x.shape[0], x.shape[0])]:
+            self.hidden = None
+        out, hidden = self.step(x, self.hidden)
+        self.hidden = self._map_hidden(lambda h: h.detach(), hidden)
+        return out[0] if single else out
+
+
+class ConvEncoder(nn.Module):
+    def __init__(
+        self,
+        obs_shape,
+        channels=[32, 64, 64],
+        kernel_sizes=[8, 4, 3],
+        strides=[4, 2, 1],
+        hidden_dims=[512],
+        activation="relu",
+        device="cpu",
+        orthogonal_init=False,
+        channels_last=True,
+        scale=255.0,
+    ):
+        """
+        obs_shape: tuple
+            (C, H, W) of one observation, C includes any stacked frames
+        channels, kernel_sizes, strides: list
+            One entry per conv layer, defaults to the Nature DQN torso
+        hidden_dims: list
+            ffEncoder stack applied to the flattened conv features
+        channels_last: bool
+            Run the convs in channels_last memory format, faster on CPU
+        scale: float
+            uint8 frames are divided by this inside the network
+        """
+        super(ConvEncoder, self).__init__()
+        self.obs_shape = tuple(obs_shape)
+        self.device = device
+        self.channels_last = channels_last
+        self.scale = scale
+        activations = {"relu": nn.ReLU, "tanh": nn.Tanh, "sigmoid": nn.Sigmoid}
+        layers = []
+        in_channels = self.obs_shape[0]
+        for c, k, st in zip(channels, kernel_sizes, strides):
+            layers.append(nn.Conv2d(in_channels, c, kernel_size=k, stride=st))
+            if orthogonal_init:
+                _orthogonal_init(layers[-1])
+            layers.append(activations[activation]())
+            in_channels = c
+        self.conv = nn.Sequential(*layers)
+        with torch.no_grad():
+            n_flat = self.conv(torch.zeros((1,) + self.obs_shape)).numel()
+        self.mlp = ffEncoder(
+            n_flat,
+            hidden_dims,
+            activation=activation,
+            device=device,
+            orthogonal_init=orthogonal_init,
+            dropout=0,
+        )
+        self.output_dim = self.mlp.output_dim
+        self.to(device)
+        if channels_last:
+            self.conv.to(memory_format=torch.channels_last)
+
+    def forward(self, x, debug=False):
+        # uint8 [..., C, H, W] or flat [..., C*H*W] frames stay uint8 until
+        # here so the buffer and host->device copies are 4x smaller
+        x = T(x, self.device)
+        lead = x.shape[:-3] if x.shape[-3:] == self.obs_shape else x.shape[:-1]
+        x = x.reshape((-1,) + self.obs_shape).float() / self.scale
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = self.conv(x).flatten(1)
+        if debug:
+            print(f"ConvEncoder: conv features {x.shape}")
+        return self.mlp(x).reshape(lead + (self.output_dim,))
+
+
+class SparseEncoder(nn.Module):
+    def __init__(
+        self,
+        num_embeddings,
+        embed_dim,
+        hidden_dims,
+        dense_dim=0,
+        mode="sum",
+        activation="relu",
+        device="cpu",
+        orthogonal_init=False,
+    ):
+        """
+        num_embeddings: int
+            Size of the sparse id / category vocabulary
+        embed_dim: int
+            Width of the EmbeddingBag that replaces the dense first layer
+        hidden_dims: list
+            Dense ffEncoder stack applied after the bag lookup
+        dense_dim: int
+            Leading observation features passed through as dense floats
+        mode: str
+            EmbeddingBag reduction, "sum", "mean" or "max"
+
+        Observations are [..., dense_dim + max_active] with padded ids, -1
+        marking empty slots, so replay only stores the active ids. A tuple
+        (indices, offsets) or (indices, offsets, dense) in CSR form is also
+        accepted. Ids must reach the encoder exact, so replay obs carrying
+        them need an obs_dtype that holds num_embeddings ids (see the
+        ReplayBuffer obs_ids argument); float16 rounds ids above 2048.
+        """
+        super(SparseEncoder, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embed_dim = embed_dim
+        self.dense_dim = dense_dim
+        self.device = device
+        # the extra row is the padding id and stays zero
+        self.bag = nn.EmbeddingBag(
+            num_embeddings + 1, embed_dim, mode=mode, padding_idx=num_embeddings
+        )
+        self.mlp = ffEncoder(
+            embed_dim + dense_dim,
+            hidden_dims,
+            activation=activation,
+            device=device,
+            orthogonal_init=orthogonal_init,
+            dropout=0,
+        )
+        self.output_dim = self.mlp.output_dim
+        self.to(device)
+
+    def forward(self, x, debug=False):
+        if isinstance(x, (tuple, list)):
+            indices = torch.as_tensor(x[0], device=self.device).long()
+            offsets = torch.as_tensor(x[1], device=self.device).long()
+            e = self.bag(indices, offsets)
+            lead = e.shape[:1]
+            if self.dense_dim > 0:
+                dense = torch.as_tensor(x[2], device=self.device).float()
+                e = torch.cat([dense, e], dim=-1)
+        else:
+            x = T(x, self.device)
+            lead = x.shape[:-1]
+            x = x.reshape(-1, x.shape[-1])
+            ids = x[:, self.dense_dim :]
+            if not is_traced(ids):
+                assert bool(
+                    ((ids == ids.round()) & (ids < self.num_embeddings)).all()
+                ), "sparse ids must be integral and below num_embeddings"
+            ids = ids.long()
+            ids = torch.where(ids < 0, self.num_embeddings, ids)
+            e = self.bag(ids)
+            if self.dense_dim > 0:
+                e = torch.cat([x[:, : self.dense_dim].float(), e], dim=-1)
+        if debug:
+            print(f"SparseEncoder: bag output {e.shape}")
+        return self.mlp(e).reshape(lead + (self.output_dim,))
+
+
+class SetEncoder(nn.Module):
+    def __init__(
+        self,
+        entity_dim,
+        max_entities,
+        hidden_dims,
+        pooling="mean",
+        n_heads=4,
+        activation="relu",
+        device="cpu",
+        orthogonal_init=False,
+        dropout=0.0,
+    ):
+        """
+        Each entity is entity_dim features followed by a presence flag, 1 for
+        a real entity and 0 for padding, as built by Util.pad_entities. The
+        flag rides along in the observation so the actor, critic and replay
+        keep it without a separate mask argument.
+
+        entity_dim: int
+            Features per entity, not counting the presence flag
+        max_entities: int
+            Entities in a flat observation of size
+            max_entities * (entity_dim + 1)
+        hidden_dims: list
+            Hidden dims of the per-entity ffEncoder
+        pooling: str
+            "mean", "max" or "attention" over the present entities
+        n_heads: int
+            Heads of the attention pooling, must divide hidden_dims[-1]
+        """
+        super(SetEncoder, self).__init__()
+        assert pooling in ["mean", "max", "attention"], "Invalid pooling"
+        self.entity_dim = entity_dim
+        self.max_entities = max_entities
+        self.pooling = pooling
+        self.device = device
+        self.phi = ffEncoder(
+            entity_dim,
+            hidden_dims,
+            activation=activation,
+            device=device,
+            orthogonal_init=orthogonal_init,
+            dropout=dropout,
+        )
+        self.output_dim = self.phi.output_dim
+        if pooling == "attention":
+            assert self.output_dim % n_heads == 0, "n_heads should divide output_dim"
+            self.seed = nn.Parameter(torch.randn(1, 1, self.output_dim) * 0.1)
+            self.attention = nn.MultiheadAttention(
+                self.output_dim, n_heads, batch_first=True
+            )
+        self.to(device)
+
+    def _entities(self, x):
+        # Flat [..., max_entities * (entity_dim + 1)] or [..., E, entity_dim + 1]
+        # in, [B, E, entity_dim] features and the bool presence mask out
+        x = T(x, self.device).float()
+        width = self.entity_dim + 1
+        if x.shape[-1] == self.max_entities * width and (
+            x.dim() == 1 or self.max_entities > 1
+        ):
+            x = x.reshape(x.shape[:-1] + (self.max_entities, width))
+        lead = x.shape[:-2]
+        x = x.reshape((-1,) + x.shape[-2:])
+        return x[..., :-1], x[..., -1] > 0.5, lead
+
+    def forward(self, x, debug=False):
+        x, mask, lead = self._entities(x)
+        h = self.phi(x)
+        m = mask.unsqueeze(-1)
+        if self.pooling == "mean":
+            out = (h * m).sum(dim=1) / m.sum(dim=1).clamp(min=1)
+        elif self.pooling == "max":
+            out = h.masked_fill(~m, float("-inf")).max(dim=1).values
+            out = torch.where(m.any(dim=1), out, torch.zeros_like(out))
+        else:
+            # an empty set attends to its first (zero) slot instead of nothing
+            pad = ~mask
+            pad[:, 0] = pad[:, 0] & mask.any(dim=1)
+            out, _ = self.attention(
+                self.seed.expand(h.shape[0], -1, -1),
+                h,
+                h,
+                key_padding_mask=pad,
+                need_weights=False,
+            )
+            out = out.squeeze(1)
+        if debug:
+            print(f"SetEncoder: entities {x.shape}, present {mask.sum(dim=1)}")
+        return out.reshape(lead + (self.output_dim,))
+
+
 class MixedActor(nn.Module):
     def __init__(
         self,
@@ -131,10 +778,19 @@ class MixedActor(nn.Module):
         self.tau = tau
         self.hard = hard
         print(hidden_dims)
-        if encoder is None and len(hidden_dims) > 0:
+        # An injected encoder may be shared with a critic, so the heads are
+        # sized from its output rather than from hidden_dims
+        if encoder is not None:
+            self.encoder = encoder
+            feature_dim = encoder.output_dim
+        elif len(hidden_dims) > 0:
             self.encoder = ffEncoder(
                 obs_dim, hidden_dims, device=device, activation=activation, dropout=0
             )
+            feature_dim = hidden_dims[-1]
+        else:
+            self.encoder = None
+            feature_dim = obs_dim
 
         assert not (
             continuous_action_dim is None and discrete_action_dims is None
@@ -161,67 +817,87 @@ class MixedActor(nn.Module):
 
         self.continuous_actions_head = None
         if continuous_action_dim is not None and continuous_action_dim > 0:
-            self.continuous_actions_head = nn.Linear(
-                hidden_dims[-1], continuous_action_dim
-            )
+            self.continuous_actions_head = nn.Linear(feature_dim, continuous_action_dim)
             if orthogonal_init:
                 _orthogonal_init(self.continuous_actions_head)
 
         self.discrete_action_heads = nn.ModuleList()
         if discrete_action_dims is not None and len(discrete_action_dims) > 0:
             for dim in discrete_action_dims:
-                self.discrete_action_heads.append(nn.Linear(hidden_dims[-1], dim))
+                self.discrete_action_heads.append(nn.Linear(feature_dim, dim))
                 if orthogonal_init:
                     _orthogonal_init(self.discrete_action_heads[-1])
         self.to(device)
 
-    def forward(self, x, action_mask=None, gumbel=False, debug=False):
-        ogx = x
+    def _mask_logits(self, logits, action_mask=None):
+        if action_mask is None:
+            return logits
+        if not torch.is_tensor(action_mask):
+            action_mask = torch.as_tensor(action_mask, device=logits.device)
+        return torch.where(action_mask == 0, -1e8, logits)
+
+    def forward(self, x, action_mask=None, gumbel=False, debug=False, logits=False):
+        """
+        Returns (continuous_actions, discrete_actions). discrete_actions holds
+        one entry per discrete head: gumbel softmax samples if gumbel, raw
+        masked logits if logits, and softmax probabilities otherwise.
+        """
         if debug:
             print(f"MixedActor: x {x}, action_mask {action_mask}, gumbel {gumbel}")
         if self.encoder is not None:
             x = self.encoder(x=x, debug=debug)
         else:
             x = T(a=x, device=self.device, debug=debug)
+        return self.heads(x, action_mask, gumbel=gumbel, logits=logits)
 
+    def heads(self, x, action_mask=None, gumbel=False, logits=False):
+        # Action heads applied to already encoded features so a shared trunk
+        # only has to be evaluated once per forward
+        # head outputs are fp32 under autocast so sampling and log probs are
+        # full precision
         continuous_actions = None
         discrete_actions = None
         if self.continuous_actions_head is not None:
             continuous_actions = (
-                F.tanh(self.continuous_actions_head(x)) * self.action_scales
+                F.tanh(self.continuous_actions_head(x).float()) * self.action_scales
                 + self.action_biases
             )
             # If continuous action contains nan, print x and the continuous actions
-            if torch.isnan(continuous_actions).any():
+            if (
+                not is_traced(continuous_actions)
+                and torch.isnan(continuous_actions).any()
+            ):
                 print(f"Continuous actions: {continuous_actions}")
-                print(f"X: {x}, ogx: {ogx}")
+                print(f"X: {x}")
                 # raise ValueError("Continuous actions contain nan")
 
-        # TODO: Put this into it's own function and implement the ppo way of sampling
         if self.discrete_action_heads is not None:
             discrete_actions = []
             for i, head in enumerate(self.discrete_action_heads):
-                logits = head(x)
+                head_logits = self._mask_logits(head(x).float(), action_mask)
 
                 if gumbel:
-                    if action_mask is not None:
-                        logits[action_mask == 0] = -1e8
                     probs = F.gumbel_softmax(
-                        logits, dim=-1, tau=self.tau, hard=self.hard
+                        head_logits, dim=-1, tau=self.tau, hard=self.hard
                     )
-                    # activations = activations / activations.sum(dim=-1, keepdim=True)
                     discrete_actions.append(probs)
+                elif logits:
+                    discrete_actions.append(head_logits)
                 else:
-                    if action_mask is not None:
-                        logits[action_mask == 0] = -1e8
-                    discrete_actions.append(F.softmax(logits, dim=-1))
+                    discrete_actions.append(F.softmax(head_logits, dim=-1))
 
         return continuous_actions, discrete_actions
 
 
 class ValueSA(nn.Module):
     def __init__(
-        self, obs_dim, action_dim, hidden_dim=256, device="cpu", activation="relu"
+        self,
+        obs_dim,
+        action_dim,
+        hidden_dim=256,
+        device="cpu",
+        activation="relu",
+        encoder=None,
     ):
         super(ValueSA, self).__init__()
         self.device = device
@@ -231,6 +907,10 @@ class ValueSA(nn.Module):
             )
         activations = {"relu": F.relu, "tanh": torch.tanh, "sigmoid": torch.sigmoid}
         self.activation = activations[activation]
+        # obs go through the encoder first and the action joins its features
+        self.encoder = encoder
+        if encoder is not None:
+            obs_dim = encoder.output_dim
         self.l1 = nn.Linear(obs_dim + action_dim, hidden_dim)
         self.l2 = nn.Linear(hidden_dim, hidden_dim)
         self.l3 = nn.Linear(hidden_dim, 1)
@@ -239,9 +919,11 @@ class ValueSA(nn.Module):
     def forward(self, x, u, debug=False):
         if debug:
             print(f"ValueSA: x {x}, u {u}")
+        if self.encoder is not None:
+            x = self.encoder(x)
         x = self.activation(self.l1(torch.cat([x, u], -1)))
         x = self.activation(self.l2(x))
-        x = self.l3(x)
+        x = self.l3(x).float()
         return x
 
 
@@ -253,6 +935,8 @@ class ValueS(nn.Module):
         device="cpu",
         activation="relu",
         orthogonal_init=False,
+        encoder=None,
+        detach_encoder=False,
     ):
         super(ValueS, self).__init__()
         self.device = device
@@ -262,24 +946,124 @@ class ValueS(nn.Module):
             )
         activations = {"relu": F.relu, "tanh": torch.tanh, "sigmoid": torch.sigmoid}
         self.activation = activations[activation]
-        self.l1 = nn.Linear(obs_dim, hidden_dim)
-        self.l2 = nn.Linear(hidden_dim, hidden_dim)
-        self.l3 = nn.Linear(hidden_dim, 1)
+        # With a shared encoder only the value head belongs to the critic.
+        # detach_encoder stops the value loss from training the shared trunk.
+        self.encoder = encoder
+        self.detach_encoder = detach_encoder
+        if encoder is not None:
+            self.l3 = nn.Linear(encoder.output_dim, 1)
+        else:
+            self.l1 = nn.Linear(obs_dim, hidden_dim)
+            self.l2 = nn.Linear(hidden_dim, hidden_dim)
+            self.l3 = nn.Linear(hidden_dim, 1)
 
         if orthogonal_init:
-            _orthogonal_init(self.l1)
-            _orthogonal_init(self.l2)
+            if encoder is None:
+                _orthogonal_init(self.l1)
+                _orthogonal_init(self.l2)
             _orthogonal_init(self.l3)
         self.to(device)
 
+    def head(self, x):
+        if self.detach_encoder:
+            x = x.detach()
+        return self.l3(x).float()
+
     def forward(self, x):
+        if self.encoder is not None:
+            return self.head(self.encoder(x))
         x = T(x, self.device)
         x = self.activation(self.l1(x))
         x = self.activation(self.l2(x))
-        x = self.l3(x)
+        x = self.l3(x).float()
         return x
 
 
+class AttentionCritic(nn.Module):
+    def __init__(
+        self,
+        obs_dim,
+        action_dim=0,
+        hidden_dims=[64, 64],
+        n_heads=4,
+        activation="relu",
+        device="cpu",
+        orthogonal_init=False,
+    ):
+        """
+        obs_dim: int
+            Per-agent observation size
+        action_dim: int
+            Per-agent action size, 0 for a V(s) critic
+        hidden_dims: list
+            Hidden dims of the ffEncoder shared by every agent
+        n_heads: int
+            Attention heads, must divide hidden_dims[-1]
+        """
+        super(AttentionCritic, self).__init__()
+        self.device = device
+        self.encoder = ffEncoder(
+            obs_dim + action_dim,
+            hidden_dims,
+            activation=activation,
+            device=device,
+            orthogonal_init=orthogonal_init,
+            dropout=0,
+        )
+        embed_dim = self.encoder.output_dim
+        assert embed_dim % n_heads == 0, "n_heads should divide hidden_dims[-1]"
+        self.attention = nn.MultiheadAttention(embed_dim, n_heads, batch_first=True)
+        self.l3 = nn.Linear(2 * embed_dim, 1)
+        if orthogonal_init:
+            _orthogonal_init(self.l3)
+        self.to(device)
+
+    def forward(self, x, u=None, agent_mask=None, debug=False):
+        # x [B, n_agents, obs_dim] -> [B, n_agents, 1]. A 2d x is treated as a
+        # team of one so the critic also stands in for ValueS / ValueSA.
+        x = T(x, self.device).float()
+        single = x.dim() == 2
+        if single:
+            x = x.unsqueeze(1)
+            u = u.unsqueeze(1) if u is not None else None
+        if u is not None:
+            x = torch.cat([x, u.float()], dim=-1)
+        h = self.encoder(x)
+        pad = None if agent_mask is None else agent_mask == 0
+        context, _ = self.attention(h, h, h, key_padding_mask=pad, need_weights=False)
+        v = self.l3(torch.cat([h, context], dim=-1)).float()
+        if pad is not None:
+            v = v.masked_fill(pad.unsqueeze(-1), 0.0)
+        if debug:
+            print(f"AttentionCritic: h {h.shape}, v {v.shape}")
+        if single:
+            v = v.squeeze(1)
+        return v
+
+    def agent_value(self, team_obs, agent_num, team_u=None, u=None, agent_mask=None):
+        """
+        team_obs: tensor
+            [n_agents, B, obs_dim] as stored in a FlexiBatch
+        team_u: tensor
+            [n_agents, B, action_dim] or None for V(s)
+        u: tensor
+            [B, action_dim] used in place of agent_num's action in team_u
+        agent_mask: tensor
+            [n_agents, B] with 0 for padded agents
+
+        Returns the value of agent_num [B]
+        """
+        if u is not None:
+            team_u = team_u.clone()
+            team_u[agent_num] = u
+        v = self.forward(
+            team_obs.transpose(0, 1),
+            team_u.transpose(0, 1) if team_u is not None else None,
+            agent_mask.T if agent_mask is not None else None,
+        )
+        return v[:, agent_num, 0]
+
+
 class QSCA(nn.Module):
     def __init__(
         self,
@@ -370,43 +1154,46 @@ class QS(nn.Module):
             )
         self.device = device
         self.dueling = dueling
+        # An injected encoder such as SetEncoder sets the head input size
+        feature_dim = getattr(self.encoder, "output_dim", hidden_dims[-1])
         if self.dueling:
-            self.value_head = nn.Linear(hidden_dims[-1], 1)
+            self.value_head = nn.Linear(feature_dim, 1)
         else:
             self.value_head = None
 
         self.discrete_advantage_heads = nn.ModuleList()
         if discrete_action_dims is not None and len(discrete_action_dims) > 0:
             for dim in discrete_action_dims:
-                self.discrete_advantage_heads.append(nn.Linear(hidden_dims[-1], dim))
+                self.discrete_advantage_heads.append(nn.Linear(feature_dim, dim))
 
         self.continuous_advantage_heads = nn.ModuleList()
         if continuous_action_dim > 0:
             for dim in range(continuous_action_dim):
                 self.continuous_advantage_heads.append(
-                    nn.Linear(hidden_dims[-1], n_c_action_bins)
+                    nn.Linear(feature_dim, n_c_action_bins)
                 )
 
         self.to(device)
 
     def forward(self, x, action_mask=None):
         # TODO: action mask implementation
-        x = T(x, self.device)
+        # the encoder converts x itself, a SparseEncoder may get a CSR tuple
         x = self.encoder(x)
+        # fp32 outputs under autocast keep targets and softmaxes full precision
         values = 0
         if self.dueling:
-            values = self.value_head(x)
+            values = self.value_head(x).float()
         disc_advantages = []
         if len(self.disc_action_dims) > 0:
             for i, head in enumerate(self.discrete_advantage_heads):
-                Adv = head(x)
+                Adv = head(x).float()
                 if self.dueling:
                     Adv = Adv - Adv.mean(dim=-1, keepdim=True)
                 disc_advantages.append(Adv)
         cont_advantages = []
         if self.cont_action_dims > 0:
             for i, head in enumerate(self.continuous_advantage_heads):
-                Adv = head(x)
+                Adv = head(x).float()
                 if self.dueling:
                     Adv = Adv - Adv.mean(dim=-1, keepdim=True)
                 cont_advantages.append(Adv)
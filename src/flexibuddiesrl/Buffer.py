@@ -0,0 +1,689 @@
+import copy
+import queue
+import threading
+import torch
+import numpy as np
+from flexibuff import FlexiBatch
+from flexibuddiesrl.Util import AGENT_FIELDS, GLOBAL_FIELDS, holds_ids, pack_mask
+
+
+class FrameStore:
+    def __init__(self, capacity, frame_shape, stack=4, device="cpu"):
+        """
+        capacity: int
+            Number of single frames kept, older frames are overwritten
+        frame_shape: tuple
+            (C, H, W) of one uint8 frame
+        stack: int
+            Frames per stacked observation
+
+        Each frame is stored once. Transitions keep the frame id returned by
+        add() for obs and obs_ and stacks are gathered on sample, so a stack
+        of k frames costs k times less memory than storing stacked obs.
+        """
+        self.capacity = capacity
+        self.frame_shape = tuple(frame_shape)
+        self.stack_size = stack
+        self.device = device
+        self.frames = torch.zeros(
+            (capacity,) + self.frame_shape, dtype=torch.uint8, device=device
+        )
+        # absolute frame id of the first frame of each frame's episode
+        self.episode_start = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.next_id = 0
+        self._start = 0
+
+    def add(self, frame, new_episode=False):
+        """Stores one frame and returns its id"""
+        if new_episode:
+            self._start = self.next_id
+        slot = self.next_id % self.capacity
+        self.frames[slot] = torch.as_tensor(frame, device=self.device)
+        self.episode_start[slot] = self._start
+        self.next_id += 1
+        return self.next_id - 1
+
+    def stack(self, ids):
+        """
+        ids: array of frame ids from add()
+
+        Returns uint8 [B, stack * C, H, W]. Frames before an episode start
+        repeat the first frame of the episode.
+        """
+        ids = torch.as_tensor(ids, device=self.device).long()
+        offsets = torch.arange(-self.stack_size + 1, 1, device=self.device)
+        frame_ids = ids.unsqueeze(-1) + offsets
+        start = self.episode_start[ids % self.capacity].unsqueeze(-1)
+        frame_ids = torch.maximum(frame_ids, start)
+        assert (
+            frame_ids.numel() == 0
+            or int(frame_ids.min()) >= self.next_id - self.capacity
+        ), "Frame ids have been overwritten"
+        stacked = self.frames[frame_ids % self.capacity]
+        return stacked.reshape(
+            ids.shape + (self.stack_size * self.frame_shape[0],) + self.frame_shape[1:]
+        )
+
+
+class ReplayBuffer:
+    def __init__(
+        self,
+        capacity,
+        obs_dim,
+        discrete_action_dims=None,
+        continuous_action_dim=0,
+        n_agents=1,
+        state_dim=None,
+        action_mask=False,
+        log_probs=True,
+        individual_rewards=False,
+        store_next_obs=True,
+        obs_dtype=torch.float32,
+        action_dtype=torch.long,
+        pack_masks=False,
+        obs_ids=0,
+        device="cpu",
+    ):
+        """
+        capacity: int
+            Transitions kept, the oldest are overwritten
+        obs_dim: int
+            Size of one agent's observation
+        discrete_action_dims: list
+            Cardinality of each discrete head, None or [] for none
+        continuous_action_dim: int
+            Number of continuous actions
+        state_dim: int
+            Size of a global state, None to not store one
+        action_mask: bool
+            Store a legal action mask per discrete head for obs and obs_
+        log_probs: bool
+            Store discrete and continuous log probs
+        store_next_obs: bool
+            Keep an obs_ column. When False obs_ of a transition is the obs
+            of the next transition from the same stream (env), found by a
+            stored row index. Only an episode's final obs takes an extra row.
+        obs_dtype: torch.dtype
+            Storage dtype of obs and state, e.g. torch.float16, torch.bfloat16
+            or torch.uint8 for frames
+        action_dtype: torch.dtype
+            Storage dtype of discrete actions, e.g. torch.int8 or torch.int16
+        pack_masks: bool
+            Store action masks as bits, 8 actions per byte
+        obs_ids: int
+            num_embeddings of a SparseEncoder whose padded ids ride in obs, 0
+            if obs holds none. obs_dtype must store these ids exactly, e.g.
+            float16 only holds ids up to 2048
+
+        Compact batches are upcast on device by Util.upcast_batch, which
+        every agent's reinforcement_learn applies first.
+
+        Replay store whose columns are torch tensors preallocated at capacity
+        on device, laid out like flexibuff ([n_agents, capacity, ...] agent
+        columns, [capacity, ...] global ones). sample() draws indices on
+        device and gathers each column once into a FlexiBatch, so nothing
+        goes through numpy on the way to the learner.
+        """
+        self.capacity = capacity
+        self.obs_dim = obs_dim
+        self.n_agents = n_agents
+        self.discrete_action_dims = (
+            [] if discrete_action_dims is None else list(discrete_action_dims)
+        )
+        self.continuous_action_dim = continuous_action_dim
+        self.store_next_obs = store_next_obs
+        self.obs_dtype = obs_dtype
+        self.action_dtype = action_dtype
+        self.pack_masks = pack_masks
+        self.device = device
+        nd = len(self.discrete_action_dims)
+        if nd > 0:
+            assert (
+                max(self.discrete_action_dims) - 1 <= torch.iinfo(action_dtype).max
+            ), f"{action_dtype} cannot hold {max(self.discrete_action_dims)} actions"
+        assert obs_ids == 0 or holds_ids(
+            obs_dtype, obs_ids
+        ), f"{obs_dtype} cannot hold {obs_ids} ids"
+
+        def agent_col(width, dtype=torch.float32):
+            return torch.zeros((n_agents, capacity, width), dtype=dtype, device=device)
+
+        self.columns = {
+            "obs": agent_col(obs_dim, obs_dtype),
+            "global_rewards": torch.zeros(capacity, device=device),
+            "terminated": torch.zeros(capacity, device=device),
+        }
+        if store_next_obs:
+            self.columns["obs_"] = agent_col(obs_dim, obs_dtype)
+        else:
+            # row holding each transition's next obs
+            self.next_idx = torch.zeros(capacity, dtype=torch.long, device=device)
+        if nd > 0:
+            self.columns["discrete_actions"] = agent_col(nd, action_dtype)
+            if log_probs:
+                self.columns["discrete_log_probs"] = agent_col(nd)
+        if continuous_action_dim > 0:
+            self.columns["continuous_actions"] = agent_col(continuous_action_dim)
+            if log_probs:
+                self.columns["continuous_log_probs"] = agent_col(continuous_action_dim)
+        if state_dim is not None:
+            for f in ["state", "state_"]:
+                self.columns[f] = torch.zeros(
+                    (capacity, state_dim), dtype=obs_dtype, device=device
+                )
+        if individual_rewards:
+            self.columns["individual_rewards"] = torch.zeros(
+                (n_agents, capacity), device=device
+            )
+        if action_mask:
+            # one [n_agents, capacity, dim] mask per head like flexibuff
+            for f in ["action_mask", "action_mask_"]:
+                self.columns[f] = [
+                    (
+                        torch.full(
+                            (n_agents, capacity, (d + 7) // 8), 255, device=device
+                        ).to(torch.uint8)
+                        if pack_masks
+                        else torch.ones((n_agents, capacity, d), device=device)
+                    )
+                    for d in self.discrete_action_dims
+                ]
+        # rows that hold a complete transition
+        self.sampleable = torch.zeros(capacity, dtype=torch.bool, device=device)
+        self.reset()
+
+    def reset(self):
+        self.idx = 0
+        self.steps_recorded = 0
+        self._set_sampleable(torch.arange(self.capacity, device=self.device), False)
+        # latest row of each stream still waiting for its next obs
+        self._last_row = torch.full((0,), -1, dtype=torch.long, device=self.device)
+
+    def __len__(self):
+        return self.steps_recorded
+
+    def _set_sampleable(self, slots, flag):
+        self.sampleable[slots] = flag
+
+    def _prepare(self, name, col, x, rows):
+        if self.pack_masks and name in ["action_mask", "action_mask_"]:
+            x = pack_mask(torch.as_tensor(x, device=self.device))
+        x = torch.as_tensor(x, device=self.device).to(col.dtype)
+        agent = name in AGENT_FIELDS
+        if agent and x.dim() == col.dim() - 1:
+            x = x.unsqueeze(0)  # single agent data without the agent axis
+        if rows is not None:
+            x = x[:, rows] if agent else x[rows]
+        if agent:
+            return x.reshape((col.shape[0], -1) + col.shape[2:])
+        return x.reshape((-1,) + col.shape[1:])
+
+    def _write(self, name, x, slots):
+        col = self.columns[name]
+        if isinstance(col, list):
+            for c, m in zip(col, x):
+                c[:, slots] = m
+        elif name in AGENT_FIELDS:
+            col[:, slots] = x
+        else:
+            col[slots] = x
+
+    def add(self, rows=None, episode_ends=None, streams=None, **columns):
+        """
+        Writes n transitions at once, for example one per env of a vector
+        env step. Global columns are [n, ...], agent columns
+        [n_agents, n, ...] or [n, ...] when there is one agent. rows is an
+        optional bool mask over n of the transitions to keep. Columns the
+        buffer does not track raise a KeyError, missing ones keep stale data.
+
+        Without store_next_obs, streams gives each row's env id (default its
+        position in n, each stream at most once per call) and episode_ends
+        marks rows whose obs_ starts no further transition (terminated or
+        truncated, default terminated). Only those rows' obs_ are stored.
+        """
+        if rows is not None:
+            rows = torch.as_tensor(rows, device=self.device, dtype=torch.bool)
+        next_obs = columns.pop("obs_", None)
+        prepared = {}
+        n = None
+        for name, x in columns.items():
+            if x is None:
+                continue
+            col = self.columns[name]
+            if isinstance(col, list):
+                prepared[name] = [
+                    self._prepare(name, c, m, rows) for c, m in zip(col, x)
+                ]
+                n = prepared[name][0].shape[1]
+            else:
+                prepared[name] = self._prepare(name, col, x, rows)
+                n = prepared[name].shape[1 if name in AGENT_FIELDS else 0]
+        if next_obs is not None:
+            next_obs = self._prepare("obs_", self.columns["obs"], next_obs, rows)
+        if not n:
+            return 0
+
+        if self.store_next_obs:
+            if next_obs is not None:
+                prepared["obs_"] = next_obs
+            slots = self._claim(n)
+            for name, x in prepared.items():
+                self._write(name, x, slots)
+            self._set_sampleable(slots, True)
+            return n
+
+        if episode_ends is None:
+            ends = prepared["terminated"] > 0.5
+        else:
+            ends = torch.as_tensor(episode_ends, device=self.device, dtype=torch.bool)
+            if rows is not None:
+                ends = ends[rows]
+        if streams is None:
+            streams = torch.arange(rows.shape[0] if rows is not None else n)
+        streams = torch.as_tensor(streams, device=self.device, dtype=torch.long)
+        if rows is not None and streams.shape[0] != n:
+            streams = streams[rows]
+        n_ends = int(ends.sum())
+        slots = self._claim(n + n_ends)
+        t_slots, end_slots = slots[:n], slots[n:]
+        for name, x in prepared.items():
+            self._write(name, x, t_slots)
+        # an episode's final obs goes in an extra row that is never sampled
+        self.columns["obs"][:, end_slots] = next_obs[:, ends]
+        self.next_idx[t_slots[ends]] = end_slots
+
+        if int(streams.max()) >= self._last_row.shape[0]:
+            grown = torch.full(
+                (int(streams.max()) + 1,), -1, dtype=torch.long, device=self.device
+            )
+            grown[: self._last_row.shape[0]] = self._last_row
+            self._last_row = grown
+        # the previous row of each stream is completed by this obs
+        prev = self._last_row[streams]
+        linked = prev >= 0
+        self.next_idx[prev[linked]] = t_slots[linked]
+        self._set_sampleable(prev[linked], True)
+        self._set_sampleable(t_slots[ends], True)
+        self._last_row[streams] = torch.where(
+            ends, torch.full_like(t_slots, -1), t_slots
+        )
+        return n
+
+    def _claim(self, n):
+        # next n ring rows, forgetting whatever transitions lived there
+        slots = (self.idx + torch.arange(n, device=self.device)) % self.capacity
+        self._set_sampleable(slots, False)
+        if not self.store_next_obs and self._last_row.shape[0] > 0:
+            stale = torch.isin(self._last_row, slots)
+            self._last_row[stale] = -1
+        self.idx = (self.idx + n) % self.capacity
+        self.steps_recorded = min(self.steps_recorded + n, self.capacity)
+        return slots
+
+    def save_transition(self, **columns):
+        """Stores a single step, agent columns [n_agents, ...] or unbatched"""
+        single = {}
+        for name, x in columns.items():
+            if x is None:
+                continue
+            col = self.columns["obs" if name == "obs_" else name]
+            if isinstance(col, list):
+                single[name] = [
+                    torch.as_tensor(m, device=self.device).reshape(self.n_agents, 1, -1)
+                    for m in x
+                ]
+            elif name in AGENT_FIELDS:
+                single[name] = torch.as_tensor(x, device=self.device).reshape(
+                    (self.n_agents, 1) + col.shape[2:]
+                )
+            else:
+                single[name] = torch.as_tensor(x, device=self.device).reshape(
+                    (1,) + col.shape[1:]
+                )
+        return self.add(**single)
+
+    def batch(self, idx):
+        """FlexiBatch of rows idx, a long tensor on the buffer's device"""
+        fields = {}
+        for name, col in self.columns.items():
+            agent = name in AGENT_FIELDS
+            if isinstance(col, list):
+                fields[name] = [c.index_select(1, idx) for c in col]
+            else:
+                fields[name] = col.index_select(1 if agent else 0, idx)
+        if not self.store_next_obs:
+            fields["obs_"] = self.columns["obs"].index_select(
+                1, self.next_idx.index_select(0, idx)
+            )
+        batch = FlexiBatch(**fields)
+        if self.pack_masks:
+            batch.packed_mask_dims = self.discrete_action_dims
+        return batch
+
+    def sample_transitions(self, batch_size=256, idx=None):
+        """
+        batch_size transitions drawn uniformly with replacement, or the rows
+        in idx. Like flexibuff with as_torch=True the batch is on device.
+        """
+        if idx is None and self.store_next_obs:
+            idx = torch.randint(
+                0, self.steps_recorded, (batch_size,), device=self.device
+            )
+        elif idx is None:
+            # only rows whose obs_ has arrived and that are not final obs
+            rows = self.sampleable.nonzero().squeeze(-1)
+            if rows.numel() == 0:
+                raise ValueError(
+                    "No transition can be sampled yet, every stored row is "
+                    "still waiting for its next obs"
+                )
+            idx = rows[
+                torch.randint(0, rows.numel(), (batch_size,), device=self.device)
+            ]
+        else:
+            idx = torch.as_tensor(idx, device=self.device, dtype=torch.long)
+        return self.batch(idx)
+
+
+class SumTree:
+    def __init__(self, capacity, device="cpu"):
+        """
+        Array sum-tree over capacity leaves. Node i has children 2i and
+        2i + 1, the root is node 1 and leaf j is node size + j. Updates and
+        sampling touch one node per level for the whole batch at once.
+        """
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.depth = self.size.bit_length() - 1
+        self.device = device
+        self.tree = torch.zeros(2 * self.size, dtype=torch.float64, device=device)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, idx, values):
+        node = idx + self.size
+        self.tree[node] = values.to(self.tree.dtype)
+        for _ in range(self.depth):
+            node = node // 2
+            # duplicate parents all write the same sum
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def sample(self, n):
+        """
+        Stratified draw of n leaves, one uniform point in each of n equal
+        slices of the total. Returns (leaf indices, leaf priorities).
+        """
+        total = self.total()
+        u = (
+            torch.arange(n, device=self.device, dtype=torch.float64)
+            + torch.rand(n, device=self.device, dtype=torch.float64)
+        ) * (total / n)
+        # the last slice may round up to total, keep u in [0, total)
+        u = torch.minimum(u, torch.nextafter(total, torch.zeros_like(total)))
+        node = torch.ones(n, dtype=torch.long, device=self.device)
+        for _ in range(self.depth):
+            left = 2 * node
+            left_sum = self.tree[left]
+            right_sum = self.tree[left + 1]
+            # rounding in the parent sums must not lead into a zero-mass subtree
+            go_right = ((u >= left_sum) & (right_sum > 0)) | (left_sum <= 0)
+            u = torch.where(go_right, u - left_sum, u)
+            node = torch.where(go_right, left + 1, left)
+        return node - self.size, self.tree[node]
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(
+        self,
+        capacity,
+        obs_dim,
+        alpha=0.6,
+        beta=0.4,
+        beta_increment=1e-4,
+        eps=1e-6,
+        **kwargs,
+    ):
+        """
+        alpha: float
+            Priority exponent, 0 is uniform sampling
+        beta: float
+            Importance weight exponent, annealed to 1 by beta_increment per
+            sample call
+        eps: float
+            Added to |td error| so no transition gets priority 0
+
+        ReplayBuffer whose sample_transitions draws proportionally to
+        priority. The batch carries indices and is_weights, which DQN and
+        TD3 apply to their TD losses. After learning pass agent.td_errors to
+        update_priorities(batch.indices, ...).
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.max_priority = 1.0
+        self.tree = SumTree(capacity, kwargs.get("device", "cpu"))
+        # rows the tree can draw, the N of the importance weights
+        self.n_sampleable = torch.zeros(
+            (), dtype=torch.long, device=kwargs.get("device", "cpu")
+        )
+        super(PrioritizedReplayBuffer, self).__init__(capacity, obs_dim, **kwargs)
+
+    def _set_sampleable(self, slots, flag):
+        before = self.sampleable[slots].sum()
+        super(PrioritizedReplayBuffer, self)._set_sampleable(slots, flag)
+        self.n_sampleable += self.sampleable[slots].sum() - before
+        # new transitions are sampled at least once before being scored
+        p = self.max_priority**self.alpha if flag else 0.0
+        self.tree.update(slots, torch.full((slots.shape[0],), p, device=self.device))
+
+    def sample_transitions(self, batch_size=256, idx=None):
+        if idx is not None:
+            return super(PrioritizedReplayBuffer, self).sample_transitions(
+                batch_size, idx
+            )
+        idx, priorities = self.tree.sample(batch_size)
+        probs = priorities / self.tree.total()
+        weights = (self.n_sampleable * probs) ** (-self.beta)
+        batch = self.batch(idx)
+        batch.indices = idx
+        batch.is_weights = (weights / weights.max()).float()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return batch
+
+    def update_priorities(self, idx, td_errors):
+        """Sets the priorities of rows idx from their |td errors| in one call"""
+        p = torch.as_tensor(td_errors, device=self.device).detach().abs() + self.eps
+        self.max_priority = max(self.max_priority, float(p.max()))
+        self.tree.update(idx, p**self.alpha)
+
+
+class BatchPrefetcher:
+    def __init__(self, sample_fn, depth=2, device="cpu", pin_memory=None):
+        """
+        sample_fn: callable
+            Returns the next FlexiBatch with numpy or cpu torch fields, e.g.
+            lambda: buffer.sample_transitions(256, as_torch=False)
+        depth: int
+            Batches sampled ahead of the learner
+        device: str
+            Where the learner wants its batches
+        pin_memory: bool
+            Stage batches in pinned host tensors, on by default when cuda
+            is available
+
+        Samples on a background thread and copies each batch into one of
+        depth + 2 preallocated (pinned) staging slots, then to device
+        asynchronously on a side stream. The learner takes ready batches:
+
+            prefetcher = BatchPrefetcher(sample_fn, depth=4, device="cuda")
+            for _ in range(n_updates):
+                agent.reinforcement_learn(prefetcher.get())
+            prefetcher.close()
+
+        On cpu without pinning, batches are handed over as sampled and a
+        batch is only valid until depth + 1 more batches have been taken.
+        """
+        self.sample_fn = sample_fn
+        self.depth = depth
+        self.device = torch.device(device)
+        # pinning needs a cuda driver
+        self.pin_memory = torch.cuda.is_available() and pin_memory is not False
+        self.staged = self.pin_memory or self.device.type != "cpu"
+        self.slots = [{} for _ in range(depth + 2)]
+        self.slot_events = [None] * len(self.slots)
+        self.queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _stage(self, slot, name, x):
+        x = torch.as_tensor(x)
+        if not self.staged:
+            return x
+        buf = slot.get(name)
+        if buf is None or buf.shape != x.shape or buf.dtype != x.dtype:
+            buf = torch.empty(x.shape, dtype=x.dtype, pin_memory=self.pin_memory)
+            slot[name] = buf
+        buf.copy_(x)
+        return buf.to(self.device, non_blocking=self.pin_memory)
+
+    def _to_device(self, batch, slot):
+        out = copy.copy(batch)
+        for f in AGENT_FIELDS + GLOBAL_FIELDS:
+            x = getattr(batch, f, None)
+            if isinstance(x, list):
+                x = [self._stage(slot, f"{f}{j}", a) for j, a in enumerate(x)]
+            elif isinstance(x, (np.ndarray, torch.Tensor)):
+                x = self._stage(slot, f, x)
+            else:
+                continue
+            setattr(out, f, x)
+        return out
+
+    def _worker(self):
+        cuda = self.device.type == "cuda"
+        stream = torch.cuda.Stream(self.device) if cuda else None
+        i = 0
+        while not self._stop.is_set():
+            event = None
+            try:
+                batch = self.sample_fn()
+                s = i % len(self.slots)
+                i += 1
+                if self.slot_events[s] is not None:
+                    # the last copy out of this slot must be done
+                    self.slot_events[s].synchronize()
+                if cuda:
+                    with torch.cuda.stream(stream):
+                        batch = self._to_device(batch, self.slots[s])
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    self.slot_events[s] = event
+                else:
+                    batch = self._to_device(batch, self.slots[s])
+            except Exception as e:
+                batch = e
+            while not self._stop.is_set():
+                try:
+                    self.queue.put((batch, event), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(batch, Exception):
+                return
+
+    def get(self):
+        """Next batch on device, waits only if sampling has fallen behind"""
+        batch, event = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for f in AGENT_FIELDS + GLOBAL_FIELDS:
+                x = getattr(batch, f, None)
+                for t in x if isinstance(x, list) else [x]:
+                    if torch.is_tensor(t):
+                        # memory was allocated on the side stream
+                        t.record_stream(current)
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def close(self):
+        self._stop.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.thread.join()
+
+
+def sample_sequences(batch, n_seqs, seq_len, burn_in=0, rng=None):
+    """
+    batch: FlexiBatch
+        Time-ordered transitions of one env, agent fields [n_agents, T, ...]
+    n_seqs: int
+        Windows to sample
+    seq_len: int
+        Steps per window, gradients are truncated at window starts
+    burn_in: int
+        Steps before each window used only to warm the recurrent state
+
+    Returns a shallow copy of batch with the windows laid end to end on the
+    batch axis ([n_agents, n_seqs * seq_len, ...]) plus episode_starts,
+    burn_in_obs [n_agents, n_seqs, burn_in, obs_dim] and burn_in_lengths,
+    ready for Agent.set_recurrent_context. Windows may cross episode ends,
+    the step after a terminated one is flagged as a new sequence.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_steps = batch.obs.shape[1]
+    seq_len = min(seq_len, n_steps)
+    first = torch.as_tensor(
+        rng.integers(0, n_steps - seq_len + 1, size=n_seqs), device=batch.obs.device
+    )
+    rows = (first.unsqueeze(-1) + torch.arange(seq_len, device=first.device)).reshape(
+        -1
+    )
+
+    seq = copy.copy(batch)
+    for f in AGENT_FIELDS:
+        x = getattr(batch, f, None)
+        if x is None:
+            continue
+        if isinstance(x, list):
+            setattr(seq, f, [a[rows] for a in x])
+        else:
+            setattr(seq, f, x[:, rows])
+    for f in GLOBAL_FIELDS:
+        x = getattr(batch, f, None)
+        if x is None:
+            continue
+        setattr(seq, f, x[rows])
+
+    term = batch.terminated.float()
+    starts = torch.zeros(rows.shape[0], dtype=torch.bool, device=rows.device)
+    starts[1:] = term[rows[:-1]] > 0.5
+    starts[::seq_len] = True
+    seq.episode_starts = starts
+
+    if burn_in > 0:
+        # steps since the episode began, so burn-in never crosses an episode
+        steps = torch.arange(n_steps, device=rows.device)
+        new_episode = torch.zeros(n_steps, dtype=torch.bool, device=rows.device)
+        new_episode[1:] = term[:-1] > 0.5
+        episode_first = torch.cummax(steps * new_episode, dim=0).values
+        lengths = torch.clamp(steps[first] - episode_first[first], max=burn_in)
+        offsets = torch.arange(burn_in, device=rows.device)
+        idx = first.unsqueeze(-1) - lengths.unsqueeze(-1) + offsets
+        valid = offsets.unsqueeze(0) < lengths.unsqueeze(-1)
+        idx = torch.where(valid, idx, torch.zeros_like(idx))
+        burn_in_obs = batch.obs[:, idx] * valid.unsqueeze(-1)
+        seq.burn_in_obs = burn_in_obs
+        seq.burn_in_lengths = lengths
+    return seq
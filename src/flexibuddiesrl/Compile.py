@@ -0,0 +1,335 @@
+import warnings
+import torch
+from flexibuddiesrl.Util import autocast
+
+
+def bucket_rows(n, buckets=None):
+    """
+    Number of rows a batch of n is padded to before a compiled update: the
+    next power of two, or the first entry of the sorted buckets list that
+    holds n. Each bucket is one static shape, so it compiles once.
+    """
+    if buckets is None:
+        return 1 << max(int(n) - 1, 0).bit_length()
+    for b in buckets:
+        if b >= n:
+            return b
+    return int(n)
+
+
+def pad_rows(x, size):
+    # Pads dim 0 by repeating real rows so padding never holds an all-masked
+    # action or a NaN, padded rows get weight 0 in the loss
+    if not torch.is_tensor(x) or x.dim() == 0 or x.shape[0] == size:
+        return x
+    idx = torch.arange(size, device=x.device) % x.shape[0]
+    return x.index_select(0, idx)
+
+
+def compile_available():
+    return hasattr(torch, "compile")
+
+
+def is_compiling():
+    # True while torch.compile traces, for skipping data dependent checks
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and getattr(compiler, "is_compiling", bool)()
+
+
+def is_traced(x):
+    # True if x is traced by torch.compile or wrapped by a torch.func transform
+    # (vmap, grad), where a data dependent branch on x cannot run
+    if is_compiling():
+        return True
+    functorch = getattr(torch._C, "_functorch", None)
+    return functorch is not None and functorch.is_functorch_wrapped_tensor(x)
+
+
+class CompiledUpdate:
+    def __init__(
+        self,
+        loss_fn,
+        optimizer=None,
+        parameters=None,
+        clip_grad=None,
+        compile=False,
+        buckets=None,
+        mode=None,
+        amp_dtype=None,
+    ):
+        """
+        One optimizer step of an agent. loss_fn(weights, *tensors, **static)
+        is a pure function of tensors returning (loss, *outputs) with no
+        .item(), NumPy or data dependent branches. weights [B] is each row's
+        share of the batch mean (1 / B times any importance weight).
+
+        loss_fn: callable
+            Targets and losses, run eagerly or through torch.compile
+        optimizer: torch.optim.Optimizer
+            Stepped after loss.backward(), None to only evaluate loss_fn
+        parameters: list
+            Parameters clipped to clip_grad before the step
+        compile: bool
+            Compile loss_fn and the optimizer step. Falls back to eager with
+            a warning if torch.compile is missing or fails.
+        buckets: list
+            Sorted row counts to pad batches to, powers of two if None
+        mode: str
+            torch.compile mode
+        amp_dtype: torch.dtype
+            Runs loss_fn under torch.autocast with this dtype, e.g.
+            torch.bfloat16. Backward and the optimizer step stay fp32.
+        """
+        self.loss_fn = loss_fn
+        self.optimizer = optimizer
+        self.parameters = parameters
+        self.clip_grad = clip_grad
+        self.buckets = buckets
+        self.amp_dtype = amp_dtype
+        self.compiled_loss = None
+        self.compiled_step = None
+        if compile and compile_available():
+            self.compiled_loss = torch.compile(loss_fn, mode=mode, dynamic=False)
+            if optimizer is not None:
+                self.compiled_step = torch.compile(
+                    optimizer.step, mode=mode, dynamic=False
+                )
+
+    def _fallback(self, e):
+        warnings.warn(f"torch.compile failed, using the eager update: {e}")
+        self.compiled_loss = None
+        self.compiled_step = None
+
+    def _loss(self, weights, tensors, static):
+        with autocast(weights.device, self.amp_dtype):
+            return self._forward(weights, tensors, static)
+
+    def _forward(self, weights, tensors, static):
+        n = weights.shape[0]
+        if self.compiled_loss is not None:
+            size = bucket_rows(n, self.buckets)
+            padded = [pad_rows(x, size) for x in tensors]
+            w = torch.cat([weights, weights.new_zeros(size - n)])
+            try:
+                return self.compiled_loss(w, *padded, **static), size
+            except Exception as e:
+                self._fallback(e)
+        return self.loss_fn(weights, *tensors, **static), n
+
+    def _step(self):
+        if self.compiled_step is not None:
+            # a float lr is a constant of the compiled step, so an annealed lr
+            # would recompile it every update
+            groups = self.optimizer.param_groups
+            lrs = [g["lr"] for g in groups]
+            for g, lr in zip(groups, lrs):
+                g["lr"] = torch.tensor(float(lr))
+            try:
+                self.compiled_step()
+                return
+            except Exception as e:
+                self._fallback(e)
+            finally:
+                for g, lr in zip(groups, lrs):
+                    g["lr"] = lr
+        self.optimizer.step()
+
+    def __call__(self, weights, *tensors, **static):
+        """
+        Runs loss_fn, backward and the optimizer step. Returns the outputs of
+        loss_fn with per-row outputs cut back to the real rows.
+        """
+        n = weights.shape[0]
+        outputs, size = self._loss(weights, tensors, static)
+        if self.optimizer is not None:
+            self.optimizer.zero_grad()
+            outputs[0].backward()
+            if self.clip_grad is not None and self.clip_grad > 0:
+                torch.nn.utils.clip_grad_norm_(
+                    self.parameters,
+                    self.clip_grad,
+                    error_if_nonfinite=True,
+                    foreach=True,
+                )
+            self._step()
+        return tuple(
+            (x[:n] if torch.is_tensor(x) and x.dim() > 0 and x.shape[0] == size else x)
+            for x in outputs
+        )
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import numpy as np
+    import torch._inductor.config as inductor_config
+    from flexibuddiesrl.Buffer import ReplayBuffer
+    from flexibuddiesrl.DQN import DQN
+    from flexibuddiesrl.TD3 import TD3
+    from flexibuddiesrl.DDPG import DDPG
+    from flexibuddiesrl.PG import PG
+    from flexibuddiesrl.Runner import VectorRunner
+    from flexibuddiesrl.Envs import BatchCartPole
+
+    # compiled kernels draw the same random numbers as eager ones
+    inductor_config.fallback_random = True
+    np.random.seed(0)
+    lo = np.array([-2.0], dtype=np.float32)
+    hi = np.array([2.0], dtype=np.float32)
+    n = 2000
+    rb = ReplayBuffer(n, 7, discrete_action_dims=[3], continuous_action_dim=1)
+    rb.add(
+        obs=np.random.rand(n, 7),
+        obs_=np.random.rand(n, 7),
+        discrete_actions=np.random.randint(0, 3, (n, 1)),
+        continuous_actions=np.random.uniform(-2, 2, (n, 1)),
+        discrete_log_probs=np.log(np.full((n, 1), 1 / 3)),
+        continuous_log_probs=np.random.uniform(-2, 0, (n, 1)),
+        global_rewards=np.random.rand(n),
+        terminated=np.random.rand(n) < 0.05,
+    )
+    agents = {
+        "DQN": lambda: DQN(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dims=1,
+            min_actions=lo,
+            max_actions=hi,
+            dueling=True,
+            hidden_dims=[256, 256],
+        ),
+        "TD3": lambda: TD3(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dim=1,
+            min_actions=lo,
+            max_actions=hi,
+            policy_frequency=1,
+            rand_steps=0,
+            # the smoothing noise is drawn after the target gumbel noise of
+            # every padded row, so compiled and eager would smooth differently
+            action_noise=0.0,
+        ),
+        "DDPG": lambda: DDPG(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dim=1,
+            min_actions=lo,
+            max_actions=hi,
+            rand_steps=0,
+        ),
+        "PG": lambda: PG(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dim=1,
+            min_actions=lo,
+            max_actions=hi,
+            mini_batch_size=64,
+            n_epochs=2,
+        ),
+    }
+    # python -m flexibuddiesrl.Compile [compile | bf16]
+    check = sys.argv[1] if len(sys.argv) > 1 else "compile"
+
+    def copy_agent(dst, src):
+        # same weights, targets and optimizer state, copied in place so the
+        # compiled steps keep the tensors they were traced with
+        if isinstance(src, torch.nn.Module):
+            modules = [(dst, src)]
+        else:
+            modules = [
+                (getattr(dst, k), m)
+                for k, m in vars(src).items()
+                if isinstance(m, torch.nn.Module)
+            ]
+        with torch.no_grad():
+            for md, ms in modules:
+                for d, s in zip(md.state_dict().values(), ms.state_dict().values()):
+                    d.copy_(s)
+            for name, opt in vars(src).items():
+                if not isinstance(opt, torch.optim.Optimizer):
+                    continue
+                dst_opt = getattr(dst, name)
+                for gd, gs in zip(dst_opt.param_groups, opt.param_groups):
+                    for pd, ps in zip(gd["params"], gs["params"]):
+                        pd.copy_(ps)
+                        for k, v in opt.state[ps].items():
+                            dst_opt.state[pd][k].copy_(v)
+
+    if check == "compile":
+        for name, make in agents.items():
+            torch.manual_seed(0)
+            eager = make()
+            compiled = make()
+            compiled.compile_updates()
+            # 100, 120 and 77 all pad to 128 so every size reuses one graph
+            for step, bsize in enumerate([100, 120, 77, 256]):
+                batch = rb.sample_transitions(bsize)
+                # one update from identical weights and batch, so drift from
+                # earlier steps does not add up
+                copy_agent(compiled, eager)
+                torch.manual_seed(step)
+                e = eager.reinforcement_learn(batch)
+                torch.manual_seed(step)
+                c = compiled.reinforcement_learn(batch)
+                print(f"{name} rows: {bsize} eager: {e} compiled: {c}")
+                assert np.allclose(e, c, rtol=1e-4, atol=1e-6), "loss mismatch"
+
+            batch = rb.sample_transitions(256)
+            for agent, label in [(eager, "eager"), (compiled, "compiled")]:
+                start = time.time()
+                for _ in range(50):
+                    agent.reinforcement_learn(batch)
+                print(f"{name} {label} updates/sec: {50 / (time.time() - start):.1f}")
+
+    if check == "bf16":
+        # update and acting throughput of the 256 wide MLPs
+        for rows in [256, 2048]:
+            batch = rb.sample_transitions(rows)
+            obs = torch.rand(rows, 7)
+            for name, make in agents.items():
+                torch.manual_seed(0)
+                agent = make()
+                for dtype in [None, torch.bfloat16]:
+                    agent.mixed_precision(dtype)
+                    start = time.time()
+                    for _ in range(20):
+                        agent.reinforcement_learn(batch)
+                    updates = 20 / (time.time() - start)
+                    start = time.time()
+                    for _ in range(50):
+                        agent.train_actions(obs)
+                    actions = 50 * rows / (time.time() - start)
+                    print(
+                        f"{name} rows: {rows} {dtype or torch.float32} updates/sec: {updates:.1f} actions/sec: {actions:.0f}"
+                    )
+
+        # learning curves from the same seed should agree within noise
+        curves = []
+        for dtype in [None, torch.bfloat16]:
+            torch.manual_seed(0)
+            np.random.seed(0)
+            agent = DQN(
+                obs_dim=4,
+                discrete_action_dims=[2],
+                continuous_action_dims=0,
+                dueling=True,
+                hidden_dims=[256, 256],
+            )
+            agent.mixed_precision(dtype)
+            stats = VectorRunner(
+                agent,
+                env=BatchCartPole(16, seed=0),
+                learning_starts=1000,
+                batch_size=128,
+                seed=0,
+                log_interval=0,
+            ).run(40000)
+            curve = [
+                float(np.mean(r)) for r in np.array_split(stats["episode_returns"], 5)
+            ]
+            print(f"DQN BatchCartPole {dtype or torch.float32} returns: {curve}")
+            curves.append(curve)
+        # final returns within a quarter of the fp32 run's, cartpole caps at 500
+        fp32, bf16 = curves[0][-1], curves[1][-1]
+        assert np.isclose(bf16, fp32, rtol=0.25, atol=25), "bf16 returns diverged"
@@ -1,8 +1,14 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
-from flexibuddiesrl.Agent import Agent, MixedActor, ValueSA
-from flexibuddiesrl.Util import T, get_multi_discrete_one_hot
+from flexibuddiesrl.Agent import Agent, MixedActor, ValueSA, AttentionCritic
+from flexibuddiesrl.Util import (
+    T,
+    get_multi_discrete_one_hot,
+    team_actions,
+    policy_team_actions,
+    upcast_batch,
+)
 from flexibuff import FlexiBatch
 import os
 import pickle
@@ -26,6 +32,8 @@ class DDPG(Agent):
         eval_mode=False,
         gumbel_tau=0.5,
         rand_steps=10000,
+        centralized_critic=False,
+        critic_heads=4,
     ):
         # documentation
         """
@@ -51,6 +59,11 @@ class DDPG(Agent):
         name: str
             The name of the agent
         device: str
+        centralized_critic: bool
+            Use an AttentionCritic over every agent's obs and action instead
+            of a ValueSA on this agent's own. Agents share action spaces.
+        critic_heads: int
+            Attention heads of the centralized critic
         """
         assert not (
             continuous_action_dim is None and discrete_action_dims is None
@@ -60,8 +73,8 @@ class DDPG(Agent):
             and len(min_actions) == continuous_action_dim
         ), "max_actions should be provided for each contin action dim"
 
-        self.total_action_dim = continuous_action_dim + np.sum(
-            np.array(discrete_action_dims)
+        self.total_action_dim = continuous_action_dim + int(
+            np.sum(np.array(discrete_action_dims))
         )
         self.target_update_percentage = target_update_percentage
         self.rand_steps = rand_steps
@@ -103,12 +116,29 @@ class DDPG(Agent):
         self.actor_target.to(device)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters())
 
-        self.critic = ValueSA(
-            obs_dim, self.total_action_dim, hidden_dim=256, device=device
-        )
-        self.critic_target = ValueSA(
-            obs_dim, self.total_action_dim, hidden_dim=256, device=device
-        )
+        self.centralized_critic = centralized_critic
+        if centralized_critic:
+            self.critic = AttentionCritic(
+                obs_dim,
+                self.total_action_dim,
+                hidden_dims=hidden_dims,
+                n_heads=critic_heads,
+                device=device,
+            )
+            self.critic_target = AttentionCritic(
+                obs_dim,
+                self.total_action_dim,
+                hidden_dims=hidden_dims,
+                n_heads=critic_heads,
+                device=device,
+            )
+        else:
+            self.critic = ValueSA(
+                obs_dim, self.total_action_dim, hidden_dim=256, device=device
+            )
+            self.critic_target = ValueSA(
+                obs_dim, self.total_action_dim, hidden_dim=256, device=device
+            )
         self.critic_target.load_state_dict(self.critic.state_dict())
         self.critic.to(device)
         self.critic_target.to(device)
@@ -116,6 +146,15 @@ class DDPG(Agent):
 
         self.device = device
 
+    def _q(
+        self, critic, obs, u, team_obs=None, team_u=None, agent_mask=None, agent_num=0
+    ):
+        # Q of agent_num taking u, attending over the rest of team_u if the
+        # critic is centralized and the team's obs are given
+        if team_obs is None:
+            return critic(obs, u).squeeze(-1)
+        return critic.agent_value(team_obs, agent_num, team_u, u, agent_mask)
+
     def __noise__(self, continuous_actions: torch.Tensor):
         noise = torch.normal(
             0,
@@ -126,29 +165,35 @@ class DDPG(Agent):
             noise = noise.squeeze(0)
         return noise
 
-    def _get_random_actions(self, action_mask=None, debug=False):
-
+    def _get_random_actions(self, action_mask=None, debug=False, n=None):
+        # n random actions for a batch of n observations, one action if None
+        lead = () if n is None else (n,)
         continuous_actions = (
-            torch.rand(size=(self.continuous_action_dim,), device=self.device) * 2 - 1
+            torch.rand(size=lead + (self.continuous_action_dim,), device=self.device)
+            * 2
+            - 1
         ) * self.actor.action_scales - self.actor.action_biases
         discrete_actions = torch.zeros(
-            (len(self.discrete_action_dims)),
+            lead + (len(self.discrete_action_dims),),
             device=self.device,
-            dtype=torch.long,  # used to be (1,len...) but I think this is not needed
+            dtype=torch.long,
         )
         for dim, dim_size in enumerate(self.discrete_action_dims):
-            discrete_actions[dim] = torch.randint(dim_size, (1,))
+            discrete_actions[..., dim] = torch.randint(
+                dim_size, lead if n is not None else (1,), device=self.device
+            )
         return discrete_actions, continuous_actions
 
     def train_actions(self, observations, action_mask=None, step=False, debug=False):
         observations = T(observations, self.device, debug=debug)
         if debug:
             print("DDPG train_actions Observations: ", observations)
+        n_obs = observations.shape[0] if observations.dim() > 1 else None
         if step:
-            self.step += 1
+            self.step += 1 if n_obs is None else n_obs
         if self.step < self.rand_steps:
             discrete_actions, continuous_actions = self._get_random_actions(
-                action_mask, debug=debug
+                action_mask, debug=debug, n=n_obs
             )
             return (
                 discrete_actions.detach().cpu().numpy(),
@@ -157,7 +202,7 @@ class DDPG(Agent):
                 None,
                 None,
             )
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             continuous_actions, discrete_action_activations = self.actor(
                 x=observations, action_mask=action_mask, gumbel=True, debug=debug
             )
@@ -201,7 +246,7 @@ class DDPG(Agent):
             for i, activation in enumerate(discrete_action_activations):
                 if debug:
                     print("DDPG train_actions activation: ", activation)
-                discrete_actions[i] = torch.argmax(activation, dim=-1)
+                discrete_actions[..., i] = torch.argmax(activation, dim=-1)
 
             if debug:
                 print(
@@ -225,41 +270,19 @@ class DDPG(Agent):
         aloss_item = 0
         closs_item = 0
         self.rl_step += 1
-        with torch.no_grad():
-            if batch.action_mask is not None:
-                mask = batch.action_mask[agent_num]
-                mask_ = batch.action_mask_[agent_num]
-            else:
-                mask = 1.0
-                mask_ = 1.0
-            continuous_actions_, discrete_action_activations_ = self.actor_target(
-                batch.obs_[agent_num], mask_, gumbel=True
-            )
+        batch = upcast_batch(batch)
+        mask = None
+        mask_ = None
+        if batch.action_mask is not None:
+            mask = batch.action_mask[agent_num]
+            mask_ = batch.action_mask_[agent_num]
+        team_obs, team_obs_, team_u, agent_mask = None, None, None, None
+        if self.centralized_critic:
+            team_obs, team_obs_ = batch.obs, batch.obs_
+            team_u = team_actions(batch, self.discrete_action_dims)
+            agent_mask = getattr(batch, "agent_mask", None)
 
-            if len(discrete_action_activations_) == 1:
-                daa_ = discrete_action_activations_[0]
-            else:
-                daa_ = torch.cat(discrete_action_activations_, dim=-1)
-
-            if debug:
-                print(
-                    "DDPG reinforcement_learn continuous_actions_: ",
-                    continuous_actions_,
-                )
-                print(
-                    "DDPG reinforcement_learn discrete_action_activations_: ",
-                    discrete_action_activations_,
-                )
-                print("DDPG reinforcement_learn daa: ", daa_)
-                # input()
-            actions_ = torch.cat([continuous_actions_, daa_], dim=-1)
-            qtarget = self.critic_target(batch.obs_[agent_num], actions_).squeeze(-1)
-            # TODO configure reward channel beyong just global_rewards
-            next_q_value = (
-                batch.global_rewards + (1 - batch.terminated) * self.gamma * qtarget
-            )
         # for each discrete action, get the one hot coding and concatinate them
-
         actions = torch.cat(
             [
                 batch.continuous_actions[agent_num],
@@ -271,52 +294,114 @@ class DDPG(Agent):
             ],
             dim=-1,
         )
-        q_values = self.critic(batch.obs[agent_num], actions).squeeze(-1)
-        qf1_loss = F.mse_loss(q_values, next_q_value)
+        bsize = batch.global_rewards.shape[0]
+        weights = torch.full((bsize,), 1.0 / bsize, device=self.device)
 
         # optimize the critic
-        self.critic_optimizer.zero_grad()
-        qf1_loss.backward()
-        self.critic_optimizer.step()
-        closs_item = qf1_loss.item()
+        critic_update = self._update("critic", self._critic_loss, self.critic_optimizer)
+        qf1_loss, q_values = critic_update(
+            weights,
+            batch.obs[agent_num],
+            batch.obs_[agent_num],
+            mask_,
+            actions,
+            batch.global_rewards,
+            batch.terminated,
+            team_obs,
+            team_obs_,
+            team_u,
+            agent_mask,
+            agent_num=agent_num,
+        )
+        if debug:
+            print("DDPG reinforcement_learn q_values: ", q_values)
+        closs_item = self._loss_item(qf1_loss)
 
         if self.rl_step % self.policy_frequency == 0 and not critic_only:
-            c_act, d_act = self.actor(
-                x=batch.obs[agent_num], action_mask=mask, gumbel=True
+            actor_update = self._update("actor", self._actor_loss, self.actor_optimizer)
+            (actor_loss,) = actor_update(
+                weights,
+                batch.obs[agent_num],
+                mask,
+                team_obs,
+                team_u,
+                agent_mask,
+                agent_num=agent_num,
             )
-            # print(c_act.shape)
-            # print(f"dact shape: [{len(d_act)}],{d_act[0].shape}")
-            # TODO Check and make sure that the discrete actions are concatenated correctly
-            if len(d_act) == 1:
-                d_act = d_act[0]
-            else:
-                d_act = torch.cat(d_act, dim=-1)
-            actor_loss = -self.critic(
-                x=batch.obs[agent_num], u=torch.cat([c_act, d_act], dim=-1)
-            ).mean()
-            # print(torch.cat([c_act, d_act], dim=-1).shape)
-            self.actor_optimizer.zero_grad()
-            actor_loss.backward()
-            self.actor_optimizer.step()
 
             # update the target network
-            for param, target_param in zip(
-                self.actor.parameters(), self.actor_target.parameters()
-            ):
-                target_param.data.copy_(
-                    self.target_update_percentage * param.data
-                    + (1 - self.target_update_percentage) * target_param.data
-                )
-            for param, target_param in zip(
-                self.critic.parameters(), self.critic_target.parameters()
-            ):
-                target_param.data.copy_(
-                    self.target_update_percentage * param.data
-                    + (1 - self.target_update_percentage) * target_param.data
-                )
-            aloss_item = actor_loss.item()
+            self.polyak_update(self.target_update_percentage)
+            aloss_item = self._loss_item(actor_loss)
         return aloss_item, closs_item
 
+    def _critic_loss(
+        self,
+        weights,
+        obs,
+        obs_,
+        mask_,
+        actions,
+        rewards,
+        terminated,
+        team_obs=None,
+        team_obs_=None,
+        team_u=None,
+        agent_mask=None,
+        agent_num=0,
+    ):
+        """
+        Critic TD loss as a pure function of tensors for
+        Compile.CompiledUpdate. Returns (loss, Q [B]).
+        """
+        with torch.no_grad():
+            continuous_actions_, discrete_action_activations_ = self.actor_target(
+                obs_, mask_, gumbel=True
+            )
+            if len(discrete_action_activations_) == 1:
+                daa_ = discrete_action_activations_[0]
+            else:
+                daa_ = torch.cat(discrete_action_activations_, dim=-1)
+            actions_ = torch.cat([continuous_actions_, daa_], dim=-1)
+            team_u_ = None
+            if team_obs_ is not None:
+                team_u_ = policy_team_actions(self.actor_target, team_obs_)
+            qtarget = self._q(
+                self.critic_target,
+                obs_,
+                actions_,
+                team_obs_,
+                team_u_,
+                agent_mask,
+                agent_num,
+            )
+            # TODO configure reward channel beyong just global_rewards
+            next_q_value = rewards + (1 - terminated) * self.gamma * qtarget
+        q_values = self._q(
+            self.critic, obs, actions, team_obs, team_u, agent_mask, agent_num
+        )
+        loss = (weights * (q_values - next_q_value) ** 2).sum()
+        return loss, q_values.detach()
+
+    def _actor_loss(
+        self,
+        weights,
+        obs,
+        mask,
+        team_obs=None,
+        team_u=None,
+        agent_mask=None,
+        agent_num=0,
+    ):
+        # Deterministic policy gradient through the gumbel relaxed actions
+        c_act, d_act = self.actor(x=obs, action_mask=mask, gumbel=True)
+        if len(d_act) == 1:
+            d_act = d_act[0]
+        else:
+            d_act = torch.cat(d_act, dim=-1)
+        u = torch.cat([c_act, d_act], dim=-1)
+        q = self._q(self.critic, obs, u, team_obs, team_u, agent_mask, agent_num)
+        return ((-weights * q).sum(),)
+
     def ego_actions(self, observations, action_mask=None):
         with torch.no_grad():
             continuous_actions, discrete_action_activations = self.actor(
@@ -351,9 +436,41 @@ class DDPG(Agent):
 
         return loss
 
-    def utility_function(self, observations, actions=None):
-        return 0  # Returns the single-agent critic for a single action.
-        # If actions are none then V(s)
+    def polyak_update(self, tau=0.01):
+        for param, target_param in zip(
+            self.actor.parameters(), self.actor_target.parameters()
+        ):
+            target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+        for param, target_param in zip(
+            self.critic.parameters(), self.critic_target.parameters()
+        ):
+            target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+
+    def utility_function(self, observations, actions=None, target=False):
+        # Q(s,a) for the stored actions, or Q(s,pi(s)) if actions is None.
+        # target reads the actor and critic target networks
+        observations = T(observations, self.device)
+        actor = self.actor_target if target else self.actor
+        critic = self.critic_target if target else self.critic
+        if actions is None:
+            c_act, d_act = actor(x=observations, gumbel=False)
+            u = list(d_act) if d_act is not None else []
+            if self.continuous_action_dim > 0:
+                u = [c_act] + u
+        else:
+            u = []
+            if self.continuous_action_dim > 0:
+                u.append(actions[1])
+            if (
+                self.discrete_action_dims is not None
+                and len(self.discrete_action_dims) > 0
+            ):
+                u.append(
+                    get_multi_discrete_one_hot(
+                        actions[0], discrete_action_dims=self.discrete_action_dims
+                    )
+                )
+        return critic(observations, torch.cat(u, dim=-1)).squeeze(-1)
 
     def expected_V(self, obs, legal_action=None):
         qtot = 0
@@ -2,7 +2,8 @@ import numpy as np
 import torch.nn as nn
 import torch
 from torch.distributions import Categorical
-from flexibuddiesrl.Agent import QS
+from flexibuddiesrl.Agent import QS, Agent, RecurrentEncoder, keeps_hidden
+from flexibuddiesrl.Util import per_agent_mean, upcast_batch
 from flexibuff import FlexiBatch
 import os
 import pickle
@@ -16,7 +17,7 @@ class dqntype(Enum):
     Munchausen = 2
 
 
-class DQN(nn.Module):
+class DQN(nn.Module, Agent):
     def __init__(
         self,
         obs_dim=10,
@@ -40,6 +41,8 @@ class DQN(nn.Module):
         name="DQN",
         clip_grad=1.0,
         load_from_checkpoint_path=None,
+        recurrent=None,
+        rnn_hidden=64,
     ):
         super(DQN, self).__init__()
         self.clip_grad = clip_grad
@@ -86,21 +89,15 @@ class DQN(nn.Module):
         self.hidden_dims = hidden_dims
         self.activation = activation
         self.orthogonal = orthogonal
-        self.Q1 = QS(
-            obs_dim=obs_dim,
-            continuous_action_dim=continuous_action_dims,
-            discrete_action_dims=discrete_action_dims,
-            hidden_dims=hidden_dims,
-            activation=activation,
-            orthogonal=orthogonal,
-            dueling=dueling,
-            n_c_action_bins=n_c_action_bins,
-            device=device,
-        )
+        # "gru" or "lstm" puts a RecurrentEncoder under the Q heads. Train it
+        # on Buffer.sample_sequences batches so rows form ordered sequences.
+        self.recurrent = recurrent
+        self.rnn_hidden = rnn_hidden
+        self.device = device
+        self.Q1 = self._make_q()
 
         self.Q1.to(device)
 
-        self.device = device
         self.optimizer = torch.optim.Adam(self.Q1.parameters(), lr=lr)
         self.to(device)
 
@@ -123,8 +120,35 @@ class DQN(nn.Module):
             "eval_mode",
             "hidden_dims",
             "activation",
+            "recurrent",
+            "rnn_hidden",
         ]
 
+    def _make_q(self):
+        encoder = None
+        if getattr(self, "recurrent", None):
+            encoder = RecurrentEncoder(
+                self.obs_dim,
+                self.hidden_dims,
+                rnn_hidden=self.rnn_hidden,
+                cell=self.recurrent,
+                activation=self.activation,
+                device=self.device,
+                orthogonal_init=self.orthogonal,
+            )
+        return QS(
+            obs_dim=self.obs_dim,
+            continuous_action_dim=self.continuous_action_dims,
+            discrete_action_dims=self.discrete_action_dims,
+            hidden_dims=self.hidden_dims,
+            encoder=encoder,
+            activation=self.activation,
+            orthogonal=self.orthogonal,
+            dueling=self.dueling,
+            n_c_action_bins=self.n_c_action_bins,
+            device=self.device,
+        )
+
     def _cont_from_q(self, cont_act):
         return (
             torch.argmax(torch.stack(cont_act, dim=0), dim=-1)
@@ -171,7 +195,7 @@ class DQN(nn.Module):
                 ) * self.np_action_ranges + self.np_action_means
 
         else:
-            with torch.no_grad():
+            with torch.no_grad(), self._autocast():
                 value, disc_act, cont_act = self.Q1(observations, action_mask)
                 # select actions from q function
                 # print(value, disc_act, cont_act)
@@ -191,9 +215,59 @@ class DQN(nn.Module):
                     cont_act = self._cont_from_q(cont_act).cpu().numpy()
         return disc_act, cont_act
 
+    def _e_greedy_batch_action(self, observations, action_mask=None, debug=False):
+        # one eps draw per row so a vector env explores like n single envs
+        n = observations.shape[0]
+        if self.init_eps > 0.0:
+            self.eps = self.init_eps * (
+                1 - self.step / (self.step + self.eps_decay_half_life)
+            )
+        explore = np.random.rand(n) < self.eps if self.init_eps > 0.0 else None
+        disc_act, cont_act = None, None
+        with torch.no_grad(), self._autocast():
+            value, dq, cq = self.Q1(observations, action_mask)
+            if len(self.discrete_action_dims) > 0:
+                disc_act = (
+                    torch.stack([torch.argmax(d, dim=-1) for d in dq], dim=-1)
+                    .cpu()
+                    .numpy()
+                    .astype(np.int32)
+                )
+            if self.continuous_action_dims > 0:
+                cont_act = (
+                    (
+                        (
+                            torch.argmax(torch.stack(cq, dim=-2), dim=-1)
+                            / (self.n_c_action_bins - 1)
+                            - 0.5
+                        )
+                        * self.action_ranges
+                        + self.action_means
+                    )
+                    .cpu()
+                    .numpy()
+                )
+        if explore is not None and explore.any():
+            k = int(explore.sum())
+            if disc_act is not None:
+                disc_act[explore] = np.stack(
+                    [
+                        np.random.randint(0, d, size=k)
+                        for d in self.discrete_action_dims
+                    ],
+                    axis=-1,
+                )
+            if cont_act is not None:
+                cont_act[explore] = (
+                    np.random.rand(k, self.continuous_action_dims) - 0.5
+                ) * self.np_action_ranges + self.np_action_means
+        if debug:
+            print(f"  DQN batch actions explore: {explore}, eps: {self.eps}")
+        return disc_act, cont_act
+
     def _soft_train_action(self, observations, action_mask, step, debug):
         disc_act, cont_act = None, None
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             value, disc_act, cont_act = self.Q1(observations, action_mask)
             if len(self.discrete_action_dims) > 0:
                 dact = np.zeros(len(disc_act), dtype=np.int64)
@@ -221,6 +295,13 @@ class DQN(nn.Module):
         return disc_act, cont_act
 
     def train_actions(self, observations, action_mask=None, step=False, debug=False):
+        if len(observations.shape) > 1:
+            # [n_envs, obs_dim] from a vector env, counts as n_envs steps
+            disc_act, cont_act = self._e_greedy_batch_action(
+                observations, action_mask, debug
+            )
+            self.step += observations.shape[0] * int(step)
+            return disc_act, cont_act, 0, 0, 0
         disc_act, cont_act = self._e_greedy_train_action(
             observations, action_mask, step, debug
         )
@@ -240,10 +321,40 @@ class DQN(nn.Module):
     def imitation_learn(self, observations, actions):
         return 0  # loss
 
-    def utility_function(self, observations, actions=None):
-        return 0  # Returns the single-agent critic for a single action.
-        # If actions are none then V(s)
+    @keeps_hidden
+    def utility_function(self, observations, actions=None, target=False):
+        # Q(s,a) averaged over action heads, or max_a Q(s,a) if actions is None.
+        # There is no target network, target reads Q1 as well
+        values, disc_adv, cont_adv = self.Q1(observations)
+        qs = []
+        if self.discrete_action_dims is not None and len(self.discrete_action_dims) > 0:
+            for i in range(len(self.discrete_action_dims)):
+                if actions is None:
+                    q = torch.max(disc_adv[i], dim=-1).values
+                else:
+                    q = torch.gather(
+                        disc_adv[i],
+                        dim=-1,
+                        index=actions[0][..., i].long().unsqueeze(-1),
+                    ).squeeze(-1)
+                qs.append(q.unsqueeze(-1))
+        if self.continuous_action_dims is not None and self.continuous_action_dims > 0:
+            stacked = torch.stack(cont_adv, dim=-2)
+            if actions is None:
+                q = torch.max(stacked, dim=-1).values
+            else:
+                q = torch.gather(
+                    stacked,
+                    dim=-1,
+                    index=self._discretize_actions(actions[1]).unsqueeze(-1),
+                ).squeeze(-1)
+            qs.append(q)
+        q = torch.cat(qs, dim=-1).mean(dim=-1)
+        if self.dueling:
+            q = q + values.squeeze(-1)
+        return q
 
+    @keeps_hidden
     def expected_V(self, obs, legal_action=None, debug=False):
         with torch.no_grad():
             value, dac, cac = self.Q1(obs, legal_action)
@@ -309,14 +420,85 @@ class DQN(nn.Module):
     ):
         if self.eval_mode:
             return 0, 0
+        batch = upcast_batch(batch)
         if debug:
             print("\nDoing Reinforcement learn \n")
-        dqloss = 0
-        cqloss = 0
+        if self.recurrent:
+            self.set_recurrent_context(batch, agent_num)
+        bsize = batch.global_rewards.shape[0]
+        # importance weights from a PrioritizedReplayBuffer batch
+        is_weights = getattr(batch, "is_weights", None)
+        weights = torch.full((bsize,), 1.0 / bsize, device=self.device)
+        if is_weights is not None:
+            weights = weights * is_weights
+        discrete_actions = None
+        if self.discrete_action_dims is not None and len(self.discrete_action_dims) > 0:
+            discrete_actions = batch.discrete_actions[agent_num]
+        continuous_actions = None
+        if self.continuous_action_dims is not None and self.continuous_action_dims > 0:
+            continuous_actions = batch.continuous_actions[agent_num]
+        update = self._update(
+            "q",
+            self._td_loss,
+            self.optimizer,
+            list(self.parameters()),
+            self.clip_grad,
+        )
+        _, dqloss, cqloss, dq_samples, cq_samples = update(
+            weights,
+            batch.obs[agent_num],
+            batch.obs_[agent_num],
+            discrete_actions,
+            continuous_actions,
+            batch.global_rewards,
+            batch.terminated,
+        )
+        if self.recurrent:
+            self.clear_recurrent_context()
+        if self.dqn_type == dqntype.Soft and torch.isnan(dq_samples).any():
+            print("NAN in dqloss")
+            print(dq_samples)
+        if debug:
+            print(f"dq samples: {dq_samples}, cq samples: {cq_samples}")
+        with torch.no_grad():
+            # per-sample |td error| for PrioritizedReplayBuffer.update_priorities
+            self.td_errors = (
+                dq_samples.clamp(min=0).sqrt() + cq_samples.clamp(min=0).sqrt()
+            )
+
+        if getattr(batch, "agent_ids", None) is not None:
+            self.agent_losses = (
+                per_agent_mean(dq_samples, batch.agent_ids, batch.n_agents),
+                per_agent_mean(cq_samples, batch.agent_ids, batch.n_agents),
+            )
+        # actor loss, critic loss
+        return self._loss_item(dqloss), self._loss_item(cqloss)
+
+    def _td_loss(
+        self,
+        weights,
+        obs,
+        obs_,
+        discrete_actions,
+        continuous_actions,
+        rewards,
+        terminated,
+    ):
+        """
+        The Q learning loss as a pure function of tensors for
+        Compile.CompiledUpdate. weights [B] is each row's share of the mean.
+        Returns (loss, dqloss, cqloss, dq_samples, cq_samples) where the
+        samples are the per-row squared errors averaged over heads.
+        """
+        dqloss = torch.zeros((), device=weights.device)
+        cqloss = torch.zeros((), device=weights.device)
+        dq_samples = torch.zeros_like(rewards)
+        cq_samples = torch.zeros_like(rewards)
+        not_done = self.gamma * (1 - terminated)
         with torch.no_grad():
             dQ_ = 0
             cQ_ = 0
-            next_values, next_disc_adv, next_cont_adv = self.Q1(batch.obs_[agent_num])
+            next_values, next_disc_adv, next_cont_adv = self.Q1(obs_)
             dnv_ = 0
             cnv_ = 0
             if self.dueling:
@@ -326,37 +508,26 @@ class DQN(nn.Module):
                     .unsqueeze(-1)
                     .expand(-1, -1, self.n_c_action_bins)
                 )
-            if debug:
-                print(
-                    f"next vals: {next_values}, next_disct_adv: {next_disc_adv}, next_cont_adv: {next_cont_adv}"
-                )
-                # print(f"stacked: {torch.stack(next_cont_adv, dim=1)}")
-                # input()
-
-            if (
-                self.discrete_action_dims is not None
-                and len(self.discrete_action_dims) > 0
-            ):
-                dQ_ = torch.zeros(
-                    (batch.global_rewards.shape[0], len(self.discrete_action_dims)),
-                    dtype=torch.float32,
-                ).to(self.device)
-                for i in range(len(self.discrete_action_dims)):
-                    if self.dqn_type == dqntype.EGreedy:
-                        dQ_[:, i] = torch.max(
-                            next_disc_adv[i], dim=-1
-                        ).values + dnv_.squeeze(-1)
-                    elif self.dqn_type == dqntype.Soft:
-                        dQ_[:, i] = torch.sum(
-                            torch.softmax(next_disc_adv[i], dim=-1)
-                            * (next_disc_adv[i] + dnv_),
-                            dim=-1,
-                        )
 
-            if (
-                self.continuous_action_dims is not None
-                and self.continuous_action_dims > 0
-            ):
+            if discrete_actions is not None:
+                if self.dqn_type == dqntype.EGreedy:
+                    dQ_ = torch.stack(
+                        [
+                            torch.max(h, dim=-1).values + dnv_.squeeze(-1)
+                            for h in next_disc_adv
+                        ],
+                        dim=-1,
+                    )
+                elif self.dqn_type == dqntype.Soft:
+                    dQ_ = torch.stack(
+                        [
+                            torch.sum(torch.softmax(h, dim=-1) * (h + dnv_), dim=-1)
+                            for h in next_disc_adv
+                        ],
+                        dim=-1,
+                    )
+
+            if continuous_actions is not None:
                 if self.dqn_type == dqntype.EGreedy:
                     cQ_ = torch.max(
                         (
@@ -370,68 +541,48 @@ class DQN(nn.Module):
                     next_probs = torch.softmax(scq, dim=-1)
                     cQ_ = torch.sum(next_probs * (scq + cnv_), dim=-1)
 
-        values, disc_adv, cont_adv = self.Q1(batch.obs[agent_num])
+        values, disc_adv, cont_adv = self.Q1(obs)
         dnv = 0
         cnv = 0
         if self.dueling:
             dnv = values.squeeze(-1)
             cnv = values.expand(-1, self.continuous_action_dims).unsqueeze(-1)
 
-        if self.discrete_action_dims is not None and len(self.discrete_action_dims) > 0:
-            dQ = torch.zeros(
-                (batch.global_rewards.shape[0], len(self.discrete_action_dims)),
-                dtype=torch.float32,
-            ).to(self.device)
-
-            for i in range(len(self.discrete_action_dims)):
-                dQ[:, i] = (
+        if discrete_actions is not None:
+            dQ = torch.stack(
+                [
                     torch.gather(
                         disc_adv[i],
                         dim=-1,
-                        index=batch.discrete_actions[agent_num, :, i].unsqueeze(-1),
+                        index=discrete_actions[:, i].unsqueeze(-1),
                     ).squeeze(-1)
                     + dnv
-                )
+                    for i in range(len(self.discrete_action_dims))
+                ],
+                dim=-1,
+            )
 
             if self.dqn_type == dqntype.EGreedy:
-                dqloss = (
-                    dQ
-                    - batch.global_rewards.unsqueeze(-1)
-                    - (self.gamma * (1 - batch.terminated)).unsqueeze(-1) * dQ_
-                ) ** 2
+                dq = (dQ - rewards.unsqueeze(-1) - not_done.unsqueeze(-1) * dQ_) ** 2
 
             elif self.dqn_type == dqntype.Soft:
-                dqloss = (
-                    dQ
-                    - batch.global_rewards.unsqueeze(-1)
-                    - (self.gamma * (1 - batch.terminated)).unsqueeze(-1) * dQ_
-                ) ** 2
-                for h in range(len(disc_adv)):
-                    probs = torch.softmax(disc_adv[h], dim=-1)
-                    enloss = (
-                        Categorical(probs=probs).entropy()
-                        * 0.1
-                        * self.entropy_loss_coef
-                    )
-                    # print(dqloss[:, h].shape, enloss.shape)
-                    if torch.isnan(enloss).any():
-                        print("NAN in entropy")
-                        print(probs)
-                        print(enloss)
-                    if torch.isnan(dqloss).any():
-                        print("NAN in dqloss")
-                        print(dqloss)
-                    dqloss[:, h] -= enloss
+                dq = (dQ - rewards.unsqueeze(-1) - not_done.unsqueeze(-1) * dQ_) ** 2
+                enloss = torch.stack(
+                    [
+                        Categorical(probs=torch.softmax(h, dim=-1)).entropy()
+                        for h in disc_adv
+                    ],
+                    dim=-1,
+                )
+                dq = dq - enloss * 0.1 * self.entropy_loss_coef
             else:
-                dqloss = 0
+                dq = 0
                 for h in range(len(disc_adv)):
                     with torch.no_grad():
                         next_probs = torch.softmax(next_disc_adv[h], dim=-1)
                         lnprobs = torch.log(
                             torch.softmax(disc_adv[h], dim=-1).gather(
-                                index=batch.discrete_actions[agent_num, :, h].unsqueeze(
-                                    -1
-                                ),
+                                index=discrete_actions[:, h].unsqueeze(-1),
                                 dim=-1,
                             )
                         ).squeeze(-1)
@@ -443,48 +594,36 @@ class DQN(nn.Module):
                             ),
                             dim=-1,
                         )
-                    dqloss += (
-                        dQ[:, h]
-                        - batch.global_rewards
-                        - (self.munchausen * self.entropy_loss_coef * lnprobs)
-                        - (self.gamma * (1 - batch.terminated)) * dQ_
-                    ) ** 2
-            dqloss = dqloss.mean()
+                    dq = (
+                        dq
+                        + (
+                            dQ[:, h]
+                            - rewards
+                            - (self.munchausen * self.entropy_loss_coef * lnprobs)
+                            - not_done * dQ_
+                        )
+                        ** 2
+                    )
+            dq_samples = self._sample_mean(dq)
+            dqloss = (weights * dq_samples).sum()
 
-        if self.continuous_action_dims is not None and self.continuous_action_dims > 0:
+        if continuous_actions is not None:
             cQ = (
                 torch.gather(
                     torch.stack(cont_adv, dim=1),
                     dim=-1,
-                    index=self._discretize_actions(
-                        batch.continuous_actions[agent_num]
-                    ).unsqueeze(-1),
+                    index=self._discretize_actions(continuous_actions).unsqueeze(-1),
                 )
                 + (cnv if self.dueling else 0)
             ).squeeze(-1)
 
             if self.dqn_type == dqntype.EGreedy:
-                cqloss = (
-                    cQ
-                    - (
-                        batch.global_rewards.unsqueeze(-1)
-                        + (self.gamma * (1 - batch.terminated)).unsqueeze(-1) * cQ_
-                    )
-                ) ** 2
+                cq = (cQ - (rewards.unsqueeze(-1) + not_done.unsqueeze(-1) * cQ_)) ** 2
             elif self.dqn_type == dqntype.Soft:
-                cqloss = (
-                    cQ
-                    - (
-                        batch.global_rewards.unsqueeze(-1)
-                        + (self.gamma * (1 - batch.terminated)).unsqueeze(-1) * cQ_
-                    )
-                ) ** 2
+                cq = (cQ - (rewards.unsqueeze(-1) + not_done.unsqueeze(-1) * cQ_)) ** 2
                 cprob = torch.softmax(torch.stack(cont_adv, dim=1), dim=-1)
-                cqloss -= (
-                    Categorical(probs=cprob).entropy() * self.entropy_loss_coef
-                )  # torch.sum(cprob * torch.log(cprob), dim=-1)
+                cq = cq - Categorical(probs=cprob).entropy() * self.entropy_loss_coef
             else:
-                cqloss = 0
                 with torch.no_grad():
                     stacknc = torch.stack(next_cont_adv, dim=1)
                     next_probs = torch.softmax(stacknc, dim=-1)
@@ -492,7 +631,7 @@ class DQN(nn.Module):
                         torch.softmax(torch.stack(cont_adv, dim=1), dim=-1)
                         .gather(
                             index=self._discretize_actions(
-                                batch.continuous_actions[agent_num]
+                                continuous_actions
                             ).unsqueeze(-1),
                             dim=-1,
                         )
@@ -506,29 +645,34 @@ class DQN(nn.Module):
                         ),
                         dim=-1,
                     )
-                cqloss = (
+                cq = (
                     cQ
-                    - batch.global_rewards.unsqueeze(-1)
+                    - rewards.unsqueeze(-1)
                     - (self.munchausen * self.entropy_loss_coef * lnprobs)
-                    - (self.gamma * (1 - batch.terminated).unsqueeze(-1)) * cQ_
+                    - not_done.unsqueeze(-1) * cQ_
                 ) ** 2
-            cqloss = cqloss.mean()
-        loss = dqloss + cqloss
-        self.optimizer.zero_grad()
-        loss.backward()
-        if self.clip_grad is not None and self.clip_grad > 0:
-            torch.nn.utils.clip_grad_norm_(
-                self.parameters(),
-                self.clip_grad,
-                error_if_nonfinite=True,
-                foreach=True,
-            )
-        self.optimizer.step()
-
+            cq_samples = self._sample_mean(cq)
+            cqloss = (weights * cq_samples).sum()
+        # leave the constant zero loss of a missing head out of the total,
+        # inductor folds x + 0 into x and the compiled total loses its grad
+        # when x.detach() is returned alongside it
+        if continuous_actions is None:
+            loss = dqloss
+        elif discrete_actions is None:
+            loss = cqloss
+        else:
+            loss = dqloss + cqloss
         return (
-            dqloss.item() if torch.is_tensor(dqloss) else dqloss,
-            cqloss.item() if torch.is_tensor(cqloss) else cqloss,
-        )  # actor loss, critic loss
+            loss,
+            dqloss.detach(),
+            cqloss.detach(),
+            dq_samples.detach(),
+            cq_samples.detach(),
+        )
+
+    def _sample_mean(self, samples):
+        # squared errors are [B] or [B, heads]
+        return samples.mean(dim=-1) if samples.dim() > 1 else samples
 
     def _dump_attr(self, attr, path):
         f = open(path, "wb")
@@ -575,17 +719,7 @@ class DQN(nn.Module):
             self.np_action_means = (self.max_actions + self.min_actions) / 2
             self.action_means = torch.from_numpy(self.np_action_means).to(self.device)
 
-        self.Q1 = QS(
-            obs_dim=self.obs_dim,
-            continuous_action_dim=self.continuous_action_dims,
-            discrete_action_dims=self.discrete_action_dims,
-            hidden_dims=self.hidden_dims,
-            activation=self.activation,
-            orthogonal=self.orthogonal,
-            dueling=self.dueling,
-            n_c_action_bins=self.n_c_action_bins,
-            device=self.device,
-        )
+        self.Q1 = self._make_q()
         self.Q1.load_state_dict(torch.load(checkpoint_path + "/Q1"))
         self.Q1.to(self.device)
 
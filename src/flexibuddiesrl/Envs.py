@@ -0,0 +1,246 @@
+import numpy as np
+import gymnasium as gym
+from gymnasium.vector.utils import batch_space
+
+
+class BatchEnv(gym.vector.VectorEnv):
+    """
+    Base for NumPy environments that step all num_envs instances with array
+    ops instead of one Python env per instance. Follows the gymnasium vector
+    autoreset convention: an env that finishes returns its final obs, and
+    its next step() resets it and returns reward 0 and the reset obs.
+    Subclasses set single_observation_space / single_action_space and
+    implement _reset(mask), _step(actions) -> (reward, terminated) and _obs().
+    """
+
+    def __init__(self, num_envs, max_steps, seed=None):
+        self.num_envs = num_envs
+        self.max_steps = max_steps
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.rng = np.random.default_rng(seed)
+        self.elapsed = np.zeros(num_envs, dtype=np.int64)
+        self._needs_reset = np.zeros(num_envs, dtype=bool)
+
+    def reset(self, *, seed=None, options=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self._reset(np.ones(self.num_envs, dtype=bool))
+        self.elapsed[:] = 0
+        self._needs_reset[:] = False
+        return self._obs(), {}
+
+    def step(self, actions):
+        # finished envs are stepped with the rest and overwritten by the reset
+        reset = self._needs_reset
+        reward, terminated = self._step(actions)
+        self.elapsed += 1
+        truncated = self.elapsed >= self.max_steps
+        if reset.any():
+            self._reset(reset)
+            self.elapsed[reset] = 0
+            reward[reset] = 0.0
+            terminated[reset] = False
+            truncated[reset] = False
+        self._needs_reset = terminated | truncated
+        return self._obs(), reward.astype(np.float32), terminated, truncated, {}
+
+
+class BatchCartPole(BatchEnv):
+    def __init__(self, num_envs=1, max_steps=500, seed=None):
+        """CartPole-v1 dynamics, Discrete(2) push left / right"""
+        self.single_observation_space = gym.spaces.Box(
+            -np.inf, np.inf, (4,), dtype=np.float32
+        )
+        self.single_action_space = gym.spaces.Discrete(2)
+        self.gravity = 9.8
+        self.masscart = 1.0
+        self.masspole = 0.1
+        self.total_mass = self.masspole + self.masscart
+        self.length = 0.5
+        self.polemass_length = self.masspole * self.length
+        self.force_mag = 10.0
+        self.tau = 0.02
+        self.theta_threshold = 12 * 2 * np.pi / 360
+        self.x_threshold = 2.4
+        self.state = np.zeros((num_envs, 4))
+        super(BatchCartPole, self).__init__(num_envs, max_steps, seed)
+
+    def _reset(self, mask):
+        self.state[mask] = self.rng.uniform(-0.05, 0.05, size=(int(mask.sum()), 4))
+
+    def _obs(self):
+        return self.state.astype(np.float32)
+
+    def _step(self, actions):
+        actions = np.asarray(actions).reshape(self.num_envs)
+        x, x_dot, theta, theta_dot = self.state.T
+        force = np.where(actions == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        temp = (
+            force + self.polemass_length * theta_dot**2 * sintheta
+        ) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+            self.length * (4.0 / 3.0 - self.masspole * costheta**2 / self.total_mass)
+        )
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        self.state = np.stack(
+            [
+                x + self.tau * x_dot,
+                x_dot + self.tau * xacc,
+                theta + self.tau * theta_dot,
+                theta_dot + self.tau * thetaacc,
+            ],
+            axis=-1,
+        )
+        terminated = (np.abs(self.state[:, 0]) > self.x_threshold) | (
+            np.abs(self.state[:, 2]) > self.theta_threshold
+        )
+        return np.ones(self.num_envs), terminated
+
+
+class BatchPendulum(BatchEnv):
+    def __init__(self, num_envs=1, max_steps=200, seed=None):
+        """Pendulum-v1 dynamics, Box(-2, 2, (1,)) torque"""
+        self.max_speed = 8.0
+        self.max_torque = 2.0
+        self.dt = 0.05
+        self.g = 10.0
+        self.m = 1.0
+        self.l = 1.0
+        high = np.array([1.0, 1.0, self.max_speed], dtype=np.float32)
+        self.single_observation_space = gym.spaces.Box(-high, high, dtype=np.float32)
+        self.single_action_space = gym.spaces.Box(
+            -self.max_torque, self.max_torque, (1,), dtype=np.float32
+        )
+        self.th = np.zeros(num_envs)
+        self.thdot = np.zeros(num_envs)
+        super(BatchPendulum, self).__init__(num_envs, max_steps, seed)
+
+    def _reset(self, mask):
+        n = int(mask.sum())
+        self.th[mask] = self.rng.uniform(-np.pi, np.pi, size=n)
+        self.thdot[mask] = self.rng.uniform(-1.0, 1.0, size=n)
+
+    def _obs(self):
+        return np.stack([np.cos(self.th), np.sin(self.th), self.thdot], axis=-1).astype(
+            np.float32
+        )
+
+    def _step(self, actions):
+        u = np.clip(
+            np.asarray(actions, dtype=np.float64).reshape(self.num_envs),
+            -self.max_torque,
+            self.max_torque,
+        )
+        th_norm = ((self.th + np.pi) % (2 * np.pi)) - np.pi
+        costs = th_norm**2 + 0.1 * self.thdot**2 + 0.001 * u**2
+        self.thdot = np.clip(
+            self.thdot
+            + (
+                3 * self.g / (2 * self.l) * np.sin(self.th)
+                + 3.0 / (self.m * self.l**2) * u
+            )
+            * self.dt,
+            -self.max_speed,
+            self.max_speed,
+        )
+        self.th = self.th + self.thdot * self.dt
+        return -costs, np.zeros(self.num_envs, dtype=bool)
+
+
+class BatchHybrid(BatchEnv):
+    def __init__(self, num_envs=1, max_steps=200, seed=None):
+        """
+        A cart pole and a pendulum driven together, like test_dual_env.
+        Obs is the 7 dim concatenation, the action is
+        Tuple(Discrete(2), Box(-2, 2, (1,))). The reward is the cart pole's 1
+        per step plus the pendulum cost scaled to [-1, 0]. The episode ends
+        when the pole falls or after max_steps.
+        """
+        self.cart = BatchCartPole(num_envs, max_steps, seed)
+        self.pend = BatchPendulum(num_envs, max_steps, seed)
+        self.single_observation_space = gym.spaces.Box(
+            -np.inf, np.inf, (7,), dtype=np.float32
+        )
+        self.single_action_space = gym.spaces.Tuple(
+            (self.cart.single_action_space, self.pend.single_action_space)
+        )
+        super(BatchHybrid, self).__init__(num_envs, max_steps, seed)
+        self.cart.rng = self.rng
+        self.pend.rng = self.rng
+
+    def reset(self, *, seed=None, options=None):
+        # both halves draw from the shared generator
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.cart.rng = self.rng
+        self.pend.rng = self.rng
+        return super(BatchHybrid, self).reset(options=options)
+
+    def _reset(self, mask):
+        self.cart._reset(mask)
+        self.pend._reset(mask)
+
+    def _obs(self):
+        return np.concatenate([self.cart._obs(), self.pend._obs()], axis=-1)
+
+    def _step(self, actions):
+        d_reward, terminated = self.cart._step(actions[0])
+        c_reward, _ = self.pend._step(actions[1])
+        max_cost = np.pi**2 + 0.1 * self.pend.max_speed**2 + 0.001 * 4
+        return d_reward + c_reward / max_cost, terminated
+
+
+if __name__ == "__main__":
+    import time
+    import torch
+    from flexibuddiesrl.PG import PG
+    from flexibuddiesrl.Runner import VectorRunner
+
+    for env_cls in [BatchCartPole, BatchPendulum, BatchHybrid]:
+        for n in [1, 16, 256, 4096]:
+            env = env_cls(n, seed=0)
+            env.reset(seed=0)
+            start = time.time()
+            for _ in range(200):
+                env.step(env.action_space.sample())
+            print(
+                f"{env_cls.__name__} n_envs: {n} env steps/sec: {200 * n / (time.time() - start):.0f}"
+            )
+
+    for n in [16, 256, 4096]:
+        agent = PG(
+            obs_dim=4,
+            discrete_action_dims=[2],
+            hidden_dims=[64, 64],
+            mini_batch_size=256,
+            n_epochs=1,
+            device="cuda" if torch.cuda.is_available() else "cpu",
+        )
+        runner = VectorRunner(
+            agent,
+            env=BatchCartPole(n, seed=0),
+            rollout_len=32,
+            device=agent.device,
+            seed=0,
+            log_interval=0,
+        )
+        stats = runner.run(100000)
+        print(
+            f"PG on BatchCartPole n_envs: {n} env steps/sec: {stats['env_steps_per_sec']:.0f} updates/sec: {stats['updates_per_sec']:.2f}"
+        )
+
+    # a centralized critic acts with return_value=True before any team batch
+    agent = PG(
+        obs_dim=4,
+        discrete_action_dims=[2],
+        hidden_dims=[64, 64],
+        centralized_critic=True,
+    )
+    stats = VectorRunner(
+        agent, env=BatchCartPole(16, seed=0), rollout_len=32, seed=0, log_interval=0
+    ).run(4096)
+    assert stats["updates"] > 0, "centralized PG did not update through the runner"
+    print(f"centralized PG on BatchCartPole updates: {stats['updates']}")
@@ -0,0 +1,241 @@
+import copy
+import os
+import pickle
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from flexibuddiesrl.Util import select_agents, flatten_agents, normgrad, upcast_batch
+
+
+class VDNMixer(nn.Module):
+    def __init__(self, n_agents=None, state_dim=None, device="cpu"):
+        super(VDNMixer, self).__init__()
+        self.n_agents = n_agents
+        self.device = device
+
+    def forward(self, utilities, state=None):
+        # utilities [B, n_agents] -> Q_tot [B]
+        return utilities.sum(dim=-1)
+
+
+class QMixer(nn.Module):
+    def __init__(
+        self,
+        n_agents,
+        state_dim,
+        embed_dim=32,
+        hypernet_hidden=64,
+        device="cpu",
+    ):
+        """
+        n_agents: int
+            Number of utilities mixed per sample
+        state_dim: int
+            Size of the global state the hypernetworks condition on
+        embed_dim: int
+            Width of the mixing layer
+        hypernet_hidden: int
+            Hidden size of the hypernetwork producing the first mixing weights
+        """
+        super(QMixer, self).__init__()
+        self.n_agents = n_agents
+        self.state_dim = state_dim
+        self.embed_dim = embed_dim
+        self.device = device
+        self.hyper_w1 = nn.Sequential(
+            nn.Linear(state_dim, hypernet_hidden),
+            nn.ReLU(),
+            nn.Linear(hypernet_hidden, n_agents * embed_dim),
+        )
+        self.hyper_b1 = nn.Linear(state_dim, embed_dim)
+        self.hyper_w2 = nn.Linear(state_dim, embed_dim)
+        self.hyper_b2 = nn.Sequential(
+            nn.Linear(state_dim, embed_dim), nn.ReLU(), nn.Linear(embed_dim, 1)
+        )
+        self.to(device)
+
+    def forward(self, utilities, state):
+        # abs() on the hypernetwork weights keeps Q_tot monotonic in each utility
+        bsize = utilities.shape[0]
+        w1 = torch.abs(self.hyper_w1(state)).view(bsize, self.n_agents, self.embed_dim)
+        b1 = self.hyper_b1(state).view(bsize, 1, self.embed_dim)
+        hidden = F.elu(torch.bmm(utilities.unsqueeze(1), w1) + b1)
+        w2 = torch.abs(self.hyper_w2(state)).view(bsize, self.embed_dim, 1)
+        b2 = self.hyper_b2(state).view(bsize, 1, 1)
+        return (torch.bmm(hidden, w2) + b2).view(bsize)
+
+
+class MixerLearner:
+    def __init__(
+        self,
+        agents,
+        mixer,
+        lr=1e-3,
+        gamma=0.99,
+        target_update_percentage=0.01,
+        grad_clip=10.0,
+        one_hot_ids=False,
+        device="cpu",
+    ):
+        """
+        agents: list
+            Agent for each team slot. The same instance may fill several slots,
+            its utilities are then evaluated in one batched call.
+        mixer: nn.Module
+            VDNMixer or QMixer taking ([B, n_agents], state) -> [B]
+        target_update_percentage: float
+            Polyak rate for the target mixer
+        grad_clip: float
+            Max grad norm per agent and for the mixer, None to disable
+        one_hot_ids: bool
+            Append one-hot slot ids to obs for shared agents
+        """
+        self.agents = agents
+        self.n_agents = len(agents)
+        self.mixer = mixer
+        self.mixer_target = copy.deepcopy(mixer)
+        self.gamma = gamma
+        self.target_update_percentage = target_update_percentage
+        self.grad_clip = grad_clip
+        self.one_hot_ids = one_hot_ids
+        self.device = device
+        self.mixer_params = list(self.mixer.parameters())
+        self.optimizer = (
+            torch.optim.Adam(self.mixer_params, lr=lr)
+            if len(self.mixer_params) > 0
+            else None
+        )
+
+        # slots grouped by agent instance, in order of first appearance
+        self.groups = {}
+        self.unique_agents = []
+        for slot, agent in enumerate(agents):
+            if id(agent) not in self.groups:
+                self.groups[id(agent)] = []
+                self.unique_agents.append(agent)
+            self.groups[id(agent)].append(slot)
+
+    def _agent_optimizer(self, agent):
+        opt = getattr(agent, "critic_optimizer", None)
+        if opt is None:
+            opt = agent.optimizer
+        return opt
+
+    def _state(self, batch, next_state=False):
+        state = getattr(batch, "state_" if next_state else "state", None)
+        if state is not None:
+            return state
+        obs = batch.obs_ if next_state else batch.obs
+        return obs.permute(1, 0, 2).reshape(obs.shape[1], -1)
+
+    def utilities(self, batch, next_obs=False):
+        """
+        Per-slot utilities [B, n_agents] from one utility_function call per
+        agent instance. With next_obs the greedy utilities of obs_ come from
+        the agents' target networks, or their online ones if they keep none.
+        """
+        bsize = batch.obs.shape[1]
+        utils = [None] * self.n_agents
+        for agent in self.unique_agents:
+            slots = self.groups[id(agent)]
+            flat = flatten_agents(
+                select_agents(batch, slots, self.n_agents if self.one_hot_ids else None)
+            )
+            if next_obs:
+                u = agent.utility_function(flat.obs_[0], None, target=True)
+            else:
+                da = getattr(flat, "discrete_actions", None)
+                ca = getattr(flat, "continuous_actions", None)
+                u = agent.utility_function(
+                    flat.obs[0],
+                    (
+                        da[0] if da is not None else None,
+                        ca[0] if ca is not None else None,
+                    ),
+                )
+            u = u.reshape(len(slots), bsize)
+            for i, slot in enumerate(slots):
+                utils[slot] = u[i]
+        return torch.stack(utils, dim=-1)
+
+    def learn(self, batch, debug=False):
+        """
+        One team TD update. Every agent's utility and the mixer get their
+        gradients from a single backward of the mixed loss. The target mixer
+        and the agents' target networks then move by their polyak rates.
+
+        batch: FlexiBatch
+            Team batch with obs [n_agents, B, obs_dim] on the learner's device
+
+        Returns the mixed TD loss as a float.
+        """
+        batch = upcast_batch(batch)
+        with torch.no_grad():
+            next_utils = self.utilities(batch, next_obs=True)
+            q_tot_ = self.mixer_target(next_utils, self._state(batch, True))
+            target = batch.global_rewards + self.gamma * (1 - batch.terminated) * q_tot_
+
+        utils = self.utilities(batch)
+        q_tot = self.mixer(utils, self._state(batch))
+        loss = F.mse_loss(q_tot, target)
+        if debug:
+            print(f"MixerLearner utils: {utils.shape}, q_tot: {q_tot[:4]}")
+            print(f"MixerLearner target: {target[:4]}, loss: {loss.item()}")
+
+        optimizers = [self._agent_optimizer(a) for a in self.unique_agents]
+        for opt in optimizers:
+            opt.zero_grad()
+        if self.optimizer is not None:
+            self.optimizer.zero_grad()
+        loss.backward()
+        if self.grad_clip is not None:
+            for opt in optimizers:
+                for g in opt.param_groups:
+                    normgrad(g["params"], self.grad_clip)
+            if self.optimizer is not None:
+                normgrad(self.mixer_params, self.grad_clip)
+        for opt in optimizers:
+            opt.step()
+        if self.optimizer is not None:
+            self.optimizer.step()
+        self.polyak_update(self.target_update_percentage)
+        for agent in self.unique_agents:
+            if hasattr(agent, "polyak_update"):
+                agent.polyak_update(agent.target_update_percentage)
+        return loss.item()
+
+    def polyak_update(self, tau):
+        with torch.no_grad():
+            for param, target_param in zip(
+                self.mixer.parameters(), self.mixer_target.parameters()
+            ):
+                target_param.data.copy_(
+                    tau * param.data + (1.0 - tau) * target_param.data
+                )
+
+    def save(self, checkpoint_path):
+        if not os.path.exists(checkpoint_path):
+            os.makedirs(checkpoint_path)
+        torch.save(self.mixer.state_dict(), checkpoint_path + "/mixer")
+        torch.save(self.mixer_target.state_dict(), checkpoint_path + "/mixer_target")
+        if self.optimizer is not None:
+            torch.save(self.optimizer.state_dict(), checkpoint_path + "/mixer_optim")
+        with open(checkpoint_path + "/mixer_gamma", "wb") as f:
+            pickle.dump(self.gamma, f)
+
+    def load(self, checkpoint_path):
+        self.mixer.load_state_dict(
+            torch.load(checkpoint_path + "/mixer", map_location=self.device)
+        )
+        self.mixer_target.load_state_dict(
+            torch.load(checkpoint_path + "/mixer_target", map_location=self.device)
+        )
+        if self.optimizer is not None and os.path.exists(
+            checkpoint_path + "/mixer_optim"
+        ):
+            self.optimizer.load_state_dict(
+                torch.load(checkpoint_path + "/mixer_optim", map_location=self.device)
+            )
+        if os.path.exists(checkpoint_path + "/mixer_gamma"):
+            with open(checkpoint_path + "/mixer_gamma", "rb") as f:
+                self.gamma = pickle.load(f)
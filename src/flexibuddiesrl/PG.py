@@ -1,12 +1,95 @@
-from flexibuddiesrl.Agent import ValueS, MixedActor, Agent
-from flexibuddiesrl.Util import T
+from flexibuddiesrl.Agent import (
+    ValueS,
+    MixedActor,
+    Agent,
+    ffEncoder,
+    AttentionCritic,
+    RecurrentEncoder,
+    keeps_hidden,
+)
+from flexibuddiesrl.Util import (
+    T,
+    select_agents,
+    flatten_agents,
+    per_agent_sum,
+    upcast_batch,
+)
 import torch
 from flexibuff import FlexiBatch
-from torch.distributions import Categorical
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 import pickle
 import os
+import copy
+
+
+class StreamingGAE:
+    """
+    Incremental GAE accumulator fed one transition at a time during rollout
+    collection. Advantages for an episode segment are finalized as soon as
+    the segment ends, so finish() only has to bootstrap the open tail.
+    """
+
+    def __init__(self, gamma=0.99, gae_lambda=0.95, device="cpu"):
+        self.gamma = gamma
+        self.gae_lambda = gae_lambda
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.advantages = []  # finalized segments
+        self.returns = []
+        self._rewards = []  # open segment
+        self._values = []
+
+    def __len__(self):
+        return len(self.advantages) + len(self._rewards)
+
+    def _scalar(self, x):
+        if torch.is_tensor(x):
+            return x.reshape(-1)[0].item()
+        return float(np.asarray(x).reshape(-1)[0])
+
+    def add(self, reward, value, terminated, next_value=None):
+        """
+        reward, value: r_t and V(s_t) for the step just taken
+        terminated: whether the episode ended on this step
+        next_value: V(s_t+1) to bootstrap from when the episode was truncated
+        """
+        self._rewards.append(self._scalar(reward))
+        self._values.append(self._scalar(value))
+        if terminated:
+            self._close_segment(0.0 if next_value is None else self._scalar(next_value))
+
+    def _close_segment(self, next_value):
+        n = len(self._rewards)
+        seg_adv = [0.0] * n
+        last_gae_lam = 0.0
+        for t in reversed(range(n)):
+            delta = self._rewards[t] + self.gamma * next_value - self._values[t]
+            last_gae_lam = delta + self.gamma * self.gae_lambda * last_gae_lam
+            seg_adv[t] = last_gae_lam
+            next_value = self._values[t]
+        self.advantages.extend(seg_adv)
+        self.returns.extend([a + v for a, v in zip(seg_adv, self._values)])
+        self._rewards = []
+        self._values = []
+
+    def finish(self, last_value=0.0):
+        """
+        Bootstraps the open tail with last_value = V(obs_[-1]) and returns
+        (returns, advantages) as [T, 1] tensors, ready to be passed to
+        PG.reinforcement_learn. The accumulator is reset afterwards.
+        """
+        if len(self._rewards) > 0:
+            self._close_segment(self._scalar(last_value))
+        G = torch.tensor(self.returns, dtype=torch.float32, device=self.device)
+        advantages = torch.tensor(
+            self.advantages, dtype=torch.float32, device=self.device
+        )
+        self.reset()
+        return G.unsqueeze(-1), advantages.unsqueeze(-1)
 
 
 class PG(nn.Module, Agent):
@@ -38,6 +121,13 @@ class PG(nn.Module, Agent):
         load_from_checkpoint=None,
         name="PPO",
         eval_mode=False,
+        shared_encoder=False,
+        detach_critic_encoder=False,
+        chunk_size=0,
+        centralized_critic=False,
+        critic_heads=4,
+        recurrent=None,
+        rnn_hidden=64,
     ):
         super(PG, self).__init__()
         self.eval_mode = eval_mode
@@ -68,11 +158,35 @@ class PG(nn.Module, Agent):
             "g_mean",
             "steps",
             "eval_mode",
+            "shared_encoder",
+            "detach_critic_encoder",
+            "chunk_size",
+            "centralized_critic",
+            "critic_heads",
+            "recurrent",
+            "rnn_hidden",
         ]
         assert (
             continuous_action_dim > 0 or discrete_action_dims is not None
         ), "At least one action dim should be provided"
         self.name = name
+        # One ffEncoder trunk feeding both the actor heads and the value head
+        self.shared_encoder = shared_encoder
+        self.detach_critic_encoder = detach_critic_encoder
+        # Max rollout steps per critic forward when computing advantages so
+        # peak memory does not grow with rollout length. 0 disables chunking.
+        self.chunk_size = chunk_size
+        # V(s) from an AttentionCritic over the whole team's obs at each step
+        self.centralized_critic = centralized_critic
+        self.critic_heads = critic_heads
+        # "gru" or "lstm": a RecurrentEncoder shared by actor and critic, so
+        # acting costs one cell update per step. Minibatches are trained in
+        # rollout order as truncated BPTT chunks.
+        self.recurrent = recurrent
+        self.rnn_hidden = rnn_hidden
+        assert not (
+            (shared_encoder or recurrent) and centralized_critic
+        ), "A centralized critic can not share the actor encoder"
         if load_from_checkpoint is not None:
             self.load(load_from_checkpoint)
             return
@@ -121,6 +235,26 @@ class PG(nn.Module, Agent):
             self.max_actions = torch.from_numpy(max_actions).to(self.device)
 
     def _get_torch_params(self, starting_actorlogstd):
+        self.encoder = None
+        if self.recurrent:
+            self.encoder = RecurrentEncoder(
+                self.obs_dim,
+                self.hidden_dims,
+                rnn_hidden=self.rnn_hidden,
+                cell=self.recurrent,
+                activation=self.activation,
+                device=self.device,
+                orthogonal_init=self.orthogonal,
+            )
+        elif self.shared_encoder:
+            self.encoder = ffEncoder(
+                self.obs_dim,
+                self.hidden_dims,
+                activation=self.activation,
+                device=self.device,
+                orthogonal_init=self.orthogonal,
+                dropout=0,
+            )
         self.actor = MixedActor(
             obs_dim=self.obs_dim,
             continuous_action_dim=self.continuous_action_dim,
@@ -128,18 +262,31 @@ class PG(nn.Module, Agent):
             max_actions=self.max_actions,
             min_actions=self.min_actions,
             hidden_dims=self.hidden_dims,
+            encoder=self.encoder,
             device=self.device,
             orthogonal_init=self.orthogonal,
             activation=self.activation,
         )
 
-        self.critic = ValueS(
-            obs_dim=self.obs_dim,
-            hidden_dim=self.hidden_dims[0],
-            device=self.device,
-            orthogonal_init=self.orthogonal,
-            activation=self.activation,
-        )
+        if self.centralized_critic:
+            self.critic = AttentionCritic(
+                obs_dim=self.obs_dim,
+                hidden_dims=self.hidden_dims,
+                n_heads=self.critic_heads,
+                device=self.device,
+                orthogonal_init=self.orthogonal,
+                activation=self.activation,
+            )
+        else:
+            self.critic = ValueS(
+                obs_dim=self.obs_dim,
+                hidden_dim=self.hidden_dims[0],
+                device=self.device,
+                orthogonal_init=self.orthogonal,
+                activation=self.activation,
+                encoder=self.encoder,
+                detach_encoder=self.detach_critic_encoder,
+            )
         self.actor_logstd = (
             nn.Parameter(
                 torch.zeros(1, self.continuous_action_dim), requires_grad=True
@@ -156,28 +303,34 @@ class PG(nn.Module, Agent):
     def _sample_multi_discrete(
         self, logits, debug=False
     ):  # logits of the form [action_dim, batch_size, action_dim_size]
+        # batch_size may be absent for a single observation
+        lead = logits[0].shape[:-1]
         actions = torch.zeros(
-            size=(len(self.discrete_action_dims),),
+            size=lead + (len(self.discrete_action_dims),),
             device=self.device,
             dtype=torch.int,
         )
         log_probs = torch.zeros(
-            size=(len(self.discrete_action_dims),),
+            size=lead + (len(self.discrete_action_dims),),
             device=self.device,
         )
         for i in range(len(self.discrete_action_dims)):
-            # print(f"logits: {logits}")
-            dist = Categorical(probs=logits[i])
-            actions[i] = dist.sample()
-            # print(f"act: {actions[i]}")
-            # print(
-            #    f"logprob: {dist.log_prob(actions[i])}, {torch.log(logits[i][actions[i]])}"
-            # )
-            log_probs[i] = dist.log_prob(actions[i])
-            # print(dist)
+            head_log_probs = F.log_softmax(logits[i], dim=-1)
+            act = torch.multinomial(
+                head_log_probs.exp().reshape(-1, head_log_probs.shape[-1]), 1
+            ).reshape(lead + (1,))
+            actions[..., i] = act.squeeze(-1)
+            log_probs[..., i] = head_log_probs.gather(-1, act).squeeze(-1)
         return actions, log_probs
 
-    def train_actions(self, observations, action_mask=None, step=False, debug=False):
+    def train_actions(
+        self,
+        observations,
+        action_mask=None,
+        step=False,
+        debug=False,
+        return_value=False,
+    ):
         if debug:
             print(f"  Testing Train Actions: Observations: {observations}")
         if not torch.is_tensor(observations):
@@ -190,16 +343,29 @@ class PG(nn.Module, Agent):
         # print(f"Observations: {observations.shape} {observations}")
 
         if step:
-            self.steps += 1
+            # a batch of observations from a vector env is one step per env
+            self.steps += observations.shape[0] if observations.dim() > 1 else 1
         if self.anneal_lr > 0:
             frac = max(1.0 - (self.steps - 1.0) / self.anneal_lr, 0.001)
             lrnow = frac * self.lr
             self.optimizer.param_groups[0]["lr"] = lrnow
 
-        with torch.no_grad():
-            continuous_logits, discrete_logits = self.actor(
-                x=observations, action_mask=action_mask, gumbel=False, debug=False
-            )
+        value = 0
+        with torch.no_grad(), self._autocast():
+            if return_value:
+                # V(s) from the same no-grad pass so it can be stored per step
+                value, continuous_logits, discrete_logits = self._actor_critic(
+                    observations, action_mask=action_mask
+                )
+                value = value.detach().cpu().numpy()
+            else:
+                continuous_logits, discrete_logits = self.actor(
+                    x=observations,
+                    action_mask=action_mask,
+                    gumbel=False,
+                    debug=False,
+                    logits=True,
+                )
             if debug:
                 print(f"  After actor: clog {continuous_logits}, dlog{discrete_logits}")
 
@@ -249,14 +415,14 @@ class PG(nn.Module, Agent):
             continuous_actions,
             discrete_log_probs,
             continuous_log_probs,
-            0,  # vals.detach().cpu().numpy(), TODO: re-enable this when flexibuff is done
+            value,
         )
 
     # takes the observations and returns the action with the highest probability
     def ego_actions(self, observations, action_mask=None):
         with torch.no_grad():
             continuous_actions, discrete_action_activations = self.actor(
-                observations, action_mask, gumbel=False
+                observations, action_mask, gumbel=False, logits=True
             )
             if len(continuous_actions.shape) == 1:
                 continuous_actions = continuous_actions.unsqueeze(0)
@@ -292,29 +458,76 @@ class PG(nn.Module, Agent):
 
         return loss.item()  # loss
 
-    def utility_function(self, observations, actions=None):
+    @keeps_hidden
+    def utility_function(self, observations, actions=None, target=False):
         if not torch.is_tensor(observations):
             observations = torch.tensor(observations, dtype=torch.float).to(self.device)
-        if actions is not None:
-            return self.critic(observations, actions)
-        else:
-            return self.critic(observations)
-        # If actions are none then V(s)
+        # The PG critic is V(s) so actions are ignored, and it has no target
+        # network so target reads the online critic
+        return self.critic(observations).squeeze(-1)
 
+    @keeps_hidden
     def expected_V(self, obs, legal_action=None):
         return self.critic(obs)
 
-    def marl_learn(self, batch, agent_num, mixer, critic_only=False, debug=False):
-        return super().marl_learn(batch, agent_num, mixer, critic_only, debug)
-
     def zero_grads(self):
         return 0
 
+    def _critic_values(self, batch, agent_num, idx=slice(None), next_obs=False):
+        # Same shape as self.critic(obs[agent_num, idx]). A centralized critic
+        # sees the whole team at each step and reads out agent_num's value.
+        obs = batch.obs_ if next_obs else batch.obs
+        if self.recurrent:
+            # filled once per rollout by _recurrent_values
+            if next_obs:
+                return batch.last_value
+            return batch.values[agent_num, idx].unsqueeze(-1)
+        if not self.centralized_critic:
+            return self.critic(obs[agent_num, idx])
+        team_obs = obs[:, idx]
+        agent_mask = getattr(batch, "agent_mask", None)
+        if agent_mask is not None:
+            agent_mask = T(agent_mask, self.device)[:, idx]
+        single = team_obs.dim() == 2
+        if single:
+            team_obs = team_obs.unsqueeze(1)
+            agent_mask = agent_mask.unsqueeze(1) if agent_mask is not None else None
+        v = self.critic(
+            team_obs.transpose(0, 1),
+            agent_mask=agent_mask.T if agent_mask is not None else None,
+        )[:, agent_num]
+        if np.ndim(agent_num) > 0:
+            v = v.transpose(0, 1)
+        if single:
+            v = v.squeeze(-2)
+        return v
+
+    def _actor_critic(self, obs, action_mask=None, batch=None, agent_num=0, idx=None):
+        # With a shared encoder the trunk runs once for both actor and critic
+        if self.centralized_critic:
+            cont, disc = self.actor(
+                obs, action_mask=action_mask, gumbel=False, logits=True
+            )
+            if batch is None:
+                # acting only sees this agent's obs, value it as a team of one
+                v = self.critic(obs.reshape(-1, obs.shape[-1]))
+                return v.reshape(obs.shape[:-1] + (1,)), cont, disc
+            return self._critic_values(batch, agent_num, idx), cont, disc
+        if self.encoder is not None:
+            features = self.encoder(obs)
+            cont, disc = self.actor.heads(
+                features, action_mask=action_mask, gumbel=False, logits=True
+            )
+            return self.critic.head(features), cont, disc
+        cont, disc = self.actor(obs, action_mask=action_mask, gumbel=False, logits=True)
+        return self.critic(obs), cont, disc
+
     def _get_disc_log_probs_entropy(self, logits, actions):
-        log_probs = torch.zeros_like(actions, dtype=torch.float)
-        dist = Categorical(logits=logits)
-        log_probs = dist.log_prob(actions)
-        return log_probs, dist.entropy().mean()
+        # One log_softmax pass gives both the selected log probs and entropy
+        all_log_probs = F.log_softmax(logits, dim=-1)
+        log_probs = all_log_probs.gather(-1, actions.long().unsqueeze(-1)).squeeze(-1)
+        entropy = -(all_log_probs.exp() * all_log_probs).sum(dim=-1)
+        return log_probs, entropy
 
     def _get_cont_log_probs_entropy(self, logits, actions):
         log_probs = torch.zeros_like(actions, dtype=torch.float)
@@ -326,7 +539,9 @@ class PG(nn.Module, Agent):
 
     def _get_probs_and_entropy(self, batch: FlexiBatch, agent_num):
         cp, dp = self.actor(
-            batch.obs[agent_num], action_mask=batch.action_mask[agent_num]
+            batch.obs[agent_num],
+            action_mask=batch.action_mask[agent_num],
+            logits=True,
         )
         if len(self.discrete_action_dims) > 0:
             old_disc_log_probs = []
@@ -337,7 +552,7 @@ class PG(nn.Module, Agent):
                     actions=batch.discrete_actions[agent_num][:, head],
                 )
                 old_disc_log_probs.append(odlp)
-                old_disc_entropy.append(ode)
+                old_disc_entropy.append(ode.mean())
         else:
             old_disc_log_probs = 0
             old_disc_entropy = 0
@@ -357,14 +572,55 @@ class PG(nn.Module, Agent):
             old_cont_entropy,
         )
 
+    def _chunks(self, num_steps):
+        chunk = self.chunk_size if self.chunk_size > 0 else num_steps
+        return [(s, min(s + chunk, num_steps)) for s in range(0, num_steps, chunk)]
+
+    def _agent_shape(self, agent_num):
+        # agent_num may be a list of agents under parameter sharing, in which
+        # case values and advantages are [T, n_agents] instead of [T]
+        return (len(agent_num),) if np.ndim(agent_num) > 0 else ()
+
+    def _chunk_values(self, batch, agent_num, start, end):
+        # Values stored from train_actions(return_value=True) are registered
+        # as "values" so the critic does not need to re-run over the rollout
+        stored = getattr(batch, "values", None)
+        if stored is not None:
+            values = T(stored[agent_num, start:end], self.device).float()
+            values = values.reshape(self._agent_shape(agent_num) + (end - start,))
+        else:
+            values = self._critic_values(batch, agent_num, slice(start, end)).squeeze(
+                -1
+            )
+        if np.ndim(agent_num) > 0:
+            values = values.T
+        return values
+
+    def _rollout_values(self, batch, agent_num):
+        num_steps = batch.global_rewards.shape[0]
+        chunks = self._chunks(num_steps)
+        if len(chunks) == 1:
+            return self._chunk_values(batch, agent_num, 0, num_steps)
+        values = torch.zeros(
+            (num_steps,) + self._agent_shape(agent_num), device=self.device
+        )
+        for start, end in chunks:
+            values[start:end] = self._chunk_values(batch, agent_num, start, end)
+        return values
+
     def _G(self, batch, agent_num):
-        G = torch.zeros_like(batch.global_rewards).to(self.device)
+        G = torch.zeros(
+            (batch.global_rewards.shape[0],) + self._agent_shape(agent_num),
+            device=self.device,
+        )
         G[-1] = batch.global_rewards[-1]
         if batch.terminated[-1] < 0.5:
             if self.advantage_type == "constant":
                 G[-1] += self.gamma * self.g_mean
             else:
-                G[-1] += self.gamma * self.critic(batch.obs_[agent_num][-1]).squeeze(-1)
+                G[-1] += self.gamma * self._critic_values(
+                    batch, agent_num, -1, next_obs=True
+                ).squeeze(-1)
 
         for i in range(len(batch.global_rewards) - 2, -1, -1):
             G[i] = batch.global_rewards[i] + self.gamma * G[i + 1] * (
@@ -373,31 +629,39 @@ class PG(nn.Module, Agent):
         G = G.unsqueeze(-1)
         return G
 
-    def _gae(self, batch, agent_num):
+    def _gae(self, batch, agent_num, next_values=None):
+        # next_values bootstraps the last step, by default V(obs_[-1])
         with torch.no_grad():
-            advantages = torch.zeros_like(batch.global_rewards).to(self.device)
             num_steps = batch.global_rewards.shape[0]
-            last_values = self.critic(batch.obs_[agent_num, -1]).squeeze(-1)
-            values = self.critic(batch.obs[agent_num]).squeeze(-1)
-
+            shape = (num_steps,) + self._agent_shape(agent_num)
+            advantages = torch.zeros(shape, device=self.device)
+            values = torch.zeros(shape, device=self.device)
+            if next_values is None:
+                next_values = self._critic_values(
+                    batch, agent_num, -1, next_obs=True
+                ).squeeze(-1)
+
+            # Chunks are visited back to front so the recursion only carries
+            # next_values and last_gae_lam across chunk boundaries
             last_gae_lam = 0
-            for step in reversed(range(num_steps)):
-                if step == num_steps - 1:
-                    next_non_terminal = 1.0 - batch.terminated[-1]
-                    next_values = last_values
-                else:
+            for start, end in reversed(self._chunks(num_steps)):
+                values[start:end] = self._chunk_values(batch, agent_num, start, end)
+                for step in reversed(range(start, end)):
                     next_non_terminal = 1.0 - batch.terminated[step]
-                    next_values = values[step + 1]
-                delta = (
-                    batch.global_rewards[step]
-                    + self.gamma * next_values * next_non_terminal
-                    - values[step]
-                )
-                last_gae_lam = (
-                    delta
-                    + self.gamma * self.gae_lambda * next_non_terminal * last_gae_lam
-                )
-                advantages[step] = last_gae_lam
+                    delta = (
+                        batch.global_rewards[step]
+                        + self.gamma * next_values * next_non_terminal
+                        - values[step]
+                    )
+                    last_gae_lam = (
+                        delta
+                        + self.gamma
+                        * self.gae_lambda
+                        * next_non_terminal
+                        * last_gae_lam
+                    )
+                    advantages[step] = last_gae_lam
+                    next_values = values[step]
             # TD(lambda) estimator, see Github PR #375 or "Telescoping in TD(lambda)"
             # in David Silver Lecture 4: https://www.youtube.com/watch?v=PnHCvfgC_ZA
             #
@@ -409,13 +673,15 @@ class PG(nn.Module, Agent):
 
     def _td(self, batch, agent_num):
         reward_arr = batch.global_rewards
-        td = torch.zeros_like(reward_arr).to(self.device)
+        td = torch.zeros(
+            (reward_arr.shape[0],) + self._agent_shape(agent_num), device=self.device
+        )
 
         with torch.no_grad():  # If last obs is non terminal critic to not bias it
-            old_values = self.critic(batch.obs[agent_num]).squeeze(-1)
+            old_values = self._rollout_values(batch, agent_num)
             td[-1] = (
                 self.gamma
-                * self.critic(batch.obs_[agent_num, -1]).squeeze(-1)
+                * self._critic_values(batch, agent_num, -1, next_obs=True).squeeze(-1)
                 * batch.terminated[-1]
                 - old_values[-1]
             )
@@ -440,26 +706,35 @@ class PG(nn.Module, Agent):
         total_norm = total_norm ** (1.0 / 2)
         print(total_norm)
 
-    def reinforcement_learn(
-        self,
-        batch: FlexiBatch,
-        agent_num=0,
-        critic_only=False,
-        debug=False,
-        conenv=False,
-    ):
-        if self.eval_mode:
-            return 0, 0
-        # print(f"Doing PPO learn for agent {agent_num}")
-        # Update the critic with Bellman Equation
-        # Monte Carlo Estimate of returns
-        if debug:
-            print(f"Starting Reinforcement Learn for agent {agent_num}")
-        # # G = G / 100
+    def _recurrent_values(self, batch, agent_num):
+        # One pass of the recurrent trunk over the ordered rollout gives every
+        # V(s_t), and one more cell step from the final state gives V(s_T+1)
+        valued = copy.copy(batch)
+        valued.values = torch.zeros(batch.obs.shape[:2], device=self.device)
+        last_values = []
+        agents = agent_num if np.ndim(agent_num) > 0 else [agent_num]
+        with torch.no_grad():
+            for a in agents:
+                self.set_recurrent_context(batch, a)
+                features = self.encoder(batch.obs[a])
+                valued.values[a] = self.critic.head(features).squeeze(-1)
+                hidden = self.encoder.last_hidden
+                self.clear_recurrent_context()
+                features, _ = self.encoder.step(batch.obs_[a, -1:], hidden)
+                last_values.append(self.critic.head(features).reshape(1))
+        if np.ndim(agent_num) > 0:
+            valued.last_value = torch.stack(last_values)
+        else:
+            valued.last_value = last_values[0]
+        return valued
+
+    def _advantages(self, batch, agent_num, debug=False):
+        if self.recurrent:
+            batch = self._recurrent_values(batch, agent_num)
         with torch.no_grad():
             if self.advantage_type == "gv":
                 G = self._G(batch, agent_num)
-                advantages = G - self.critic(batch.obs[agent_num])
+                advantages = G - self._rollout_values(batch, agent_num).unsqueeze(-1)
             elif self.advantage_type == "gae":
                 G, advantages = self._gae(batch, agent_num)
             elif self.advantage_type == "a2c":
@@ -478,9 +753,117 @@ class PG(nn.Module, Agent):
                 # print(advantages.squeeze(-1))
             if debug:
                 print(f"  batch rewards: {batch.global_rewards}")
-                print(f"  raw critic: {self.critic(batch.obs[agent_num])}")
+                print(f"  raw critic: {self._critic_values(batch, agent_num)}")
                 print(f"  Advantages: {advantages}")
                 print(f"  G: {G}")
+        return G, advantages
+
+    def gae_accumulator(self):
+        return StreamingGAE(
+            gamma=self.gamma, gae_lambda=self.gae_lambda, device=self.device
+        )
+
+    def _ppo_loss(
+        self,
+        weights,
+        obs,
+        action_mask,
+        discrete_actions,
+        continuous_actions,
+        discrete_log_probs,
+        continuous_log_probs,
+        advantages,
+        returns,
+        batch=None,
+        agent_num=0,
+        idx=None,
+    ):
+        """
+        Clipped PPO (or vanilla PG) actor loss plus the critic loss of one
+        minibatch as a pure function of tensors for Compile.CompiledUpdate.
+        batch and idx are only read by a centralized critic. Returns (loss,
+        actor_loss, critic_loss, actor_samples [B], critic_samples [B, 1]).
+        """
+        V_current, cont_probs, disc_logits = self._actor_critic(
+            obs, action_mask=action_mask, batch=batch, agent_num=agent_num, idx=idx
+        )
+        critic_samples = 0.5 * (V_current - returns) ** 2
+        critic_loss = (weights.unsqueeze(-1) * critic_samples).sum()
+
+        # Per-sample actor loss so it can be split by agent
+        actor_samples = 0
+        if continuous_actions is not None:
+            continuous_dist = torch.distributions.Normal(
+                loc=cont_probs,
+                scale=torch.exp(self.actor_logstd.expand_as(cont_probs)),
+            )
+            continuous_log_probs_new = continuous_dist.log_prob(continuous_actions)
+            if self.ppo_clip > 0:
+                ratio = (continuous_log_probs_new - continuous_log_probs).exp()
+                pg_loss1 = advantages * ratio
+                pg_loss2 = advantages * torch.clamp(
+                    ratio, 1 - self.ppo_clip, 1 + self.ppo_clip
+                )
+                continuous_policy_gradient = torch.min(pg_loss1, pg_loss2)
+            else:
+                continuous_policy_gradient = continuous_log_probs_new * advantages
+            actor_samples += -self.policy_loss * continuous_policy_gradient.mean(
+                dim=-1
+            ) - self.entropy_loss * continuous_dist.entropy().mean(dim=-1)
+
+        if discrete_actions is not None:
+            adv = advantages.squeeze(-1)
+            for head in range(len(self.discrete_action_dims)):
+                selected_log_probs, entropy = self._get_disc_log_probs_entropy(
+                    logits=disc_logits[head], actions=discrete_actions[:, head]
+                )
+                if self.ppo_clip > 0:
+                    ratio = (selected_log_probs - discrete_log_probs[:, head]).exp()
+                    pg_loss1 = adv * ratio
+                    pg_loss2 = adv * torch.clamp(
+                        ratio, 1 - self.ppo_clip, 1 + self.ppo_clip
+                    )
+                    discrete_policy_gradient = torch.min(pg_loss1, pg_loss2)
+                else:
+                    discrete_policy_gradient = selected_log_probs * adv
+                actor_samples += (
+                    -self.policy_loss * discrete_policy_gradient
+                    - self.entropy_loss * entropy
+                )
+        actor_loss = (weights * actor_samples).sum()
+        loss = actor_loss + critic_loss * self.critic_loss_coef
+        return (
+            loss,
+            actor_loss.detach(),
+            critic_loss.detach(),
+            actor_samples.detach(),
+            critic_samples.detach(),
+        )
+
+    def reinforcement_learn(
+        self,
+        batch: FlexiBatch,
+        agent_num=0,
+        critic_only=False,
+        debug=False,
+        conenv=False,
+        advantages=None,
+        returns=None,
+    ):
+        if self.eval_mode:
+            return 0, 0
+        batch = upcast_batch(batch)
+        # print(f"Doing PPO learn for agent {agent_num}")
+        # Update the critic with Bellman Equation
+        # Monte Carlo Estimate of returns
+        if debug:
+            print(f"Starting Reinforcement Learn for agent {agent_num}")
+        if advantages is not None and returns is not None:
+            # Precomputed during collection, e.g. by a StreamingGAE
+            advantages = T(advantages, self.device).float().reshape(-1, 1)
+            G = T(returns, self.device).float().reshape(-1, 1)
+        else:
+            G, advantages = self._advantages(batch, agent_num, debug=debug)
         if self.norm_advantages:
             advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
         avg_actor_loss = 0
@@ -502,10 +885,18 @@ class PG(nn.Module, Agent):
                 f"  bsize: {bsize}, Mini batch indices: {mini_batch_indices}, nbatch: {nbatch}"
             )
 
+        # Set by flatten_agents under parameter sharing
+        agent_ids = getattr(batch, "agent_ids", None)
+        if agent_ids is not None:
+            agent_actor_sums = np.zeros(batch.n_agents)
+            agent_critic_sums = np.zeros(batch.n_agents)
+            agent_counts = np.zeros(batch.n_agents)
+
         for epoch in range(self.n_epochs):
             if debug:
                 print("  Starting epoch", epoch)
             bnum = 0
+            carry = None  # recurrent state handed between minibatches
 
             while self.mini_batch_size * bnum < bsize:
                 # Get Critic Loss
@@ -521,156 +912,132 @@ class PG(nn.Module, Agent):
                         f"    Mini batch: {bstart}:{bend}, Indices: {indices}, {len(indices)}"
                     )
 
-                V_current = self.critic(batch.obs[agent_num, indices])
-                if debug:
-                    print(
-                        f"    V_current: {V_current.shape}, G[indices] {G[indices].shape}"
+                if self.recurrent:
+                    self.set_recurrent_context(batch, agent_num, indices, carry)
+                mb_mask = action_mask[indices] if action_mask is not None else None
+                if critic_only:
+                    # evaluates the critic without an optimizer step
+                    if self.recurrent:
+                        V_current, _, _ = self._actor_critic(
+                            batch.obs[agent_num, indices],
+                            action_mask=mb_mask,
+                            batch=batch,
+                            agent_num=agent_num,
+                            idx=indices,
+                        )
+                    else:
+                        V_current = self._critic_values(batch, agent_num, indices)
+                    critic_loss = (0.5 * (V_current - G[indices]) ** 2).mean()
+                    if self.recurrent:
+                        carry = self.encoder.last_hidden
+                        self.clear_recurrent_context()
+                else:
+                    update = self._update(
+                        "ppo",
+                        self._ppo_loss,
+                        self.optimizer,
+                        list(self.parameters()),
+                        0.5 if self.clip_grad else None,
                     )
-                    input()
-                # print(V_current)
-                # print(G[indices])
-                # print(V_current - G[indices])
-                # input()
-                critic_loss = 0.5 * ((V_current - G[indices]) ** 2).mean()
-                # print(torch.abs(V_current - G[indices]).mean())
-                if not critic_only:
-                    mb_adv = advantages[indices]
-
-                    actor_loss = 0
-                    cont_probs, disc_probs = self.actor(
-                        batch.obs[agent_num, indices],
-                        action_mask=action_mask,  # TODO fix action mask by indices
-                        gumbel=False,
+                    weights = torch.full(
+                        (len(indices),), 1.0 / len(indices), device=self.device
                     )
-                    if self.continuous_action_dim > 0:
-                        if debug:
-                            print(f"    cont probs: {cont_probs.shape}")
-                            print(
-                                f"    logstd: {self.actor_logstd.expand_as(cont_probs)}"
-                            )
-                            print(f"    advantages: {mb_adv[indices]}")
-                        # input("what is up with continuous probabilities")
-                        continuous_dist = torch.distributions.Normal(
-                            loc=cont_probs,
-                            scale=torch.exp(self.actor_logstd.expand_as(cont_probs)),
-                        )
-                        # print(batch.continuous_actions[agent_num, indices])
-                        continuous_log_probs = continuous_dist.log_prob(
+                    has_disc = (
+                        self.discrete_action_dims is not None
+                        and len(self.discrete_action_dims) > 0
+                    )
+                    has_cont = self.continuous_action_dim > 0
+                    _, actor_loss, critic_loss, actor_samples, critic_samples = update(
+                        weights,
+                        batch.obs[agent_num, indices],
+                        mb_mask,
+                        (
+                            batch.discrete_actions[agent_num, indices]
+                            if has_disc
+                            else None
+                        ),
+                        (
                             batch.continuous_actions[agent_num, indices]
+                            if has_cont
+                            else None
+                        ),
+                        (
+                            batch.discrete_log_probs[agent_num, indices]
+                            if has_disc and self.ppo_clip > 0
+                            else None
+                        ),
+                        (
+                            batch.continuous_log_probs[agent_num, indices]
+                            if has_cont and self.ppo_clip > 0
+                            else None
+                        ),
+                        advantages[indices],
+                        G[indices],
+                        batch=batch if self.centralized_critic else None,
+                        agent_num=agent_num,
+                        idx=indices if self.centralized_critic else None,
+                    )
+                    if self.recurrent:
+                        carry = self.encoder.last_hidden
+                        self.clear_recurrent_context()
+                    if debug:
+                        print(
+                            f"    actor_loss: {actor_loss}, critic_loss: {critic_loss}"
                         )
 
-                        if self.ppo_clip > 0:
-                            logratio = (
-                                continuous_log_probs
-                                - batch.continuous_log_probs[agent_num, indices]
-                            )
-
-                            ratio = logratio.exp()
-
-                            pg_loss1 = mb_adv * ratio
-                            pg_loss2 = mb_adv * torch.clamp(
-                                ratio, 1 - self.ppo_clip, 1 + self.ppo_clip
-                            )
-                            continuous_policy_gradient = torch.min(pg_loss1, pg_loss2)
-
-                        else:
-                            continuous_policy_gradient = continuous_log_probs * mb_adv
-
-                        if debug:
-                            print(f"    continuous_log_probs: {continuous_log_probs}")
-                            print(
-                                f"    continuous_policy_gradient: {continuous_policy_gradient}"
-                            )
-                        # print(continuous_policy_gradient)
-                        actor_loss += (
-                            -self.policy_loss * continuous_policy_gradient.mean()
-                            - self.entropy_loss * continuous_dist.entropy().mean()
-                        )
-                        # print(self.actor_logstd.exp())
-                        # print(continuous_dist.loc.mean())
-
-                    if self.discrete_action_dims is not None:
-                        for head in range(len(self.discrete_action_dims)):
-                            if debug:
-                                print(f"    Discrete head: {head}")
-                                print(f"    disc_probs: {disc_probs[head]}")
-                                print(
-                                    f"    batch.discrete_actions: {batch.discrete_actions[agent_num,indices,head]}"
-                                )
-                            probs: torch.Tensor = disc_probs[head]  # Categorical()
-                            dist = Categorical(probs=probs)
-                            entropy = dist.entropy().mean()
-                            # print(probs)
-                            # print(batch.discrete_actions[agent_num, indices, head])
-                            # selectedprobs = probs.gather(
-                            #     -1,
-                            #     batch.discrete_actions[
-                            #         agent_num, indices, head
-                            #     ].unsqueeze(-1),
-                            # ).squeeze(-1)
-                            # print(selectedprobs)
-
-                            selected_log_probs = dist.log_prob(
-                                batch.discrete_actions[agent_num, indices, head]
-                            )
-
-                            if self.ppo_clip > 0:
-
-                                logratio = (
-                                    selected_log_probs
-                                    - batch.discrete_log_probs[agent_num, indices, head]
-                                )
-                                ratio = logratio.exp()
-                                pg_loss1 = mb_adv.squeeze(-1) * ratio
-                                pg_loss2 = mb_adv.squeeze(-1) * torch.clamp(
-                                    ratio, 1 - self.ppo_clip, 1 + self.ppo_clip
-                                )
-                                discrete_policy_gradient = torch.min(pg_loss1, pg_loss2)
-                            else:
-                                discrete_policy_gradient = (
-                                    selected_log_probs * mb_adv.squeeze(-1)
-                                )
-
-                            actor_loss += (
-                                -self.policy_loss * discrete_policy_gradient.mean()
-                                - self.entropy_loss * entropy
-                            )
-
-                    # print("actor")
-                    # self.optimizer.zero_grad()
-                    # loss = actor_loss
-                    # loss.backward()
-                    # self._print_grad_norm()
-                    # print("critic")
-                    self.optimizer.zero_grad()
-                    loss = actor_loss + critic_loss * self.critic_loss_coef
-                    loss.backward()
-                    # self._print_grad_norm()
-                    # print(self.actor_logstd)
-                    # print(self.actor_logstd.grad)
-                    # self._print_grad_norm()
-
-                    if self.clip_grad:
-                        torch.nn.utils.clip_grad_norm_(
-                            self.parameters(),
-                            0.5,
-                            error_if_nonfinite=True,
-                            foreach=True,
-                        )
-
-                    self.optimizer.step()
-
                     avg_actor_loss += actor_loss.item()
                     avg_critic_loss += critic_loss.item()
+                    if agent_ids is not None:
+                        ids = agent_ids[indices]
+                        a_sums, counts = per_agent_sum(
+                            actor_samples, ids, batch.n_agents
+                        )
+                        c_sums, _ = per_agent_sum(critic_samples, ids, batch.n_agents)
+                        agent_actor_sums += a_sums
+                        agent_critic_sums += c_sums
+                        agent_counts += counts
             avg_actor_loss /= nbatch
             avg_critic_loss /= nbatch
             # print(f"actor_loss: {actor_loss.item()}")
 
         avg_actor_loss /= self.n_epochs
         avg_critic_loss /= self.n_epochs
+        if agent_ids is not None:
+            agent_counts = np.maximum(agent_counts, 1)
+            self.agent_losses = (
+                agent_actor_sums / agent_counts,
+                agent_critic_sums / agent_counts,
+            )
         # print(avg_actor_loss, critic_loss.item())
         return avg_actor_loss, avg_critic_loss
 
+    def shared_reinforcement_learn(
+        self, batch, agent_nums=None, one_hot_ids=False, critic_only=False, debug=False
+    ):
+        # Advantages are computed per agent before flattening so the GAE / return
+        # recursion never runs across the boundary between two agents' rollouts
+        assert (
+            not self.centralized_critic
+        ), "Flattened agents lose the team axis a centralized critic attends over"
+        if agent_nums is None:
+            agent_nums = list(range(len(batch.obs)))
+        selected = select_agents(
+            batch, agent_nums, len(batch.obs) if one_hot_ids else None
+        )
+        G, advantages = self._advantages(
+            selected, list(range(len(agent_nums))), debug=debug
+        )
+        flat = flatten_agents(selected)
+        aloss, closs = self.reinforcement_learn(
+            flat,
+            agent_num=0,
+            critic_only=critic_only,
+            debug=debug,
+            advantages=advantages.squeeze(-1).T.reshape(-1, 1),
+            returns=G.squeeze(-1).T.reshape(-1, 1),
+        )
+        return self._pop_agent_losses(len(agent_nums), aloss, closs)
+
     def _dump_attr(self, attr, path):
         f = open(path, "wb")
         pickle.dump(attr, f)
@@ -703,14 +1070,25 @@ class PG(nn.Module, Agent):
             checkpoint_path = "./" + self.name + "/"
 
         for i in range(len(self.attrs)):
+            # Attributes added after a checkpoint was written keep their defaults
+            if not os.path.exists(checkpoint_path + f"/{self.attrs[i]}"):
+                continue
             self.__dict__[self.attrs[i]] = self._load_attr(
                 checkpoint_path + f"/{self.attrs[i]}"
             )
+        # Action bounds are saved as tensors but MixedActor is built from numpy
+        if torch.is_tensor(self.max_actions):
+            self.max_actions = self.max_actions.cpu().numpy()
+            self.min_actions = self.min_actions.cpu().numpy()
+        self.critic_loss_coef = self.value_loss_coef
         self._get_torch_params(self.starting_actorlogstd)
         self.policy_loss = 5.0
         self.actor.load_state_dict(torch.load(checkpoint_path + "/PI"))
         self.critic.load_state_dict(torch.load(checkpoint_path + "/V"))
         self.actor_logstd = torch.load(checkpoint_path + "/actor_logstd")
+        if self.continuous_action_dim is not None and self.continuous_action_dim > 0:
+            self.min_actions = torch.from_numpy(self.min_actions).to(self.device)
+            self.max_actions = torch.from_numpy(self.max_actions).to(self.device)
 
     def __str__(self):
         st = ""
@@ -0,0 +1,764 @@
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import functional_call, grad_and_value, stack_module_state, vmap
+from torch.utils._pytree import tree_flatten, tree_unflatten
+from flexibuddiesrl.Util import T, get_multi_discrete_one_hot, upcast_batch
+from flexibuddiesrl.DQN import DQN
+from flexibuddiesrl.TD3 import TD3
+from flexibuddiesrl.PG import PG
+
+# Attributes that may differ between the members of a population besides the
+# learning rates. They reach the losses as per-member tensors, so they must
+# only be used arithmetically, never in a Python branch.
+MEMBER_HYPERPARAMS = {
+    DQN: ["gamma"],
+    TD3: ["gamma", "target_update_percentage"],
+    PG: ["gamma", "gae_lambda", "entropy_loss", "critic_loss_coef"],
+}
+
+
+def member_gae(values, last_value, rewards, terminated, gamma, gae_lambda):
+    """
+    PG._gae for every member at once. values, rewards and terminated are
+    [N, T], last_value, gamma and gae_lambda are [N]. Returns (returns,
+    advantages) [N, T].
+    """
+    advantages = torch.zeros_like(values)
+    last_gae_lam = torch.zeros_like(last_value)
+    next_values = last_value
+    for step in reversed(range(values.shape[1])):
+        next_non_terminal = 1.0 - terminated[:, step]
+        delta = (
+            rewards[:, step] + gamma * next_values * next_non_terminal - values[:, step]
+        )
+        last_gae_lam = delta + gamma * gae_lambda * next_non_terminal * last_gae_lam
+        advantages[:, step] = last_gae_lam
+        next_values = values[:, step]
+    return advantages + values, advantages
+
+
+class _Networks(nn.Module):
+    # Every network of one agent in a single module so torch.func can stack
+    # and swap them. forward(attr, ...) calls agent.attr(...), so
+    # functional_call can run any network or method of the agent.
+    def __init__(self, agent):
+        super(_Networks, self).__init__()
+        object.__setattr__(self, "agent", agent)
+        if isinstance(agent, nn.Module):
+            self.nets = nn.ModuleDict({"agent": agent})
+        else:
+            self.nets = nn.ModuleDict(
+                {k: v for k, v in vars(agent).items() if isinstance(v, nn.Module)}
+            )
+
+    def forward(self, attr, *args, **kwargs):
+        return getattr(self.agent, attr)(*args, **kwargs)
+
+
+class Population:
+    def __init__(self, agents):
+        """
+        N agents of one type trained as a single batched computation. Their
+        weights and Adam states are stacked along a leading member dim and
+        every forward, loss and optimizer step runs once for all members
+        through torch.func.vmap, using the agents' own loss functions.
+
+        agents: list
+            DQN, TD3 or PG agents built with the same arguments except for
+            seeds, lr and the attributes in MEMBER_HYPERPARAMS. Recurrent
+            agents and centralized critics are not supported.
+        """
+        self.agents = list(agents)
+        self.n = len(self.agents)
+        # the first member's modules run every member under functional_call
+        self.agent = self.agents[0]
+        kind = type(self.agent)
+        if kind not in MEMBER_HYPERPARAMS:
+            raise ValueError(f"Population supports DQN, TD3 and PG, not {kind}")
+        if any(type(a) is not kind for a in self.agents):
+            raise ValueError("Population members must all be the same agent type")
+        if not self.agent._compilable():
+            raise ValueError(
+                "Population does not support recurrent agents or centralized critics"
+            )
+        self.device = self.agent.device
+        self.nets = [_Networks(a) for a in self.agents]
+        params, buffers = stack_module_state(self.nets)
+        self.params = {k: v.detach() for k, v in params.items()}
+        self.buffers = buffers
+        self.hparams = {
+            k: torch.tensor(
+                [float(getattr(a, k)) for a in self.agents], device=self.device
+            )
+            for k in MEMBER_HYPERPARAMS[kind]
+        }
+        self.td_errors = None
+
+        # Parameter names stepped by each optimizer. Trainable tensors that
+        # are not module parameters, like PG's actor_logstd, are stacked
+        # under their attribute name and swapped onto the agent per call.
+        names = {id(p): k for k, p in self.nets[0].named_parameters()}
+        self.extras = []
+        self.groups = {}
+        self.lrs = {}
+        self.adam = {}
+        for opt_name, opt in vars(self.agent).items():
+            if not isinstance(opt, torch.optim.Optimizer):
+                continue
+            if not isinstance(opt, torch.optim.Adam) or opt.defaults["weight_decay"]:
+                raise ValueError(f"{opt_name} must be Adam without weight decay")
+            group = []
+            for p in (p for g in opt.param_groups for p in g["params"]):
+                if id(p) in names:
+                    group.append(names[id(p)])
+                    continue
+                attr = next(k for k, v in vars(self.agent).items() if v is p)
+                self.extras.append(attr)
+                self.params[attr] = torch.stack(
+                    [getattr(a, attr).detach() for a in self.agents]
+                )
+                group.append(attr)
+            self.groups[opt_name] = group
+            self.lrs[opt_name] = torch.tensor(
+                [getattr(a, opt_name).param_groups[0]["lr"] for a in self.agents],
+                device=self.device,
+            )
+            self.adam[opt_name] = {
+                "step": 0,
+                "betas": opt.defaults["betas"],
+                "eps": opt.defaults["eps"],
+                "exp_avg": {k: torch.zeros_like(self.params[k]) for k in group},
+                "exp_avg_sq": {k: torch.zeros_like(self.params[k]) for k in group},
+            }
+        self.base_lrs = {k: v.clone() for k, v in self.lrs.items()}
+
+        # (online, target) parameter names for polyak updates
+        self.targets = []
+        for attr, v in vars(self.agent).items():
+            if not attr.endswith("_target") or not isinstance(v, nn.Module):
+                continue
+            target = f"nets.{attr}."
+            online = f"nets.{attr[: -len('_target')]}."
+            self.targets += [
+                (online + k[len(target) :], k)
+                for k in self.params
+                if k.startswith(target)
+            ]
+
+    def _call(self, params, buffers, hparams, attr, *args, **kwargs):
+        # self.agent.attr(*args) with one member's weights and hyperparameters
+        agent = self.agent
+        saved = {k: getattr(agent, k) for k in list(hparams) + self.extras}
+        # argument validation of torch.distributions branches on tensor values
+        validate = torch.distributions.Distribution._validate_args
+        torch.distributions.Distribution.set_default_validate_args(False)
+        try:
+            for k, v in hparams.items():
+                setattr(agent, k, v)
+            for k in self.extras:
+                setattr(agent, k, params[k])
+            modules = {k: v for k, v in params.items() if k not in self.extras}
+            return functional_call(
+                self.nets[0], (modules, buffers), (attr,) + args, kwargs
+            )
+        finally:
+            torch.distributions.Distribution.set_default_validate_args(validate)
+            for k, v in saved.items():
+                setattr(agent, k, v)
+
+    def _vmap(self, fn, *args):
+        # None arguments, like a missing action mask, are shared by all
+        # members, and None outputs, like the logits of absent heads, are
+        # passed through around vmap
+        in_dims = tuple(None if a is None else 0 for a in args)
+        structure = {}
+
+        def flat_fn(*args):
+            outputs, spec = tree_flatten(fn(*args))
+            structure["spec"] = spec
+            structure["none"] = [x is None for x in outputs]
+            return [x for x in outputs if x is not None]
+
+        outputs = iter(vmap(flat_fn, in_dims=in_dims, randomness="different")(*args))
+        return tree_unflatten(
+            [None if none else next(outputs) for none in structure["none"]],
+            structure["spec"],
+        )
+
+    def forward(self, attr, *args, **kwargs):
+        """
+        agent.attr(*args, **kwargs) of every member without gradients, e.g.
+        forward("critic", obs). Tensor args are stacked [N, ...] and None
+        args are shared. Outputs have a leading member dim.
+        """
+
+        def member(params, buffers, hparams, *args):
+            return self._call(params, buffers, hparams, attr, *args, **kwargs)
+
+        with torch.no_grad():
+            return self._vmap(member, self.params, self.buffers, self.hparams, *args)
+
+    def _grad(self, loss_fn, group, *args, **kwargs):
+        # Per-member gradients of loss_fn's loss with respect to the params
+        # in group, and every output of loss_fn stacked [N, ...]
+        def member(train, frozen, buffers, hparams, *args):
+            outputs = self._call(
+                {**frozen, **train}, buffers, hparams, loss_fn, *args, **kwargs
+            )
+            return outputs[0], outputs
+
+        train = {k: self.params[k] for k in group}
+        frozen = {k: v for k, v in self.params.items() if k not in train}
+        grads, (_, outputs) = self._vmap(
+            grad_and_value(member, has_aux=True),
+            train,
+            frozen,
+            self.buffers,
+            self.hparams,
+            *args,
+        )
+        return grads, outputs
+
+    def _member_view(self, x, like):
+        # [N] per-member values shaped to broadcast against like [N, ...]
+        return x.view((self.n,) + (1,) * (like.dim() - 1))
+
+    def _step(self, opt_name, grads, clip_grad=None):
+        # torch.optim.Adam on the stacked params with a learning rate and a
+        # gradient norm clip per member. Like the agents, only module
+        # parameters are clipped.
+        names = self.groups[opt_name]
+        if clip_grad is not None and clip_grad > 0:
+            clipped = [k for k in names if k not in self.extras]
+            norms = torch.stack(
+                [grads[k].reshape(self.n, -1).norm(dim=-1) for k in clipped]
+            ).norm(dim=0)
+            coef = (clip_grad / (norms + 1e-6)).clamp(max=1.0)
+            grads = dict(grads)
+            for k in clipped:
+                grads[k] = grads[k] * self._member_view(coef, grads[k])
+        grads = [grads[k] for k in names]
+        state = self.adam[opt_name]
+        state["step"] += 1
+        beta1, beta2 = state["betas"]
+        bias_correction1 = 1 - beta1 ** state["step"]
+        bias_correction2_sqrt = math.sqrt(1 - beta2 ** state["step"])
+        step_size = self.lrs[opt_name] / bias_correction1
+        for k, g in zip(names, grads):
+            exp_avg = state["exp_avg"][k]
+            exp_avg_sq = state["exp_avg_sq"][k]
+            exp_avg.lerp_(g, 1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(g, g, value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(state["eps"])
+            self.params[k].sub_(self._member_view(step_size, g) * exp_avg / denom)
+
+    def _polyak(self, tau):
+        for online, target in self.targets:
+            t = self._member_view(tau, self.params[target])
+            self.params[target].mul_(1 - t).add_(t * self.params[online])
+
+    def _stack(self, batch, get):
+        # get(b) of each member's batch stacked [N, ...], or of one batch
+        # shared by every member. None when get returns None.
+        if isinstance(batch, (list, tuple)):
+            xs = [get(b) for b in batch]
+            return None if xs[0] is None else torch.stack(xs)
+        x = get(batch)
+        return None if x is None else x.expand((self.n,) + x.shape)
+
+    def _weights(self, batch, importance=True):
+        def w(b):
+            bsize = b.global_rewards.shape[0]
+            weights = torch.full((bsize,), 1.0 / bsize, device=self.device)
+            is_weights = getattr(b, "is_weights", None)
+            if importance and is_weights is not None:
+                weights = weights * is_weights
+            return weights
+
+        return self._stack(batch, w)
+
+    def train_actions(
+        self, observations, action_mask=None, step=False, return_value=False
+    ):
+        """
+        Acts for every member. observations are [N, obs_dim] or [N, n_envs,
+        obs_dim] with one row of envs per member, and action_mask matches
+        them or is None. Returns the agents' train_actions tuple with a
+        leading member dim on each array.
+        """
+        observations = T(observations, self.device).float()
+        if action_mask is not None:
+            action_mask = T(action_mask, self.device).float()
+        n_rows = observations.shape[1] if observations.dim() > 2 else 1
+        if isinstance(self.agent, DQN):
+            return self._dqn_actions(observations, action_mask, step, n_rows)
+        if isinstance(self.agent, TD3):
+            return self._td3_actions(observations, action_mask, step, n_rows)
+        return self._pg_actions(observations, action_mask, step, n_rows, return_value)
+
+    def _dqn_actions(self, observations, action_mask, step, n_rows):
+        agent = self.agent
+        lead = observations.shape[:-1]
+        if agent.init_eps > 0.0:
+            agent.eps = agent.init_eps * (
+                1 - agent.step / (agent.step + agent.eps_decay_half_life)
+            )
+        _, dq, cq = self.forward("Q1", observations, action_mask)
+        disc_act, cont_act = None, None
+        if len(agent.discrete_action_dims) > 0:
+            disc_act = (
+                torch.stack([torch.argmax(d, dim=-1) for d in dq], dim=-1)
+                .cpu()
+                .numpy()
+                .astype(np.int32)
+            )
+        if agent.continuous_action_dims > 0:
+            cont_act = (
+                (
+                    (
+                        torch.argmax(torch.stack(cq, dim=-2), dim=-1)
+                        / (agent.n_c_action_bins - 1)
+                        - 0.5
+                    )
+                    * agent.action_ranges
+                    + agent.action_means
+                )
+                .cpu()
+                .numpy()
+            )
+        explore = np.random.rand(*lead) < agent.eps if agent.init_eps > 0.0 else None
+        if explore is not None and explore.any():
+            k = int(explore.sum())
+            if disc_act is not None:
+                disc_act[explore] = np.stack(
+                    [
+                        np.random.randint(0, d, size=k)
+                        for d in agent.discrete_action_dims
+                    ],
+                    axis=-1,
+                )
+            if cont_act is not None:
+                cont_act[explore] = (
+                    np.random.rand(k, agent.continuous_action_dims) - 0.5
+                ) * agent.np_action_ranges + agent.np_action_means
+        for a in self.agents:
+            a.eps = agent.eps
+            a.step += n_rows * int(step)
+        return disc_act, cont_act, 0, 0, 0
+
+    def _td3_actions(self, observations, action_mask, step, n_rows):
+        agent = self.agent
+        lead = observations.shape[:-1]
+        if step:
+            for a in self.agents:
+                a.step += n_rows
+        if agent.step < agent.rand_steps:
+            discrete_actions, continuous_actions = agent._get_random_actions(
+                n=int(np.prod(lead))
+            )
+            return (
+                discrete_actions.reshape(lead + (-1,)).cpu().numpy(),
+                continuous_actions.reshape(lead + (-1,)).cpu().numpy(),
+                None,
+                None,
+                None,
+            )
+        continuous_actions, discrete_activations = self.forward(
+            "actor", observations, action_mask, gumbel=True
+        )
+        with torch.no_grad():
+            continuous_actions = agent._add_noise(continuous_actions)
+        discrete_actions = torch.stack(
+            [torch.argmax(d, dim=-1) for d in discrete_activations], dim=-1
+        )
+        return (
+            discrete_actions.cpu().numpy(),
+            continuous_actions.cpu().numpy(),
+            None,
+            None,
+            0,
+        )
+
+    def _pg_actions(self, observations, action_mask, step, n_rows, return_value):
+        agent = self.agent
+        if step:
+            for a in self.agents:
+                a.steps += n_rows
+        if agent.anneal_lr > 0:
+            frac = max(1.0 - (agent.steps - 1.0) / agent.anneal_lr, 0.001)
+            self.lrs["optimizer"] = frac * self.base_lrs["optimizer"]
+        value = 0
+        if return_value:
+            value, continuous_logits, discrete_logits = self.forward(
+                "_actor_critic", observations, action_mask
+            )
+            value = value.cpu().numpy()
+        else:
+            continuous_logits, discrete_logits = self.forward(
+                "actor", observations, action_mask, logits=True
+            )
+        continuous_actions, continuous_log_probs = None, None
+        if agent.continuous_action_dim > 0:
+            logstd = self.params["actor_logstd"].reshape(
+                (self.n,) + (1,) * (continuous_logits.dim() - 2) + (-1,)
+            )
+            dist = torch.distributions.Normal(
+                loc=continuous_logits, scale=torch.exp(logstd)
+            )
+            continuous_actions = dist.sample()
+            continuous_log_probs = dist.log_prob(continuous_actions).cpu().numpy()
+            continuous_actions = continuous_actions.cpu().numpy()
+        discrete_actions, discrete_log_probs = None, None
+        if agent.discrete_action_dims is not None:
+            discrete_actions, discrete_log_probs = agent._sample_multi_discrete(
+                discrete_logits
+            )
+            discrete_actions = discrete_actions.cpu().numpy()
+            discrete_log_probs = discrete_log_probs.cpu().numpy()
+        return (
+            discrete_actions,
+            continuous_actions,
+            discrete_log_probs,
+            continuous_log_probs,
+            value,
+        )
+
+    def reinforcement_learn(self, batch, agent_num=0, critic_only=False):
+        """
+        One reinforcement_learn step of every member.
+
+        batch: FlexiBatch or list
+            One batch shared by all members, or a list of N batches of the
+            same size, one per member
+        Returns (actor_losses, critic_losses) as [N] arrays. Per-member
+        |td errors| [N, B] are left in self.td_errors for DQN and TD3.
+        """
+        if isinstance(batch, (list, tuple)):
+            batch = [upcast_batch(b) for b in batch]
+        else:
+            batch = upcast_batch(batch)
+        if isinstance(self.agent, DQN):
+            losses = self._dqn_learn(batch, agent_num)
+        elif isinstance(self.agent, TD3):
+            losses = self._td3_learn(batch, agent_num, critic_only)
+        else:
+            losses = self._pg_learn(batch, agent_num, critic_only)
+        return tuple(np.asarray(torch.as_tensor(l).cpu()) for l in losses)
+
+    def _dqn_learn(self, batch, agent_num):
+        agent = self.agent
+        discrete_dims = agent.discrete_action_dims
+        continuous_dims = agent.continuous_action_dims
+        discrete_actions = None
+        if discrete_dims is not None and len(discrete_dims) > 0:
+            discrete_actions = self._stack(
+                batch, lambda b: b.discrete_actions[agent_num]
+            )
+        continuous_actions = None
+        if continuous_dims is not None and continuous_dims > 0:
+            continuous_actions = self._stack(
+                batch, lambda b: b.continuous_actions[agent_num]
+            )
+        grads, (_, dqloss, cqloss, dq_samples, cq_samples) = self._grad(
+            "_td_loss",
+            self.groups["optimizer"],
+            self._weights(batch),
+            self._stack(batch, lambda b: b.obs[agent_num]),
+            self._stack(batch, lambda b: b.obs_[agent_num]),
+            discrete_actions,
+            continuous_actions,
+            self._stack(batch, lambda b: b.global_rewards),
+            self._stack(batch, lambda b: b.terminated),
+        )
+        self._step("optimizer", grads, agent.clip_grad)
+        self.td_errors = dq_samples.clamp(min=0).sqrt() + cq_samples.clamp(min=0).sqrt()
+        return dqloss, cqloss
+
+    def _td3_learn(self, batch, agent_num, critic_only):
+        agent = self.agent
+        for a in self.agents:
+            a.rl_step += 1
+        mask, mask_ = None, None
+        first = batch[0] if isinstance(batch, (list, tuple)) else batch
+        if first.action_mask is not None:
+            mask = self._stack(batch, lambda b: b.action_mask[agent_num])
+            mask_ = self._stack(batch, lambda b: b.action_mask_[agent_num])
+        obs = self._stack(batch, lambda b: b.obs[agent_num])
+        actions = self._stack(
+            batch,
+            lambda b: torch.cat(
+                [
+                    b.continuous_actions[agent_num],
+                    get_multi_discrete_one_hot(
+                        b.discrete_actions[agent_num],
+                        discrete_action_dims=agent.discrete_action_dims,
+                    ),
+                ],
+                dim=-1,
+            ),
+        )
+        grads, (critic_loss, td_errors, _) = self._grad(
+            "_critic_loss",
+            self.groups["critic_optimizer"],
+            self._weights(batch),
+            obs,
+            self._stack(batch, lambda b: b.obs_[agent_num]),
+            mask_,
+            actions,
+            self._stack(batch, lambda b: b.global_rewards),
+            self._stack(batch, lambda b: b.terminated),
+        )
+        self._step("critic_optimizer", grads)
+        self.td_errors = td_errors
+        actor_loss = torch.zeros(self.n)
+        if agent.rl_step % agent.policy_frequency == 0 and not critic_only:
+            grads, (actor_loss, _) = self._grad(
+                "_actor_loss",
+                self.groups["actor_optimizer"],
+                self._weights(batch, importance=False),
+                obs,
+                mask,
+            )
+            self._step("actor_optimizer", grads)
+            self._polyak(self.hparams["target_update_percentage"])
+        return actor_loss.detach(), critic_loss.detach()
+
+    def _pg_learn(self, batch, agent_num, critic_only):
+        agent = self.agent
+        if agent.advantage_type != "gae":
+            raise ValueError("Population only supports PG with advantage_type 'gae'")
+        avg_actor_loss = torch.zeros(self.n)
+        avg_critic_loss = torch.zeros(self.n)
+        if critic_only:
+            # PG.reinforcement_learn takes no optimizer step either
+            return avg_actor_loss, avg_critic_loss
+        obs = self._stack(batch, lambda b: b.obs[agent_num])
+        stored = self._stack(
+            batch,
+            lambda b: (
+                T(b.values[agent_num], self.device).float()
+                if getattr(b, "values", None) is not None
+                else None
+            ),
+        )
+        values = (
+            stored if stored is not None else self.forward("critic", obs).squeeze(-1)
+        )
+        last_value = self.forward(
+            "critic", self._stack(batch, lambda b: b.obs_[agent_num, -1])
+        ).squeeze(-1)
+        G, advantages = member_gae(
+            values,
+            last_value,
+            self._stack(batch, lambda b: b.global_rewards),
+            self._stack(batch, lambda b: b.terminated),
+            self.hparams["gamma"],
+            self.hparams["gae_lambda"],
+        )
+        G, advantages = G.unsqueeze(-1), advantages.unsqueeze(-1)
+        if agent.norm_advantages:
+            advantages = (advantages - advantages.mean(dim=(1, 2), keepdim=True)) / (
+                advantages.std(dim=(1, 2), keepdim=True) + 1e-8
+            )
+
+        has_disc = (
+            agent.discrete_action_dims is not None
+            and len(agent.discrete_action_dims) > 0
+        )
+        has_cont = agent.continuous_action_dim > 0
+        clipped = agent.ppo_clip > 0
+        action_mask = self._stack(
+            batch,
+            lambda b: (b.action_mask[agent_num] if b.action_mask is not None else None),
+        )
+        discrete_actions = self._stack(
+            batch, lambda b: b.discrete_actions[agent_num] if has_disc else None
+        )
+        continuous_actions = self._stack(
+            batch, lambda b: b.continuous_actions[agent_num] if has_cont else None
+        )
+        discrete_log_probs = self._stack(
+            batch,
+            lambda b: b.discrete_log_probs[agent_num] if has_disc and clipped else None,
+        )
+        continuous_log_probs = self._stack(
+            batch,
+            lambda b: (
+                b.continuous_log_probs[agent_num] if has_cont and clipped else None
+            ),
+        )
+
+        def rows(x, indices):
+            return None if x is None else x[:, indices]
+
+        # the same minibatches and loss averaging as PG.reinforcement_learn
+        bsize = obs.shape[1]
+        nbatch = bsize // agent.mini_batch_size
+        for epoch in range(agent.n_epochs):
+            bnum = 0
+            while agent.mini_batch_size * bnum < bsize:
+                bstart = agent.mini_batch_size * bnum
+                bend = min(bstart + agent.mini_batch_size, bsize - 1)
+                indices = np.arange(bsize)[bstart:bend]
+                bnum += 1
+                weights = torch.full(
+                    (self.n, len(indices)), 1.0 / len(indices), device=self.device
+                )
+                grads, (_, actor_loss, critic_loss, _, _) = self._grad(
+                    "_ppo_loss",
+                    self.groups["optimizer"],
+                    weights,
+                    obs[:, indices],
+                    rows(action_mask, indices),
+                    rows(discrete_actions, indices),
+                    rows(continuous_actions, indices),
+                    rows(discrete_log_probs, indices),
+                    rows(continuous_log_probs, indices),
+                    advantages[:, indices],
+                    G[:, indices],
+                )
+                self._step("optimizer", grads, 0.5 if agent.clip_grad else None)
+                avg_actor_loss += actor_loss.cpu()
+                avg_critic_loss += critic_loss.cpu()
+            avg_actor_loss /= nbatch
+            avg_critic_loss /= nbatch
+        return avg_actor_loss / agent.n_epochs, avg_critic_loss / agent.n_epochs
+
+    def member(self, i):
+        """
+        Agent i with the population's current weights, Adam state and
+        learning rates written back into it, e.g. for agent.save(path) or
+        to keep training it on its own. Returns the agent.
+        """
+        agent = self.agents[i]
+        with torch.no_grad():
+            for k, p in self.nets[i].named_parameters():
+                p.copy_(self.params[k][i])
+            for k, b in self.nets[i].named_buffers():
+                b.copy_(self.buffers[k][i])
+            for k in self.extras:
+                getattr(agent, k).copy_(self.params[k][i])
+            for opt_name, names in self.groups.items():
+                opt = getattr(agent, opt_name)
+                state = self.adam[opt_name]
+                for g in opt.param_groups:
+                    g["lr"] = float(self.lrs[opt_name][i])
+                if state["step"] == 0:
+                    continue
+                params = [p for g in opt.param_groups for p in g["params"]]
+                for p, k in zip(params, names):
+                    opt.state[p] = {
+                        "step": torch.tensor(float(state["step"])),
+                        "exp_avg": state["exp_avg"][k][i].clone(),
+                        "exp_avg_sq": state["exp_avg_sq"][k][i].clone(),
+                    }
+        return agent
+
+
+if __name__ == "__main__":
+    import time
+    from flexibuddiesrl.Buffer import ReplayBuffer
+
+    lo = np.array([-2.0], dtype=np.float32)
+    hi = np.array([2.0], dtype=np.float32)
+    n = 2000
+    rb = ReplayBuffer(n, 7, discrete_action_dims=[3], continuous_action_dim=1)
+    rb.add(
+        obs=np.random.rand(n, 7),
+        obs_=np.random.rand(n, 7),
+        discrete_actions=np.random.randint(0, 3, (n, 1)),
+        continuous_actions=np.random.uniform(-2, 2, (n, 1)),
+        discrete_log_probs=np.log(np.full((n, 1), 1 / 3)),
+        continuous_log_probs=np.random.uniform(-2, 0, (n, 1)),
+        global_rewards=np.random.rand(n),
+        terminated=np.random.rand(n) < 0.05,
+    )
+    agents = {
+        "DQN": lambda lr, gamma: DQN(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dims=1,
+            min_actions=lo,
+            max_actions=hi,
+            dueling=True,
+            hidden_dims=[64, 64],
+            lr=lr,
+            gamma=gamma,
+        ),
+        "TD3": lambda lr, gamma: TD3(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dim=1,
+            min_actions=lo,
+            max_actions=hi,
+            hidden_dims=[64, 64],
+            policy_frequency=1,
+            rand_steps=0,
+            gamma=gamma,
+        ),
+        "PG": lambda lr, gamma: PG(
+            obs_dim=7,
+            discrete_action_dims=[3],
+            continuous_action_dim=1,
+            min_actions=lo,
+            max_actions=hi,
+            hidden_dims=[64, 64],
+            mini_batch_size=64,
+            n_epochs=2,
+            lr=lr,
+            gamma=gamma,
+        ),
+    }
+    for name, make in agents.items():
+        for size in [8, 16]:
+            lrs = np.geomspace(1e-4, 1e-2, size)
+            gammas = np.linspace(0.9, 0.99, size)
+
+            def members():
+                out = []
+                for seed in range(size):
+                    torch.manual_seed(seed)
+                    out.append(make(lrs[seed], gammas[seed]))
+                return out
+
+            solo = members()
+            pop = Population(members())
+            batches = [rb.sample_transitions(256) for _ in range(size)]
+            # DQN and PG are deterministic given the batch, so each member's
+            # losses match its agent trained alone. TD3 draws its own noise.
+            for step in range(3):
+                p = pop.reinforcement_learn(batches)
+                s = np.array(
+                    [a.reinforcement_learn(b) for a, b in zip(solo, batches)]
+                ).T
+                err = np.abs(p - s).max()
+                print(f"{name} members: {size} step: {step} max loss diff: {err:.2e}")
+                if name != "TD3":
+                    assert np.allclose(p, s, rtol=1e-3, atol=1e-4), "loss mismatch"
+
+            start = time.time()
+            for _ in range(10):
+                for a, b in zip(solo, batches):
+                    a.reinforcement_learn(b)
+            solo_rate = 10 / (time.time() - start)
+            start = time.time()
+            for _ in range(10):
+                pop.reinforcement_learn(batches)
+            pop_rate = 10 / (time.time() - start)
+            obs = torch.rand(size, 16, 7)
+            start = time.time()
+            for _ in range(50):
+                for a, o in zip(solo, obs):
+                    a.train_actions(o)
+            solo_acts = 50 / (time.time() - start)
+            start = time.time()
+            for _ in range(50):
+                pop.train_actions(obs)
+            pop_acts = 50 / (time.time() - start)
+            print(
+                f"{name} members: {size} population updates/sec: {pop_rate:.1f} "
+                f"one at a time: {solo_rate:.1f}, acting steps/sec: {pop_acts:.1f} "
+                f"one at a time: {solo_acts:.1f}"
+            )
@@ -0,0 +1,364 @@
+import time
+import numpy as np
+import torch
+import gymnasium as gym
+from flexibuff import FlexiBatch
+from flexibuddiesrl.PG import PG
+from flexibuddiesrl.Buffer import ReplayBuffer, PrioritizedReplayBuffer
+
+
+class VectorRunner:
+    def __init__(
+        self,
+        agent,
+        env_fns=None,
+        env=None,
+        asynchronous=False,
+        online=None,
+        rollout_len=128,
+        buffer_size=100000,
+        batch_size=256,
+        learning_starts=1000,
+        utd_ratio=1.0,
+        prioritized=False,
+        store_next_obs=True,
+        device="cpu",
+        seed=None,
+        log_interval=10,
+        debug=False,
+    ):
+        """
+        agent: Agent
+            Any flexibuddies agent, train_actions is called once per vector
+            step with [n_envs, obs_dim] observations
+        env_fns: list
+            Callables making one gymnasium env each, wrapped in a
+            SyncVectorEnv or AsyncVectorEnv
+        env: gym.vector.VectorEnv
+            Already built vector env, used instead of env_fns
+        online: bool
+            On-policy rollouts with GAE over each rollout (default for PG) or an
+            off-policy replay buffer
+        rollout_len: int
+            Vector steps per on-policy rollout
+        utd_ratio: float
+            Off-policy gradient updates per stored env transition, replay
+            lives in a ReplayBuffer on device
+        prioritized: bool
+            Use a PrioritizedReplayBuffer, priorities come from agent.td_errors
+        store_next_obs: bool
+            False keeps a single obs stream in replay, see ReplayBuffer
+        log_interval: int
+            Print a summary every log_interval finished episodes, 0 for quiet
+
+        Gymnasium vector envs autoreset on the step after an episode ends.
+        That step's action is ignored by the env so it is not stored.
+        Truncated episodes are bootstrapped from V(final obs) on-policy and
+        stored as not terminated off-policy.
+        """
+        assert (env_fns is None) != (env is None), "Pass one of env_fns or env"
+        if env is None:
+            env = (
+                gym.vector.AsyncVectorEnv(env_fns)
+                if asynchronous
+                else gym.vector.SyncVectorEnv(env_fns)
+            )
+        self.envs = env
+        self.n_envs = env.num_envs
+        self.agent = agent
+        self.online = isinstance(agent, PG) if online is None else online
+        self.rollout_len = rollout_len
+        self.batch_size = batch_size
+        self.learning_starts = learning_starts
+        self.utd_ratio = utd_ratio
+        self.prioritized = prioritized
+        self.device = device
+        self.seed = seed
+        self.log_interval = log_interval
+        self.debug = debug
+
+        self.obs_dim = int(np.prod(env.single_observation_space.shape))
+        self._action_layout(env.single_action_space)
+        if self.online:
+            L, E = rollout_len, self.n_envs
+            self.roll = {
+                "obs": np.zeros((L, E, self.obs_dim), dtype=np.float32),
+                "discrete_actions": np.zeros((L, E, self.n_discrete), dtype=np.int64),
+                "discrete_log_probs": np.zeros(
+                    (L, E, self.n_discrete), dtype=np.float32
+                ),
+                "continuous_actions": np.zeros(
+                    (L, E, self.continuous_action_dim), dtype=np.float32
+                ),
+                "continuous_log_probs": np.zeros(
+                    (L, E, self.continuous_action_dim), dtype=np.float32
+                ),
+                "global_rewards": np.zeros((L, E), dtype=np.float32),
+                "terminated": np.zeros((L, E), dtype=np.float32),
+                "values": np.zeros((L, E), dtype=np.float32),
+            }
+            self.valid = np.zeros((L, E), dtype=bool)
+            self.truncated = np.zeros((L, E), dtype=bool)
+        else:
+            self.buffer = (PrioritizedReplayBuffer if prioritized else ReplayBuffer)(
+                buffer_size,
+                self.obs_dim,
+                discrete_action_dims=self.discrete_action_dims,
+                continuous_action_dim=self.continuous_action_dim,
+                store_next_obs=store_next_obs,
+                device=device,
+            )
+
+    def _action_layout(self, space):
+        # where the agent's (discrete, continuous) actions go in an env action
+        self.discrete_action_dims = []
+        self.continuous_action_dim = 0
+        parts = space.spaces if isinstance(space, gym.spaces.Tuple) else (space,)
+        for p in parts:
+            if isinstance(p, gym.spaces.Discrete):
+                self.discrete_action_dims.append(int(p.n))
+            elif isinstance(p, gym.spaces.MultiDiscrete):
+                self.discrete_action_dims += [int(n) for n in p.nvec.reshape(-1)]
+            elif isinstance(p, gym.spaces.Box):
+                self.continuous_action_dim += int(np.prod(p.shape))
+                self.low, self.high = p.low, p.high
+            else:
+                raise ValueError(f"Unsupported action space {p}")
+        self.n_discrete = len(self.discrete_action_dims)
+        self.space = space
+
+    def _env_actions(self, d, c):
+        def part(p, d, c):
+            if isinstance(p, gym.spaces.Discrete):
+                return d[:, 0].astype(np.int64)
+            if isinstance(p, gym.spaces.MultiDiscrete):
+                return d.astype(np.int64)
+            return np.clip(c, self.low, self.high).reshape((-1,) + p.shape)
+
+        if isinstance(self.space, gym.spaces.Tuple):
+            out = []
+            di = 0
+            for p in self.space.spaces:
+                nd = (
+                    1
+                    if isinstance(p, gym.spaces.Discrete)
+                    else len(p.nvec) if isinstance(p, gym.spaces.MultiDiscrete) else 0
+                )
+                out.append(part(p, d[:, di : di + nd] if d is not None else None, c))
+                di += nd
+            return tuple(out)
+        return part(self.space, d, c)
+
+    def _column(self, x, width):
+        # agents return 0 or None for quantities they do not produce
+        if width == 0 or x is None or np.ndim(x) == 0:
+            return None
+        return np.asarray(x).reshape(self.n_envs, width)
+
+    def _flat_obs(self, obs):
+        return np.asarray(obs, dtype=np.float32).reshape(self.n_envs, self.obs_dim)
+
+    def _finish_episodes(self, done):
+        for e in np.nonzero(done)[0]:
+            self.episode_returns.append(float(self.ep_ret[e]))
+            self.ep_ret[e] = 0
+            if self.log_interval and len(self.episode_returns) % self.log_interval == 0:
+                print(
+                    f"n_ep: {len(self.episode_returns)} r: {np.mean(self.episode_returns[-self.log_interval:]):.2f}, step: {self.env_steps}, updates: {self.updates}"
+                )
+
+    def _act(self, obs, return_value=False):
+        if return_value:
+            return self.agent.train_actions(obs, step=True, return_value=True)
+        return self.agent.train_actions(obs, step=True, debug=self.debug)
+
+    def _vector_step(self, d, c):
+        obs_, r, term, trunc, _ = self.envs.step(self._env_actions(d, c))
+        valid = ~self.skip
+        # envs that just autoreset start fresh recurrent state
+        if self.skip.any() and hasattr(self.agent, "reset_hidden"):
+            self.agent.reset_hidden(self.skip)
+        done = np.logical_or(term, trunc) & valid
+        self.ep_ret += np.asarray(r) * valid
+        self.env_steps += int(valid.sum())
+        self.skip = done
+        return self._flat_obs(obs_), np.asarray(r, dtype=np.float32), term, trunc, valid
+
+    def _off_policy_step(self):
+        d, c, dlp, clp, _ = self._act(self.obs)
+        d = self._column(d, self.n_discrete)
+        c = self._column(c, self.continuous_action_dim)
+        obs_, r, term, trunc, valid = self._vector_step(d, c)
+        n = self.buffer.add(
+            obs=self.obs,
+            obs_=obs_,
+            global_rewards=r,
+            terminated=term,  # truncation still bootstraps from obs_
+            episode_ends=np.logical_or(term, trunc),
+            discrete_actions=d,
+            continuous_actions=c,
+            discrete_log_probs=self._column(dlp, self.n_discrete),
+            continuous_log_probs=self._column(clp, self.continuous_action_dim),
+            rows=valid,
+        )
+        self._finish_episodes(self.skip)
+        self.obs = obs_
+        if len(self.buffer) < self.learning_starts:
+            return
+        if not self.ready:
+            # without store_next_obs the first rows wait a step for obs_
+            self.ready = bool(self.buffer.sampleable.any())
+            if not self.ready:
+                return
+        self.updates_due += n * self.utd_ratio
+        t0 = time.time()
+        n_updates = int(self.updates_due)
+        if n_updates > 0:
+            # one sample for all updates due, sliced into minibatches on device
+            batch = self.buffer.sample_transitions(self.batch_size * n_updates)
+            self.losses.append(self.agent.learn_many(batch, n_updates, self.batch_size))
+            if self.prioritized:
+                self.buffer.update_priorities(batch.indices, self.agent.td_errors)
+            self.updates += n_updates
+            self.updates_due -= n_updates
+        self.update_time += time.time() - t0
+
+    def _rollout(self):
+        E = self.n_envs
+        self.valid[:] = False
+        for t in range(self.rollout_len):
+            d, c, dlp, clp, v = self._act(self.obs, return_value=True)
+            self.roll["values"][t] = np.asarray(v).reshape(E)
+            d = self._column(d, self.n_discrete)
+            c = self._column(c, self.continuous_action_dim)
+            self.roll["obs"][t] = self.obs
+            if d is not None:
+                self.roll["discrete_actions"][t] = d
+                self.roll["discrete_log_probs"][t] = self._column(dlp, self.n_discrete)
+            if c is not None:
+                self.roll["continuous_actions"][t] = c
+                self.roll["continuous_log_probs"][t] = self._column(
+                    clp, self.continuous_action_dim
+                )
+            obs_, r, term, trunc, valid = self._vector_step(d, c)
+            self.roll["global_rewards"][t] = r
+            self.roll["terminated"][t] = np.logical_or(term, trunc)
+            self.valid[t] = valid
+            self.truncated[t] = trunc & ~term & valid
+            self._finish_episodes(self.skip)
+            self.obs = obs_
+
+        with torch.no_grad():
+            last_v = (
+                self.agent.utility_function(self.obs).reshape(E).detach().cpu().numpy()
+            )
+        G, A = self._rollout_gae(last_v)
+        env_idx, t_idx = self._rollout_rows()
+        return G[t_idx, env_idx], A[t_idx, env_idx]
+
+    def _rollout_gae(self, last_v):
+        # GAE over the whole [L, E] rollout at once, envs in the agent axis
+        # of the agent's chunked _gae. The obs after a truncated step is its
+        # final obs, so V(final obs) is the next step's value and is folded
+        # into the reward. Invalid (autoreset) steps are cut off as terminal.
+        values = self.roll["values"]
+        next_v = np.concatenate([values[1:], last_v[None]])
+        rewards = self.roll["global_rewards"] + self.truncated * (
+            self.agent.gamma * next_v
+        )
+        cut = (self.roll["terminated"] > 0.5) | ~self.valid
+        batch = FlexiBatch(
+            global_rewards=torch.from_numpy(rewards).to(self.device),
+            terminated=torch.from_numpy(cut.astype(np.float32)).to(self.device),
+        )
+        batch.values = torch.from_numpy(values.T).to(self.device)
+        G, A = self.agent._gae(
+            batch,
+            list(range(self.n_envs)),
+            next_values=torch.from_numpy(last_v).to(self.device),
+        )
+        return G.squeeze(-1), A.squeeze(-1)
+
+    def _rollout_rows(self):
+        # env-major so each env's steps stay contiguous and time ordered
+        env_idx, t_idx = np.nonzero(self.valid.T)
+        return env_idx, t_idx
+
+    def _rollout_batch(self):
+        env_idx, t_idx = self._rollout_rows()
+
+        def col(name, agent=True):
+            x = self.roll[name]
+            if x.ndim == 3 and x.shape[-1] == 0:
+                return None
+            x = torch.from_numpy(x[t_idx, env_idx]).to(self.device)
+            return x.unsqueeze(0) if agent else x
+
+        batch = FlexiBatch(
+            obs=col("obs"),
+            global_rewards=col("global_rewards", agent=False),
+            terminated=col("terminated", agent=False),
+            discrete_actions=col("discrete_actions"),
+            discrete_log_probs=col("discrete_log_probs"),
+            continuous_actions=col("continuous_actions"),
+            continuous_log_probs=col("continuous_log_probs"),
+        )
+        starts = np.ones(len(env_idx), dtype=bool)
+        starts[1:] = (env_idx[1:] != env_idx[:-1]) | (
+            self.roll["terminated"][t_idx[:-1], env_idx[:-1]] > 0.5
+        )
+        batch.episode_starts = torch.from_numpy(starts).to(self.device)
+        return batch
+
+    def run(self, total_steps, callback=None):
+        """
+        Steps the vector env until total_steps valid env transitions have
+        been collected, learning along the way. callback(runner) is called
+        after every rollout (on-policy) or vector step (off-policy) and
+        ends the run early by returning True.
+
+        Returns a dict with env_steps, updates, env_steps_per_sec,
+        updates_per_sec, episode_returns and losses.
+        """
+        self.obs = self._flat_obs(self.envs.reset(seed=self.seed)[0])
+        if hasattr(self.agent, "reset_hidden"):
+            self.agent.reset_hidden()
+        self.skip = np.zeros(self.n_envs, dtype=bool)
+        self.ep_ret = np.zeros(self.n_envs)
+        self.episode_returns = []
+        self.losses = []
+        self.env_steps = 0
+        self.updates = 0
+        self.updates_due = 0.0
+        self.ready = self.online
+        self.update_time = 0.0
+        start = time.time()
+        while self.env_steps < total_steps:
+            if self.online:
+                G, A = self._rollout()
+                batch = self._rollout_batch()
+                t0 = time.time()
+                self.losses.append(
+                    self.agent.reinforcement_learn(
+                        batch, agent_num=0, advantages=A, returns=G
+                    )
+                )
+                self.update_time += time.time() - t0
+                self.updates += 1
+            else:
+                self._off_policy_step()
+            if callback is not None and callback(self):
+                break
+        elapsed = time.time() - start
+        return {
+            "env_steps": self.env_steps,
+            "updates": self.updates,
+            "env_steps_per_sec": self.env_steps / max(elapsed - self.update_time, 1e-9),
+            "updates_per_sec": self.updates / max(self.update_time, 1e-9),
+            "wall_time": elapsed,
+            "episode_returns": self.episode_returns,
+            "losses": self.losses,
+        }
+
+    def close(self):
+        self.envs.close()
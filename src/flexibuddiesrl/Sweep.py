@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+from flexibuddiesrl.DQN import DQN
+from flexibuddiesrl.TD3 import TD3
+from flexibuddiesrl.DDPG import DDPG
+from flexibuddiesrl.PG import PG
+from flexibuddiesrl.Runner import VectorRunner
+
+AGENTS = {"DQN": DQN, "TD3": TD3, "DDPG": DDPG, "PG": PG}
+
+
+def grid(space):
+    """
+    Every combination of a search space {kwarg: [values]} as a list of
+    kwargs dicts.
+    """
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*space.values())]
+
+
+def log_uniform(low, high):
+    # A random_search distribution, e.g. {"lr": log_uniform(1e-4, 1e-2)}
+    return lambda rng: float(np.exp(rng.uniform(np.log(low), np.log(high))))
+
+
+def uniform(low, high):
+    return lambda rng: float(rng.uniform(low, high))
+
+
+def random_search(space, n_trials, seed=None):
+    """
+    n_trials kwargs dicts drawn from a search space. Each value of space is
+    a list to pick from uniformly or a callable rng -> value such as
+    log_uniform(1e-4, 1e-2).
+    """
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(n_trials):
+        trials.append(
+            {
+                k: v(rng) if callable(v) else v[rng.integers(len(v))]
+                for k, v in space.items()
+            }
+        )
+    return trials
+
+
+def core_groups(n_workers=None, threads=None):
+    """
+    Splits the cores this process may run on into one group per worker.
+    threads defaults to an even share of the cores, n_workers to as many
+    workers as fit. Groups wrap around when workers * threads exceeds the
+    cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if threads is None:
+        threads = max(1, len(cores) // (n_workers or len(cores)))
+    if n_workers is None:
+        n_workers = max(1, len(cores) // threads)
+    return [
+        [cores[(w * threads + t) % len(cores)] for t in range(threads)]
+        for w in range(n_workers)
+    ]
+
+
+def _pin_worker(groups):
+    # Worker initializer: claims one core group, pins the process to it and
+    # sizes torch's thread pools to it
+    cores = groups.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already fixed when the worker was forked
+
+
+def run_trial(spec, reports=None):
+    """
+    Trains one agent and returns its row of the results table. spec holds
+    trial, agent, kwargs, seed, make_env, total_steps, runner_kwargs,
+    checkpoints, window, quantile and min_trials as set up by Sweep.
+
+    reports: list
+        One shared list per checkpoint of the scores every trial had there.
+        A trial scoring below the quantile of the others' scores, once
+        min_trials of them have reported, is stopped (median stopping).
+    """
+    start = time.time()
+    seed = spec["seed"]
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    agent = AGENTS[spec["agent"]](**spec["kwargs"])
+    runner = VectorRunner(
+        agent,
+        env=spec["make_env"](seed=seed),
+        seed=seed,
+        log_interval=0,
+        **spec["runner_kwargs"],
+    )
+    checkpoints = spec["checkpoints"]
+    window = spec["window"]
+    curve = []
+    stopped = []
+
+    def score(returns):
+        return float(np.mean(returns[-window:])) if len(returns) > 0 else None
+
+    def checkpoint(runner):
+        while len(curve) < len(checkpoints) and (
+            runner.env_steps >= checkpoints[len(curve)]
+        ):
+            s = score(runner.episode_returns)
+            curve.append(s)
+            if s is None or reports is None:
+                continue
+            shared = reports[len(curve) - 1]
+            others = list(shared)
+            shared.append(s)
+            if len(others) >= spec["min_trials"] and s < np.quantile(
+                others, spec["quantile"]
+            ):
+                stopped.append(checkpoints[len(curve) - 1])
+                return True
+        return False
+
+    stats = runner.run(spec["total_steps"], callback=checkpoint)
+    runner.close()
+    return {
+        "trial": spec["trial"],
+        "agent": spec["agent"],
+        "kwargs": spec["trial_kwargs"],
+        "seed": seed,
+        "score": score(stats["episode_returns"]),
+        "curve": curve,
+        "stopped": len(stopped) > 0,
+        "env_steps": stats["env_steps"],
+        "episodes": len(stats["episode_returns"]),
+        "env_steps_per_sec": stats["env_steps_per_sec"],
+        "updates_per_sec": stats["updates_per_sec"],
+        "wall_time": time.time() - start,
+        "pid": os.getpid(),
+        "cores": (
+            sorted(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else None
+        ),
+    }
+
+
+class Sweep:
+    def __init__(
+        self,
+        agent,
+        make_env,
+        trials,
+        base_kwargs=None,
+        total_steps=100000,
+        runner_kwargs=None,
+        checkpoints=None,
+        window=20,
+        quantile=0.5,
+        min_trials=3,
+        n_workers=None,
+        threads=None,
+        results="sweep.jsonl",
+        seed=0,
+        start_method="spawn",
+    ):
+        """
+        Trains one agent per trial on a process pool, one pinned core group
+        per worker, and appends each trial's row to a JSONL table as soon as
+        it finishes.
+
+        agent: str
+            "DQN", "TD3", "DDPG" or "PG"
+        make_env: callable
+            make_env(seed=seed) returns the vector env of one trial. It is
+            pickled to the workers, so it must be importable, e.g. a module
+            level function or functools.partial(BatchCartPole, 16)
+        trials: list
+            kwargs dicts from grid or random_search, merged over base_kwargs
+            for the agent's constructor
+        runner_kwargs: dict
+            Passed to VectorRunner, e.g. batch_size or learning_starts
+        checkpoints: list
+            Env steps where a trial's score (mean return of its last window
+            episodes) is compared with the other trials', default quarters
+            of total_steps. Trials below the quantile of the others' scores
+            are stopped once min_trials have reported, [] never stops.
+        n_workers: int
+            Worker processes, default as many as the core groups allow
+        threads: int
+            torch threads and pinned cores per worker, default an even
+            share of the available cores
+        results: str
+            JSONL file rows are appended to, None to keep them in memory
+        seed: int
+            Trial i is seeded with seed + i
+        start_method: str
+            multiprocessing start method. spawn gives each worker a fresh
+            torch thread pool, fork can hang if the parent already used it
+        """
+        assert agent in AGENTS, f"agent must be one of {list(AGENTS)}"
+        self.agent = agent
+        self.make_env = make_env
+        self.trials = list(trials)
+        self.base_kwargs = base_kwargs or {}
+        self.total_steps = total_steps
+        self.runner_kwargs = runner_kwargs or {}
+        if checkpoints is None:
+            checkpoints = [total_steps * q // 4 for q in range(1, 4)]
+        self.checkpoints = list(checkpoints)
+        self.window = window
+        self.quantile = quantile
+        self.min_trials = min_trials
+        self.groups = core_groups(n_workers, threads)
+        self.results = results
+        self.seed = seed
+        self.start_method = start_method
+
+    def _spec(self, i, kwargs):
+        return {
+            "trial": i,
+            "agent": self.agent,
+            "kwargs": {**self.base_kwargs, **kwargs},
+            "trial_kwargs": kwargs,
+            "seed": self.seed + i,
+            "make_env": self.make_env,
+            "total_steps": self.total_steps,
+            "runner_kwargs": self.runner_kwargs,
+            "checkpoints": self.checkpoints,
+            "window": self.window,
+            "quantile": self.quantile,
+            "min_trials": self.min_trials,
+        }
+
+    def _write(self, row):
+        if self.results is None:
+            return
+        with open(self.results, "a") as f:
+            f.write(json.dumps(row, default=_json_default) + "\n")
+
+    def run(self):
+        """
+        Runs every trial and returns the rows in the order they finished.
+        A trial that raises gets a row with its error instead of a score.
+        """
+        rows = []
+        ctx = multiprocessing.get_context(self.start_method)
+        with ctx.Manager() as manager:
+            groups = manager.Queue()
+            for g in self.groups:
+                groups.put(g)
+            reports = [manager.list() for _ in self.checkpoints]
+            with ProcessPoolExecutor(
+                max_workers=len(self.groups),
+                mp_context=ctx,
+                initializer=_pin_worker,
+                initargs=(groups,),
+            ) as pool:
+                futures = {
+                    pool.submit(run_trial, self._spec(i, kwargs), reports): i
+                    for i, kwargs in enumerate(self.trials)
+                }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        row = {
+                            "trial": i,
+                            "agent": self.agent,
+                            "kwargs": self.trials[i],
+                            "seed": self.seed + i,
+                            "error": repr(e),
+                        }
+                    self._write(row)
+                    rows.append(row)
+        return rows
+
+
+def _json_default(x):
+    # NumPy scalars and arrays, anything else by its repr
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    return repr(x)
+
+
+if __name__ == "__main__":
+    import sys
+    from functools import partial
+    from flexibuddiesrl.Envs import BatchCartPole
+
+    # python -m flexibuddiesrl.Sweep [results.jsonl]
+    results = sys.argv[1] if len(sys.argv) > 1 else "sweep.jsonl"
+    sweep = Sweep(
+        "DQN",
+        partial(BatchCartPole, 16),
+        grid({"lr": [1e-4, 1e-3, 1e-2], "gamma": [0.9, 0.99]}),
+        base_kwargs={
+            "obs_dim": 4,
+            "discrete_action_dims": [2],
+            "continuous_action_dims": 0,
+            "hidden_dims": [64, 64],
+            "dueling": True,
+        },
+        total_steps=20000,
+        runner_kwargs={"learning_starts": 1000, "batch_size": 128},
+        checkpoints=[5000, 10000, 15000],
+        min_trials=2,
+        results=results,
+    )
+    start = time.time()
+    for row in sweep.run():
+        print(
+            f"trial {row['trial']} {row['kwargs']} score: {row.get('score')} "
+            f"curve: {row.get('curve')} stopped: {row.get('stopped')} "
+            f"cores: {row.get('cores')} {row.get('error', '')}"
+        )
+    print(
+        f"{len(sweep.trials)} trials on {len(sweep.groups)} workers in "
+        f"{time.time() - start:.1f}s, results in {results}"
+    )
@@ -1,8 +1,22 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
-from flexibuddiesrl.Agent import Agent, MixedActor, ValueSA
-from flexibuddiesrl.Util import T, get_multi_discrete_one_hot
+from flexibuddiesrl.Agent import (
+    Agent,
+    MixedActor,
+    ValueSA,
+    AttentionCritic,
+    RecurrentEncoder,
+    keeps_hidden,
+)
+from flexibuddiesrl.Util import (
+    T,
+    get_multi_discrete_one_hot,
+    per_agent_mean,
+    team_actions,
+    policy_team_actions,
+    upcast_batch,
+)
 from flexibuff import FlexiBatch
 import os
 import pickle
@@ -26,6 +40,10 @@ class TD3(Agent):
         eval_mode=False,
         gumbel_tau=0.25,
         rand_steps=10000,
+        centralized_critic=False,
+        critic_heads=4,
+        recurrent=None,
+        rnn_hidden=64,
     ):
         # documentation
         """
@@ -51,6 +69,16 @@ class TD3(Agent):
         name: str
             The name of the agent
         device: str
+        centralized_critic: bool
+            Use an AttentionCritic over every agent's obs and action instead
+            of a ValueSA on this agent's own. Agents share action spaces.
+        critic_heads: int
+            Attention heads of the centralized critic
+        recurrent: str
+            "gru" or "lstm" to give the actor and critics RecurrentEncoders.
+            Train on Buffer.sample_sequences batches.
+        rnn_hidden: int
+            Hidden size of the recurrent encoders
         """
 
         self.attrs = [
@@ -71,6 +99,10 @@ class TD3(Agent):
             "rand_steps",
             "step",
             "rl_step",
+            "centralized_critic",
+            "critic_heads",
+            "recurrent",
+            "rnn_hidden",
         ]
 
         assert not (
@@ -92,9 +124,16 @@ class TD3(Agent):
         self.eval_mode = eval_mode
         self.name = name
         self.hidden_dims = hidden_dims
+        self.centralized_critic = centralized_critic
+        self.critic_heads = critic_heads
+        self.recurrent = recurrent
+        self.rnn_hidden = rnn_hidden
+        assert not (
+            recurrent and centralized_critic
+        ), "The centralized critic is not recurrent"
 
-        self.total_action_dim = continuous_action_dim + np.sum(
-            np.array(discrete_action_dims)
+        self.total_action_dim = continuous_action_dim + int(
+            np.sum(np.array(discrete_action_dims))
         )
         self.discrete_action_dims = discrete_action_dims
         self.continuous_action_dim = continuous_action_dim
@@ -119,7 +158,7 @@ class TD3(Agent):
             min_actions=self.min_actions,
             device=self.device,
             hidden_dims=self.hidden_dims,
-            encoder=None,
+            encoder=self._make_encoder(),
             tau=self.gumbel_tau,
             hard=False,
         ).float()
@@ -131,7 +170,7 @@ class TD3(Agent):
             min_actions=self.min_actions,
             device=self.device,
             hidden_dims=self.hidden_dims,
-            encoder=None,
+            encoder=self._make_encoder(),
             tau=self.gumbel_tau,
             hard=False,
         ).float()
@@ -142,30 +181,10 @@ class TD3(Agent):
         self.actor_target.to(self.device)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters())
 
-        self.critic1 = ValueSA(
-            self.obs_dim,
-            self.total_action_dim,
-            hidden_dim=self.hidden_dims[-1],
-            device=self.device,
-        ).float()
-        self.critic2 = ValueSA(
-            self.obs_dim,
-            self.total_action_dim,
-            hidden_dim=self.hidden_dims[-1],
-            device=self.device,
-        ).float()
-        self.critic1_target = ValueSA(
-            self.obs_dim,
-            self.total_action_dim,
-            hidden_dim=self.hidden_dims[-1],
-            device=self.device,
-        ).float()
-        self.critic2_target = ValueSA(
-            self.obs_dim,
-            self.total_action_dim,
-            hidden_dim=self.hidden_dims[-1],
-            device=self.device,
-        ).float()
+        self.critic1 = self._make_critic()
+        self.critic2 = self._make_critic()
+        self.critic1_target = self._make_critic()
+        self.critic2_target = self._make_critic()
         self.critic1_target.load_state_dict(self.critic1.state_dict())
         self.critic2_target.load_state_dict(self.critic2.state_dict())
         # self.critic2.load_state_dict(self.critic1.state_dict())
@@ -177,6 +196,43 @@ class TD3(Agent):
             list(self.critic1.parameters()) + list(self.critic2.parameters())
         )
 
+    def _make_encoder(self):
+        if not self.recurrent:
+            return None
+        return RecurrentEncoder(
+            self.obs_dim,
+            self.hidden_dims[:-1],
+            rnn_hidden=self.rnn_hidden,
+            cell=self.recurrent,
+            device=self.device,
+        )
+
+    def _make_critic(self):
+        if self.centralized_critic:
+            return AttentionCritic(
+                self.obs_dim,
+                self.total_action_dim,
+                hidden_dims=self.hidden_dims,
+                n_heads=self.critic_heads,
+                device=self.device,
+            ).float()
+        return ValueSA(
+            self.obs_dim,
+            self.total_action_dim,
+            hidden_dim=self.hidden_dims[-1],
+            device=self.device,
+            encoder=self._make_encoder(),
+        ).float()
+
+    def _q(
+        self, critic, obs, u, team_obs=None, team_u=None, agent_mask=None, agent_num=0
+    ):
+        # Q of agent_num taking u, attending over the rest of team_u if the
+        # critic is centralized and the team's obs are given
+        if team_obs is None:
+            return critic(obs, u).squeeze(-1)
+        return critic.agent_value(team_obs, agent_num, team_u, u, agent_mask)
+
     def __noise__(self, continuous_actions: torch.Tensor):
         noise = torch.normal(
             0,
@@ -200,28 +256,37 @@ class TD3(Agent):
         # print(noisyact)
         return noisyact
 
-    def _get_random_actions(self, action_mask=None, debug=False):
+    def _get_random_actions(self, action_mask=None, debug=False, n=None):
+        # n random actions for a batch of n observations, one action if None
+        lead = () if n is None else (n,)
         continuous_actions = (
-            torch.rand(size=(self.continuous_action_dim,), device=self.device) * 2 - 1
+            torch.rand(size=lead + (self.continuous_action_dim,), device=self.device)
+            * 2
+            - 1
         ) * self.actor.action_scales - self.actor.action_biases
         discrete_actions = torch.zeros(
-            (len(self.discrete_action_dims),), device=self.device, dtype=torch.long
+            lead + (len(self.discrete_action_dims),),
+            device=self.device,
+            dtype=torch.long,
         )
 
         for dim, dim_size in enumerate(self.discrete_action_dims):
-            discrete_actions[dim] = torch.randint(dim_size, (1,))
+            discrete_actions[..., dim] = torch.randint(
+                dim_size, lead if n is not None else (1,), device=self.device
+            )
         return discrete_actions, continuous_actions
 
     def train_actions(self, observations, action_mask=None, step=False, debug=False):
         observations = T(observations, self.device, debug=debug)
         if debug:
             print("    TD3 train_actions Observations: ", observations)
+        n_obs = observations.shape[0] if observations.dim() > 1 else None
         if step:
-            self.step += 1
+            self.step += 1 if n_obs is None else n_obs
 
         if self.step < self.rand_steps:
             discrete_actions, continuous_actions = self._get_random_actions(
-                action_mask, debug=debug
+                action_mask, debug=debug, n=n_obs
             )
 
             return (
@@ -231,7 +296,7 @@ class TD3(Agent):
                 None,
                 None,
             )
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             continuous_actions, discrete_action_activations = self.actor(
                 x=observations, action_mask=action_mask, gumbel=True, debug=debug
             )
@@ -282,7 +347,7 @@ class TD3(Agent):
             for i, activation in enumerate(discrete_action_activations):
                 if debug:
                     print("    TD3 train_actions activation: ", activation)
-                discrete_actions[i] = torch.argmax(activation, dim=-1)
+                discrete_actions[..., i] = torch.argmax(activation, dim=-1)
 
             if debug:
                 print(
@@ -320,52 +385,21 @@ class TD3(Agent):
         aloss_item = 0
         closs_item = 0
         self.rl_step += 1
-        with torch.no_grad():
-            if batch.action_mask is not None:
-                mask = batch.action_mask[agent_num]
-                mask_ = batch.action_mask_[agent_num]
-            else:
-                mask = 1.0
-                mask_ = 1.0
-            continuous_actions_, discrete_action_activations_ = self.actor_target(
-                batch.obs_[agent_num], mask_, gumbel=True
-            )
-            daa_ = discrete_action_activations_
-            if len(discrete_action_activations_) == 1:
-                daa_ = discrete_action_activations_[0]
-            else:
-                daa_ = torch.cat(discrete_action_activations_, dim=-1)
-
-            if debug:
-                print(
-                    "TD3 reinforcement_learn continuous_actions_: ",
-                    continuous_actions_,
-                )
-                print(
-                    "TD3 reinforcement_learn discrete_action_activations_: ",
-                    discrete_action_activations_,
-                )
-                print("TD3 reinforcement_learn daa_: ", daa_)
-                # input()
-            u_ = torch.cat([self._add_noise(continuous_actions_), daa_], dim=-1)
-
-            if debug:
-                print("u_: ", u_, "shape: ", u_.shape)
-            qtarget = torch.minimum(
-                self.critic1_target(x=batch.obs_[agent_num], u=u_),
-                self.critic2_target(x=batch.obs_[agent_num], u=u_),
-            ).squeeze(-1)
-            if debug:
-                print("TD3 reinforcement_learn qtarget: ", qtarget)
-            # TODO configure reward channel beyong just global_rewards
-            next_q_value = (
-                batch.global_rewards + (1 - batch.terminated) * self.gamma * qtarget
-            )
-            if debug:
-                print("TD3 reinforcement_learn next_q_value: ", next_q_value)
+        batch = upcast_batch(batch)
+        if self.recurrent:
+            self.set_recurrent_context(batch, agent_num)
+        mask = None
+        mask_ = None
+        if batch.action_mask is not None:
+            mask = batch.action_mask[agent_num]
+            mask_ = batch.action_mask_[agent_num]
+        team_obs, team_obs_, team_u, agent_mask = None, None, None, None
+        if self.centralized_critic:
+            team_obs, team_obs_ = batch.obs, batch.obs_
+            team_u = team_actions(batch, self.discrete_action_dims)
+            agent_mask = getattr(batch, "agent_mask", None)
 
         # for each discrete action, get the one hot coding and concatinate them
-
         actions = torch.cat(
             [
                 batch.continuous_actions[agent_num],
@@ -377,38 +411,154 @@ class TD3(Agent):
             ],
             dim=-1,
         )
-        q1_values = self.critic1(batch.obs[agent_num], actions).squeeze(-1)
-        q2_values = self.critic2(batch.obs[agent_num], actions).squeeze(-1)
-        qf1_loss = F.mse_loss(q1_values, next_q_value)
-        qf2_loss = F.mse_loss(q2_values, next_q_value)
-        L = qf1_loss + qf2_loss
-
-        # optimize the critic
-        self.critic_optimizer.zero_grad()
-        L.backward()
-        self.critic_optimizer.step()
+        bsize = batch.global_rewards.shape[0]
+        weights = torch.full((bsize,), 1.0 / bsize, device=self.device)
+        is_weights = getattr(batch, "is_weights", None)
+        if is_weights is not None:
+            # importance weights from a PrioritizedReplayBuffer batch
+            critic_weights = weights * is_weights
+        else:
+            critic_weights = weights
+
+        critic_update = self._update("critic", self._critic_loss, self.critic_optimizer)
+        L, td_errors, critic_samples = critic_update(
+            critic_weights,
+            batch.obs[agent_num],
+            batch.obs_[agent_num],
+            mask_,
+            actions,
+            batch.global_rewards,
+            batch.terminated,
+            team_obs,
+            team_obs_,
+            team_u,
+            agent_mask,
+            agent_num=agent_num,
+        )
+        if debug:
+            print("TD3 reinforcement_learn td_errors: ", td_errors)
+        # per-sample |td error| for PrioritizedReplayBuffer.update_priorities
+        self.td_errors = td_errors
+        actor_samples = torch.zeros_like(td_errors)
 
         if self.rl_step % self.policy_frequency == 0 and not critic_only:
-            c_act, d_act = self.actor(x=batch.obs[agent_num], action_mask=mask)
-
-            if len(d_act) == 1:
-                d_act = d_act[0]
-            else:
-                d_act = torch.cat(d_act, dim=-1)
-            actor_loss = -self.critic1(
-                batch.obs[agent_num], torch.cat([c_act, d_act], dim=-1)
-            ).mean()
-            self.actor_optimizer.zero_grad()
-            actor_loss.backward()
-            self.actor_optimizer.step()
+            actor_update = self._update("actor", self._actor_loss, self.actor_optimizer)
+            actor_loss, actor_samples = actor_update(
+                weights,
+                batch.obs[agent_num],
+                mask,
+                team_obs,
+                team_u,
+                agent_mask,
+                agent_num=agent_num,
+            )
 
             # update the target network
             self.polyak_update(self.target_update_percentage)
-            aloss_item = actor_loss.item()
-
-        closs_item = L.item()
+            aloss_item = self._loss_item(actor_loss)
+
+        closs_item = self._loss_item(L)
+        if self.recurrent:
+            self.clear_recurrent_context()
+        if getattr(batch, "agent_ids", None) is not None:
+            self.agent_losses = (
+                per_agent_mean(actor_samples, batch.agent_ids, batch.n_agents),
+                per_agent_mean(critic_samples, batch.agent_ids, batch.n_agents),
+            )
         return aloss_item, closs_item
 
+    def _critic_loss(
+        self,
+        weights,
+        obs,
+        obs_,
+        mask_,
+        actions,
+        rewards,
+        terminated,
+        team_obs=None,
+        team_obs_=None,
+        team_u=None,
+        agent_mask=None,
+        agent_num=0,
+    ):
+        """
+        Clipped double Q loss of both critics as a pure function of tensors
+        for Compile.CompiledUpdate. Returns (loss, |td error| [B],
+        per-row critic loss [B]).
+        """
+        with torch.no_grad():
+            continuous_actions_, discrete_action_activations_ = self.actor_target(
+                obs_, mask_, gumbel=True
+            )
+            if len(discrete_action_activations_) == 1:
+                daa_ = discrete_action_activations_[0]
+            else:
+                daa_ = torch.cat(discrete_action_activations_, dim=-1)
+            u_ = torch.cat([self._add_noise(continuous_actions_), daa_], dim=-1)
+            team_u_ = None
+            if team_obs_ is not None:
+                team_u_ = policy_team_actions(self.actor_target, team_obs_)
+            qtarget = torch.minimum(
+                self._q(
+                    self.critic1_target,
+                    obs_,
+                    u_,
+                    team_obs_,
+                    team_u_,
+                    agent_mask,
+                    agent_num,
+                ),
+                self._q(
+                    self.critic2_target,
+                    obs_,
+                    u_,
+                    team_obs_,
+                    team_u_,
+                    agent_mask,
+                    agent_num,
+                ),
+            )
+            # TODO configure reward channel beyong just global_rewards
+            next_q_value = rewards + (1 - terminated) * self.gamma * qtarget
+
+        q1_values = self._q(
+            self.critic1, obs, actions, team_obs, team_u, agent_mask, agent_num
+        )
+        q2_values = self._q(
+            self.critic2, obs, actions, team_obs, team_u, agent_mask, agent_num
+        )
+        qf1_samples = (q1_values - next_q_value) ** 2
+        qf2_samples = (q2_values - next_q_value) ** 2
+        L = (weights * qf1_samples).sum() + (weights * qf2_samples).sum()
+        return (
+            L,
+            (q1_values - next_q_value).detach().abs(),
+            (qf1_samples + qf2_samples).detach(),
+        )
+
+    def _actor_loss(
+        self,
+        weights,
+        obs,
+        mask,
+        team_obs=None,
+        team_u=None,
+        agent_mask=None,
+        agent_num=0,
+    ):
+        # Deterministic policy gradient through critic1, returns (loss, -Q [B])
+        c_act, d_act = self.actor(x=obs, action_mask=mask)
+        if len(d_act) == 1:
+            d_act = d_act[0]
+        else:
+            d_act = torch.cat(d_act, dim=-1)
+        u = torch.cat([c_act, d_act], dim=-1)
+        actor_samples = -self._q(
+            self.critic1, obs, u, team_obs, team_u, agent_mask, agent_num
+        )
+        return (weights * actor_samples).sum(), actor_samples.detach()
+
     def ego_actions(self, observations, action_mask=None):
         with torch.no_grad():
             continuous_actions, discrete_action_activations = self.actor(
@@ -436,10 +586,34 @@ class TD3(Agent):
         self.polyak_update(self.target_update_percentage)
         return loss
 
-    def utility_function(self, observations, actions=None):
-        return 0  # Returns the single-agent critic for a single action.
-        # If actions are none then V(s)
+    @keeps_hidden
+    def utility_function(self, observations, actions=None, target=False):
+        # Q(s,a) for the stored actions, or Q(s,pi(s)) if actions is None.
+        # target reads the actor and first critic target networks
+        observations = T(observations, self.device)
+        actor = self.actor_target if target else self.actor
+        critic = self.critic1_target if target else self.critic1
+        if actions is None:
+            c_act, d_act = actor(x=observations, gumbel=False)
+            u = list(d_act) if d_act is not None else []
+            if self.continuous_action_dim > 0:
+                u = [c_act] + u
+        else:
+            u = []
+            if self.continuous_action_dim > 0:
+                u.append(actions[1])
+            if (
+                self.discrete_action_dims is not None
+                and len(self.discrete_action_dims) > 0
+            ):
+                u.append(
+                    get_multi_discrete_one_hot(
+                        actions[0], discrete_action_dims=self.discrete_action_dims
+                    )
+                )
+        return critic(observations, torch.cat(u, dim=-1)).squeeze(-1)
 
+    @keeps_hidden
     def expected_V(self, obs, legal_action=None):
         qtot = 0
         with torch.no_grad:
@@ -508,12 +682,22 @@ class TD3(Agent):
             checkpoint_path = "./" + self.name + "/"
 
         for i in range(len(self.attrs)):
+            # attrs added after a checkpoint was written keep their defaults
+            if not os.path.exists(checkpoint_path + f"/{self.attrs[i]}"):
+                continue
             self.__dict__[self.attrs[i]] = self._load_attr(
                 checkpoint_path + f"/{self.attrs[i]}"
             )
-        self.total_action_dim = self.continuous_action_dim + np.sum(
-            np.array(self.discrete_action_dims)
+        self.total_action_dim = self.continuous_action_dim + int(
+            np.sum(np.array(self.discrete_action_dims))
         )
+        # saved as tensors but MixedActor builds its scales from numpy
+        if torch.is_tensor(self.min_actions):
+            self.min_actions = self.min_actions.cpu().numpy()
+            self.max_actions = self.max_actions.cpu().numpy()
+
+        self._get_torch_params()
+
         if self.continuous_action_dim > 0:
             self.min_actions = torch.from_numpy(np.array(self.min_actions)).to(
                 self.device
@@ -522,8 +706,6 @@ class TD3(Agent):
                 self.device
             )
 
-        self._get_torch_params()
-
         self.actor.load_state_dict(torch.load(checkpoint_path + "/actor"))
         self.actor_target.load_state_dict(torch.load(checkpoint_path + "/actor_target"))
         self.critic1.load_state_dict(torch.load(checkpoint_path + "/critic1"))
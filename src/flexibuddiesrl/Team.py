@@ -0,0 +1,86 @@
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TeamUpdater:
+    def __init__(self, agents, n_workers=None, intra_op_threads=None, cost_decay=0.9):
+        """
+        agents: list
+            One Agent per team member. Agent i learns from agent_num=i of the
+            team batch unless agent_nums says otherwise.
+        n_workers: int
+            Number of agents updated concurrently, defaults to len(agents)
+        intra_op_threads: int
+            Total torch threads to split between workers, defaults to the
+            current torch.get_num_threads()
+        cost_decay: float
+            Smoothing for the measured per-agent update time used to order
+            work longest first
+        """
+        self.agents = agents
+        self.n_workers = n_workers if n_workers is not None else len(agents)
+        self.n_workers = max(1, min(self.n_workers, len(agents)))
+        self.intra_op_threads = (
+            intra_op_threads
+            if intra_op_threads is not None
+            else torch.get_num_threads()
+        )
+        self.cost_decay = cost_decay
+        self.costs = [0.0] * len(agents)
+        self.pool = ThreadPoolExecutor(max_workers=self.n_workers)
+
+    def _update_one(self, i, batch, agent_num, critic_only, debug):
+        start = time.perf_counter()
+        losses = self.agents[i].reinforcement_learn(
+            batch, agent_num=agent_num, critic_only=critic_only, debug=debug
+        )
+        elapsed = time.perf_counter() - start
+        if self.costs[i] == 0.0:
+            self.costs[i] = elapsed
+        else:
+            self.costs[i] = (
+                self.cost_decay * self.costs[i] + (1 - self.cost_decay) * elapsed
+            )
+        return losses
+
+    def update(self, batch, agent_nums=None, critic_only=False, debug=False):
+        """
+        batch: FlexiBatch or list of FlexiBatch
+            A team batch shared by every agent, or one batch per agent
+        agent_nums: list
+            agent_num each agent reads from its batch, defaults to its index
+
+        Returns a list of (actor_loss, critic_loss), one per agent in order.
+        """
+        n = len(self.agents)
+        batches = batch if isinstance(batch, (list, tuple)) else [batch] * n
+        if agent_nums is None:
+            agent_nums = list(range(n))
+
+        # torch releases the GIL inside ops, but the intra-op pool is process
+        # wide, so each worker gets an equal share of it to avoid oversubscription
+        old_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, self.intra_op_threads // self.n_workers))
+
+        # Longest measured update first so the slowest agent does not start last
+        order = sorted(range(n), key=lambda i: self.costs[i], reverse=True)
+        try:
+            futures = {
+                i: self.pool.submit(
+                    self._update_one,
+                    i,
+                    batches[i],
+                    agent_nums[i],
+                    critic_only,
+                    debug,
+                )
+                for i in order
+            }
+            losses = [futures[i].result() for i in range(n)]
+        finally:
+            torch.set_num_threads(old_threads)
+        return losses
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -1,3 +1,4 @@
+import copy
 import torch
 import numpy as np
 
@@ -15,6 +16,18 @@ def T(a, device="cpu", dtype=torch.float32, debug=False):
         return a.to(device)
 
 
+def autocast(device, dtype=None):
+    # torch.autocast on the device's type, a no-op context when dtype is None.
+    # The weight cast cache is off because a no_grad target pass would cache
+    # casts without grad for the online pass that follows.
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=dtype if dtype is not None else torch.bfloat16,
+        enabled=dtype is not None,
+        cache_enabled=False,
+    )
+
+
 def get_multi_discrete_one_hot(x, discrete_action_dims, debug=False):
     onehot = torch.zeros((x.shape[0], sum(discrete_action_dims)), device=x.device)
     start = 0
@@ -27,5 +40,285 @@ def get_multi_discrete_one_hot(x, discrete_action_dims, debug=False):
     return onehot
 
 
+def team_actions(batch, discrete_action_dims):
+    # Stored continuous and one-hot discrete actions of every agent
+    # [n_agents, B, action_dim] for centralized critics
+    n_agents, bsize = batch.obs.shape[:2]
+    u = [batch.continuous_actions.float()]
+    if discrete_action_dims is not None and len(discrete_action_dims) > 0:
+        onehot = get_multi_discrete_one_hot(
+            batch.discrete_actions.reshape(n_agents * bsize, -1),
+            discrete_action_dims=discrete_action_dims,
+        )
+        u.append(onehot.reshape(n_agents, bsize, -1))
+    return torch.cat(u, dim=-1)
+
+
+def policy_team_actions(actor, team_obs, gumbel=True):
+    # Actor outputs for every agent's obs [n_agents, B, action_dim]
+    n_agents, bsize = team_obs.shape[:2]
+    c_act, d_act = actor(team_obs.reshape(n_agents * bsize, -1), gumbel=gumbel)
+    u = [c_act] if c_act is not None else []
+    u = u + (list(d_act) if d_act is not None else [])
+    return torch.cat(u, dim=-1).reshape(n_agents, bsize, -1)
+
+
+def pad_entities(entities, max_entities=None, entity_dim=None):
+    """
+    Stacks a list of [n_i, entity_dim] entity arrays into a padded
+    [B, max_entities, entity_dim + 1] array for a SetEncoder, instead of
+    np.pad'ing every observation to a fixed size. The last feature of each
+    entity is 1 when present and 0 for padding, so all-zero entities stay
+    distinguishable from empty slots. reshape(B, -1) gives the flat form.
+    """
+    if max_entities is None:
+        max_entities = max([len(e) for e in entities] + [1])
+    if entity_dim is None:
+        entity_dim = next(np.shape(e)[-1] for e in entities if len(e) > 0)
+    x = np.zeros((len(entities), max_entities, entity_dim + 1), dtype=np.float32)
+    for i, e in enumerate(entities):
+        n = min(len(e), max_entities)
+        if n > 0:
+            x[i, :n, :-1] = np.asarray(e, dtype=np.float32)[:n]
+            x[i, :n, -1] = 1.0
+    return x
+
+
+def entity_buckets(entity_counts, bucket_width=4):
+    """
+    Groups sample indices by entity count rounded up to bucket_width.
+    Returns a list of (indices, n_entities) so each bucket can be run as
+    x[indices, :n_entities] with at most bucket_width - 1 padded slots.
+    """
+    counts = np.asarray(entity_counts)
+    sizes = np.maximum(np.ceil(counts / bucket_width), 1).astype(np.int64)
+    sizes = sizes * bucket_width
+    return [(np.nonzero(sizes == n)[0], int(n)) for n in np.unique(sizes)]
+
+
+def dense_to_indices(x, max_active, dense_dim=0):
+    """
+    Converts [B, dense_dim + vocab] observations with a multi-hot tail into
+    the [B, dense_dim + max_active] padded id form a SparseEncoder reads, so
+    replay stores ids instead of vocab-sized vectors. Empty slots are -1.
+    """
+    x = np.asarray(x)
+    lead = x.shape[:-1]
+    x = x.reshape(-1, x.shape[-1])
+    out = np.full((x.shape[0], dense_dim + max_active), -1, dtype=np.float32)
+    out[:, :dense_dim] = x[:, :dense_dim]
+    for i in range(x.shape[0]):
+        ids = np.nonzero(x[i, dense_dim:])[0][:max_active]
+        out[i, dense_dim : dense_dim + len(ids)] = ids
+    return out.reshape(lead + (dense_dim + max_active,))
+
+
+def csr_to_indices(indices, offsets, max_active):
+    # (indices, offsets) bags -> [B, max_active] padded ids with -1 padding
+    indices = np.asarray(indices)
+    ends = np.append(np.asarray(offsets)[1:], len(indices))
+    out = np.full((len(offsets), max_active), -1, dtype=np.float32)
+    for i, (start, end) in enumerate(zip(offsets, ends)):
+        n = min(end - start, max_active)
+        out[i, :n] = indices[start : start + n]
+    return out
+
+
+def holds_ids(dtype, num_ids):
+    # True if dtype stores every id in [-1, num_ids) exactly (-1 is padding)
+    if dtype.is_floating_point:
+        # consecutive integers are exact up to 2 ** (mantissa bits + 1)
+        return num_ids - 1 <= 2 / torch.finfo(dtype).eps
+    info = torch.iinfo(dtype)
+    return info.min < 0 and num_ids - 1 <= info.max
+
+
 def normgrad(parameters, grad_clip=0.5):
     torch.nn.utils.clip_grad_norm_(parameters, grad_clip)
+
+
+# FlexiBatch fields indexed by agent first ([n_agents, B, ...]) and fields
+# shared by the whole team ([B, ...])
+AGENT_FIELDS = [
+    "obs",
+    "obs_",
+    "discrete_actions",
+    "continuous_actions",
+    "discrete_log_probs",
+    "continuous_log_probs",
+    "individual_rewards",
+    "individual_auxiliary_rewards",
+    "action_mask",
+    "action_mask_",
+    "values",
+]
+GLOBAL_FIELDS = [
+    "state",
+    "state_",
+    "global_rewards",
+    "global_auxiliary_rewards",
+    "terminated",
+    "memory_weights",
+]
+
+
+def append_agent_id(obs, agent_num, n_agents):
+    # One-hot agent id appended to the observation for parameter sharing
+    obs = T(obs).float()
+    one_hot = torch.zeros(obs.shape[:-1] + (n_agents,), device=obs.device)
+    one_hot[..., agent_num] = 1.0
+    return torch.cat([obs, one_hot], dim=-1)
+
+
+def select_agents(batch, agent_nums, n_agents=None):
+    """
+    Returns a shallow copy of batch holding only agent_nums on the agent
+    axis. If n_agents is given, a one-hot agent id is appended to obs and obs_.
+    """
+    selected = copy.copy(batch)
+    for f in AGENT_FIELDS:
+        x = getattr(batch, f, None)
+        if x is None:
+            continue
+        if isinstance(x, list):
+            x = [x[a] for a in agent_nums]
+        else:
+            x = x[agent_nums]
+        setattr(selected, f, x)
+    if n_agents is not None:
+        for f in ["obs", "obs_"]:
+            x = getattr(selected, f)
+            ids = torch.zeros(x.shape[:-1] + (n_agents,), device=x.device)
+            for i, a in enumerate(agent_nums):
+                ids[i, ..., a] = 1.0
+            setattr(selected, f, torch.cat([x.float(), ids], dim=-1))
+    return selected
+
+
+def flatten_agents(batch):
+    """
+    Returns a shallow copy of batch with the agent axis folded into the batch
+    axis so [n_agents, B, ...] becomes [1, n_agents * B, ...] and team fields
+    are repeated once per agent. agent_ids holds the agent index of each row.
+    """
+    flat = copy.copy(batch)
+    n_agents = len(batch.obs)
+    bsize = batch.obs[0].shape[0]
+    for f in AGENT_FIELDS:
+        x = getattr(batch, f, None)
+        if x is None:
+            continue
+        if isinstance(x, list):
+            setattr(flat, f, [torch.cat(list(x), dim=0)])
+        else:
+            setattr(flat, f, x.reshape((1, -1) + tuple(x.shape[2:])))
+    for f in GLOBAL_FIELDS:
+        x = getattr(batch, f, None)
+        if x is None:
+            continue
+        setattr(flat, f, x.repeat((n_agents,) + (1,) * (x.dim() - 1)))
+    flat.agent_ids = torch.arange(n_agents, device=batch.obs.device).repeat_interleave(
+        bsize
+    )
+    flat.n_agents = n_agents
+    return flat
+
+
+# per-row extras some batches carry next to the FlexiBatch fields
+ROW_EXTRAS = ["is_weights", "indices", "agent_ids", "episode_starts"]
+
+
+def batch_rows(batch, idx):
+    """
+    Returns a shallow copy of batch holding only rows idx of the batch axis,
+    e.g. one minibatch of a large sample. idx is a long tensor on the
+    batch's device.
+    """
+    rows = copy.copy(batch)
+    for f in AGENT_FIELDS:
+        x = getattr(batch, f, None)
+        if x is None:
+            continue
+        if isinstance(x, list):
+            # per-agent [B, d] or per-head [n_agents, B, d] masks
+            setattr(rows, f, [a.index_select(a.dim() - 2, idx) for a in x])
+        else:
+            setattr(rows, f, x.index_select(1, idx))
+    for f in GLOBAL_FIELDS + ROW_EXTRAS:
+        x = getattr(batch, f, None)
+        if torch.is_tensor(x):
+            setattr(rows, f, x.index_select(0, idx))
+    return rows
+
+
+def per_agent_sum(x, agent_ids, n_agents):
+    # Sums and counts of per-sample losses x [B, ...] for each agent id
+    x = x.detach().float().reshape(agent_ids.shape[0], -1).mean(dim=-1)
+    sums = torch.zeros(n_agents, device=x.device).index_add_(0, agent_ids, x)
+    counts = torch.bincount(agent_ids, minlength=n_agents)
+    return sums.cpu().numpy(), counts.cpu().numpy()
+
+
+def per_agent_mean(x, agent_ids, n_agents):
+    sums, counts = per_agent_sum(x, agent_ids, n_agents)
+    return sums / np.maximum(counts, 1)
+
+
+def pack_mask(mask):
+    # [..., dim] legal action mask -> uint8 [..., ceil(dim / 8)], 8 actions per byte
+    mask = torch.as_tensor(mask) > 0.5
+    dim = mask.shape[-1]
+    pad = (-dim) % 8
+    if pad:
+        mask = torch.cat([mask, mask.new_zeros(mask.shape[:-1] + (pad,))], dim=-1)
+    bits = mask.reshape(mask.shape[:-1] + (-1, 8)).to(torch.uint8)
+    weights = 2 ** torch.arange(8, device=mask.device, dtype=torch.uint8)
+    return (bits * weights).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_mask(packed, dim):
+    # inverse of pack_mask as a float mask
+    shifts = torch.arange(8, device=packed.device, dtype=torch.uint8)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.reshape(packed.shape[:-1] + (-1,))[..., :dim].float()
+
+
+COMPACT_FLOATS = [torch.float16, torch.bfloat16, torch.float64]
+
+
+def upcast_batch(batch):
+    """
+    Full precision view of a batch stored with compact dtypes: fp16 / bf16
+    floats become float32, small int actions become int64 and bit-packed
+    masks (batch.packed_mask_dims) become float masks. uint8 obs are left
+    for encoders that scale them. Returns batch itself when nothing is
+    compact, otherwise a shallow copy.
+    """
+    changes = {}
+    for f in AGENT_FIELDS + GLOBAL_FIELDS:
+        x = getattr(batch, f, None)
+        if not torch.is_tensor(x):
+            continue
+        if x.dtype in COMPACT_FLOATS:
+            changes[f] = x.float()
+        elif f == "discrete_actions" and x.dtype != torch.long:
+            changes[f] = x.long()
+    mask_dims = getattr(batch, "packed_mask_dims", None)
+    if mask_dims is not None:
+        for f in ["action_mask", "action_mask_"]:
+            x = getattr(batch, f, None)
+            if x is None:
+                continue
+            if isinstance(x, list):
+                changes[f] = [unpack_mask(m, d) for m, d in zip(x, mask_dims)]
+            else:
+                # a single mask tensor is the one discrete head
+                assert len(mask_dims) == 1, "packed masks need one tensor per head"
+                changes[f] = unpack_mask(x, mask_dims[0])
+    if len(changes) == 0:
+        return batch
+    full = copy.copy(batch)
+    for f, x in changes.items():
+        setattr(full, f, x)
+    full.packed_mask_dims = None
+    return full
@@ -4,3 +4,11 @@ from flexibuddiesrl.TD3 import *
 from flexibuddiesrl.PG import *
 from flexibuddiesrl.DQN import *
 from flexibuddiesrl.Util import *
+from flexibuddiesrl.Compile import *
+from flexibuddiesrl.Team import *
+from flexibuddiesrl.Mixer import *
+from flexibuddiesrl.Buffer import *
+from flexibuddiesrl.Runner import *
+from flexibuddiesrl.Population import *
+from flexibuddiesrl.Sweep import *
+from flexibuddiesrl.Envs import *